@@ -0,0 +1,1185 @@
+#!/usr/bin/env python3
+#  -*- coding: utf-8 -*-
+
+"""
+	benchmark.py: timings of the data pipeline, comparing the current implementation against the previous one.
+	Usage: python benchmark.py [benchmark_name ...], runs all the benchmarks if no name is given.
+"""
+
+import os
+import sys
+import time
+import subprocess
+import shutil
+import tracemalloc
+import io
+import contextlib
+
+import numpy as np
+import scipy.sparse as sps
+
+from utils import data_manager
+from utils.create_submission_file import SubmissionWriter
+from utils.compute_similarity import Compute_Similarity_Python, Compute_Similarity_Euclidean, similarityMatrixTopK
+from utils.similarity_cache import SimilarityCache
+from utils.compact_similarity import CompactSimilarityMatrix
+from utils.Evaluation.Evaluator import EvaluatorHoldout
+from recommenders.KNN.UserKNNCFRecommender import UserKNNCFRecommender
+from recommenders.KNN.ItemKNNCFRecommender import ItemKNNCFRecommender
+from utils.data_splitter import split_train_leave_k_out_user_wise, split_k_fold_user_wise, IncrementalSparseMatrix, \
+    IncrementalSparseMatrix_ListBased, assert_disjoint_matrices, assert_split_integrity
+
+
+def time_function(function, *args, n_repetitions=3, **kwargs):
+    """
+    Calls the function n_repetitions times and returns the best time in seconds and the last result
+    """
+
+    best_time = np.inf
+    result = None
+
+    for _ in range(n_repetitions):
+        start_time = time.time()
+        result = function(*args, **kwargs)
+        best_time = min(best_time, time.time() - start_time)
+
+    return best_time, result
+
+
+def print_comparison(name, previous_time, current_time):
+    print("{:<40} previous {:8.3f} s, current {:8.3f} s, speedup {:6.1f}x".format(
+        name, previous_time, current_time, previous_time / (current_time + 1e-9)))
+
+
+# -------------------------------------------
+# CSV loader
+# -------------------------------------------
+
+def _load_csv_rows(file_path):
+    # Previous parser: one tuple per line through row_split, then zip into lists
+
+    matrix_tuples = []
+
+    with open(file_path, 'r') as file:
+        next(file)  # skip header row
+        for line in file:
+            if len(line.strip()) != 0:
+                matrix_tuples.append(data_manager.row_split(line))
+
+    row_list, col_list, data_list = zip(*matrix_tuples)
+
+    return list(row_list), list(col_list), list(data_list)
+
+
+def _build_matrix_from_rows(file_path):
+    row_list, col_list, data_list = _load_csv_rows(file_path)
+    return data_manager.csr_sparse_matrix(data_list, row_list, col_list)
+
+
+def _build_matrix_from_columns(file_path):
+    row_array, col_array, data_array = data_manager.load_csv_columns(file_path)
+    return data_manager.csr_sparse_matrix(data_array, row_array, col_array)
+
+
+def benchmark_csv_loader():
+
+    print("\n ... CSV loader: line by line tuples vs typed columns ... ")
+
+    for file_path in [data_manager.data_train,
+                      data_manager.data_ICM_sub_class,
+                      data_manager.data_ICM_price,
+                      data_manager.data_ICM_asset,
+                      data_manager.data_UCM_age,
+                      data_manager.data_UCM_region]:
+
+        previous_time, previous_matrix = time_function(_build_matrix_from_rows, file_path)
+        current_time, current_matrix = time_function(_build_matrix_from_columns, file_path)
+
+        assert previous_matrix.shape == current_matrix.shape and previous_matrix.nnz == current_matrix.nnz, \
+            "benchmark_csv_loader: loaders disagree on '{}'".format(file_path)
+
+        print_comparison(file_path.split("/")[-1], previous_time, current_time)
+
+
+# -------------------------------------------
+# Concurrent loading of URM, ICM and UCM
+# -------------------------------------------
+
+def _build_matrices_sequentially():
+    URM_all = data_manager.build_URM(use_cache=False)
+    return URM_all, data_manager.build_ICM(use_cache=False), data_manager.build_UCM(URM_all, use_cache=False)
+
+
+def benchmark_concurrent_loading():
+
+    print("\n ... URM, ICM and UCM from csv: sequential vs concurrent ... ")
+
+    previous_time, previous_matrices = time_function(_build_matrices_sequentially)
+    current_time, current_matrices = time_function(data_manager.load_URM_ICM_UCM, use_cache=False)
+
+    for previous_matrix, current_matrix in zip(previous_matrices, current_matrices):
+        assert previous_matrix.shape == current_matrix.shape and (previous_matrix != current_matrix).nnz == 0, \
+            "benchmark_concurrent_loading: loaders disagree"
+
+    print_comparison("cold start, no cache", previous_time, current_time)
+
+
+# -------------------------------------------
+# Leave-k-out splitter
+# -------------------------------------------
+
+def _split_leave_k_out_user_loop(URM, k_out = 1, use_validation_set = True, leave_random_out = True):
+    # Previous splitter, verbatim but for np.int, removed from numpy, replaced by int
+
+    assert k_out > 0, "k_out must be a value greater than 0, provided was '{}'".format(k_out)
+
+    URM = sps.csr_matrix(URM)
+    n_users, n_items = URM.shape
+
+
+    URM_train_builder = IncrementalSparseMatrix(auto_create_row_mapper=False, n_rows = n_users,
+                                        auto_create_col_mapper=False, n_cols = n_items)
+
+    URM_test_builder = IncrementalSparseMatrix(auto_create_row_mapper=False, n_rows = n_users,
+                                        auto_create_col_mapper=False, n_cols = n_items)
+
+    if use_validation_set:
+         URM_validation_builder = IncrementalSparseMatrix(auto_create_row_mapper=False, n_rows = n_users,
+                                                          auto_create_col_mapper=False, n_cols = n_items)
+
+
+
+    for user_id in range(n_users):
+
+        start_user_position = URM.indptr[user_id]
+        end_user_position = URM.indptr[user_id+1]
+
+        user_profile = URM.indices[start_user_position:end_user_position]
+
+
+        if leave_random_out:
+            indices_to_suffle = np.arange(len(user_profile), dtype=int)
+
+            np.random.shuffle(indices_to_suffle)
+
+            user_interaction_items = user_profile[indices_to_suffle]
+            user_interaction_data = URM.data[start_user_position:end_user_position][indices_to_suffle]
+
+        else:
+
+            # The first will be sampled so the last interaction must be the first one
+            interaction_position = URM.data[start_user_position:end_user_position]
+
+            sort_interaction_index = np.argsort(-interaction_position)
+
+            user_interaction_items = user_profile[sort_interaction_index]
+            user_interaction_data = URM.data[start_user_position:end_user_position][sort_interaction_index]
+
+
+        #Test interactions
+        user_interaction_items_test = user_interaction_items[0:k_out]
+        user_interaction_data_test = user_interaction_data[0:k_out]
+
+        URM_test_builder.add_data_lists([user_id]*len(user_interaction_items_test), user_interaction_items_test, user_interaction_data_test)
+
+
+        #validation interactions
+        if use_validation_set:
+            user_interaction_items_validation = user_interaction_items[k_out:k_out*2]
+            user_interaction_data_validation = user_interaction_data[k_out:k_out*2]
+
+            URM_validation_builder.add_data_lists([user_id]*k_out, user_interaction_items_validation, user_interaction_data_validation)
+
+
+
+        #Train interactions
+        user_interaction_items_train = user_interaction_items[k_out*2:]
+        user_interaction_data_train = user_interaction_data[k_out*2:]
+
+        URM_train_builder.add_data_lists([user_id]*len(user_interaction_items_train), user_interaction_items_train, user_interaction_data_train)
+
+
+
+    URM_train = URM_train_builder.get_SparseMatrix()
+    URM_test = URM_test_builder.get_SparseMatrix()
+
+
+    URM_train = sps.csr_matrix(URM_train)
+    user_no_item_train = np.sum(np.ediff1d(URM_train.indptr) == 0)
+
+    if user_no_item_train != 0:
+        print("Warning: {} ({:.2f} %) of {} users have no Train items".format(user_no_item_train, user_no_item_train/n_users*100, n_users))
+
+
+
+    if use_validation_set:
+        URM_validation = URM_validation_builder.get_SparseMatrix()
+
+        URM_validation = sps.csr_matrix(URM_validation)
+        user_no_item_validation = np.sum(np.ediff1d(URM_validation.indptr) == 0)
+
+        if user_no_item_validation != 0:
+            print("Warning: {} ({:.2f} %) of {} users have no Validation items".format(user_no_item_validation, user_no_item_validation/n_users*100, n_users))
+
+
+        return URM_train, URM_validation, URM_test
+
+
+    return URM_train, URM_test
+
+
+def benchmark_leave_k_out_split(k_out=4):
+
+    print("\n ... Leave-{}-out split: user loop vs vectorized ... ".format(k_out))
+
+    URM_all = data_manager.build_URM()
+
+    # Distinct values, so that the deterministic split is unique and both splitters must agree
+    URM_all = URM_all.astype(np.float64)
+    URM_all.data = np.random.permutation(URM_all.nnz).astype(np.float64) + 1
+
+    previous_time, previous_split = time_function(_split_leave_k_out_user_loop, URM_all, k_out,
+                                                  use_validation_set=False, leave_random_out=False, n_repetitions=1)
+    current_time, current_split = time_function(split_train_leave_k_out_user_wise, URM_all, k_out=k_out,
+                                                use_validation_set=False, leave_random_out=False)
+
+    previous_train, previous_test = previous_split
+    current_train, current_test = current_split
+
+    assert (previous_test != current_test).nnz == 0, "benchmark_leave_k_out_split: test splits disagree"
+
+    # Documented change: the previous train started at rank 2*k_out, leaving the ranks from k_out to 2*k_out in no
+    # split. The current train starts at rank k_out, it adds to the previous train exactly those interactions
+    train_difference = sps.csr_matrix(current_train - previous_train)
+    train_difference.eliminate_zeros()
+
+    assert (previous_train + train_difference + previous_test != URM_all).nnz == 0 and train_difference.data.min() > 0, \
+        "benchmark_leave_k_out_split: train is not the previous train plus interactions left out of the previous split"
+
+    profile_length = np.ediff1d(sps.csr_matrix(URM_all).indptr)
+    assert np.array_equal(np.ediff1d(train_difference.indptr), np.clip(profile_length - k_out, 0, k_out)), \
+        "benchmark_leave_k_out_split: train does not add k_out interactions for each user"
+
+    def _row_min(URM):
+        # Minimum of the nonzero values of each row, all positive, 0 for an empty row
+        URM_inverse = sps.csr_matrix(URM, copy=True)
+        URM_inverse.data = 1 / URM_inverse.data
+        row_max_inverse = URM_inverse.max(axis=1).toarray().ravel()
+        return np.divide(1, row_max_inverse, out=np.zeros_like(row_max_inverse), where=row_max_inverse > 0)
+
+    def _row_max(URM):
+        return sps.csr_matrix(URM).max(axis=1).toarray().ravel()
+
+    # Values rank in decreasing order: test above the added interactions, which are above the previous train
+    has_difference = np.ediff1d(train_difference.indptr) > 0
+    has_previous_train = np.ediff1d(sps.csr_matrix(previous_train).indptr) > 0
+
+    assert np.all(_row_max(train_difference)[has_difference] < _row_min(previous_test)[has_difference]), \
+        "benchmark_leave_k_out_split: added train interactions rank before test"
+    assert np.all(_row_min(train_difference)[has_previous_train] > _row_max(previous_train)[has_previous_train]), \
+        "benchmark_leave_k_out_split: added train interactions rank after the previous train"
+
+    print("Previous split left {} interactions, ranks {} to {}, in no split, now in train".format(
+        train_difference.nnz, k_out, 2 * k_out))
+
+    print_comparison("{} interactions, by value".format(URM_all.nnz), previous_time, current_time)
+
+    previous_time, _ = time_function(_split_leave_k_out_user_loop, URM_all, k_out, use_validation_set=False,
+                                     n_repetitions=1)
+    current_time, _ = time_function(split_train_leave_k_out_user_wise, URM_all, k_out=k_out,
+                                    use_validation_set=False, random_seed=42)
+
+    print_comparison("{} interactions, random".format(URM_all.nnz), previous_time, current_time)
+
+
+# -------------------------------------------
+# Lazy k-fold split generator
+# -------------------------------------------
+
+def _get_csr_bytes(URM):
+    return URM.data.nbytes + URM.indices.nbytes + URM.indptr.nbytes
+
+
+def benchmark_k_fold_split(n_folds=5):
+
+    print("\n ... {} splits: materialized matrices vs lazy folds ... ".format(n_folds))
+
+    URM_all = sps.csr_matrix(data_manager.build_URM())
+
+    def _materialize_splits():
+        return [split_train_leave_k_out_user_wise(URM_all, k_out=1, use_validation_set=False)
+                for _ in range(n_folds)]
+
+    def _create_folds():
+        return list(split_k_fold_user_wise(URM_all, n_folds=n_folds))
+
+    previous_time, split_list = time_function(_materialize_splits, n_repetitions=1)
+    current_time, fold_list = time_function(_create_folds, n_repetitions=1)
+
+    print_comparison("create {} splits".format(n_folds), previous_time, current_time)
+
+    previous_bytes = sum(_get_csr_bytes(URM) for split in split_list for URM in split)
+    current_bytes = fold_list[0]._interaction_fold.nbytes
+
+    print("{:<40} previous {:8.1f} MB, current {:8.1f} MB".format("memory held by the splits",
+                                                                 previous_bytes / 2 ** 20, current_bytes / 2 ** 20))
+
+    fold_time, _ = time_function(fold_list[0].get_URM_train_test)
+    print("{:<40} {:8.3f} s".format("train and test of one fold", fold_time))
+
+
+# -------------------------------------------
+# Split integrity checks
+# -------------------------------------------
+
+def _assert_disjoint_by_sum(URM_list):
+    # Previous check: a copy of each URM with its data set to ones, summed into a global matrix
+
+    URM_implicit_global = None
+    cumulative_nnz = 0
+
+    for URM in URM_list:
+        cumulative_nnz += URM.nnz
+        URM_implicit = URM.copy()
+        URM_implicit.data = np.ones_like(URM_implicit.data)
+
+        URM_implicit_global = URM_implicit if URM_implicit_global is None else URM_implicit_global + URM_implicit
+
+    assert cumulative_nnz == URM_implicit_global.nnz
+
+    return True
+
+
+def _measure_peak_memory(function, *args, **kwargs):
+
+    tracemalloc.start()
+    function(*args, **kwargs)
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return peak_bytes
+
+
+def benchmark_split_integrity(k_out=4, scale_factor=10):
+
+    print("\n ... Split integrity: summed copies vs blocks of users ... ")
+
+    URM_all = sps.csr_matrix(data_manager.build_URM())
+
+    # The peak memory of the previous check grows with the data, the current one with the block size only
+    for current_scale, current_URM_all in [(1, URM_all), (scale_factor, sps.vstack([URM_all] * scale_factor, format="csr"))]:
+
+        URM_list = list(split_train_leave_k_out_user_wise(current_URM_all, k_out=k_out, random_seed=42))
+
+        previous_time, _ = time_function(_assert_disjoint_by_sum, URM_list)
+        current_time, _ = time_function(assert_disjoint_matrices, URM_list)
+        print_comparison("{}x data, disjointness".format(current_scale), previous_time, current_time)
+
+        previous_bytes = _measure_peak_memory(_assert_disjoint_by_sum, URM_list)
+        current_bytes = _measure_peak_memory(assert_disjoint_matrices, URM_list)
+        print("{:<40} previous {:8.1f} MB, current {:8.1f} MB".format("{}x data, peak extra memory".format(current_scale),
+                                                                     previous_bytes / 2 ** 20, current_bytes / 2 ** 20))
+
+        full_check_time, _ = time_function(assert_split_integrity, URM_list, URM_all=current_URM_all, k_out=k_out)
+        print("{:<40} {:8.3f} s".format("{}x data, disjoint, coverage, k_out".format(current_scale), full_check_time))
+
+
+# -------------------------------------------
+# Incremental sparse matrix builder
+# -------------------------------------------
+
+class _ElementWiseIncrementalSparseMatrix(IncrementalSparseMatrix):
+    # Previous builder: one element at a time, dictionary ID mappers, capacity grown by fixed blocks with np.concatenate
+
+    def __init__(self, **builder_args):
+        super(_ElementWiseIncrementalSparseMatrix, self).__init__(**builder_args)
+
+        self._column_original_ID_to_index = {}
+        self._row_original_ID_to_index = {}
+
+    _get_column_index = IncrementalSparseMatrix_ListBased._get_column_index
+    _get_row_index = IncrementalSparseMatrix_ListBased._get_row_index
+
+    def add_data_lists(self, row_list_to_add, col_list_to_add, data_list_to_add):
+
+        for data_point_index in range(len(row_list_to_add)):
+
+            if self._next_cell_pointer == len(self._row_array):
+                self._row_array = np.concatenate((self._row_array, np.zeros(10000000, dtype=self._dtype_coordinates)))
+                self._col_array = np.concatenate((self._col_array, np.zeros(10000000, dtype=self._dtype_coordinates)))
+                self._data_array = np.concatenate((self._data_array, np.zeros(10000000, dtype=self._dtype_data)))
+
+            self._row_array[self._next_cell_pointer] = self._get_row_index(row_list_to_add[data_point_index])
+            self._col_array[self._next_cell_pointer] = self._get_column_index(col_list_to_add[data_point_index])
+            self._data_array[self._next_cell_pointer] = data_list_to_add[data_point_index]
+
+            self._next_cell_pointer += 1
+
+        self._rows_sorted = False
+
+    def add_single_row(self, row_index, col_list, data=1.0):
+        self.add_data_lists([row_index] * len(col_list), col_list, [data] * len(col_list))
+
+
+def _build_by_rows(builder_class, URM, **builder_args):
+
+    builder = builder_class(**builder_args)
+
+    for user_id in range(URM.shape[0]):
+        builder.add_single_row(user_id, URM.indices[URM.indptr[user_id]:URM.indptr[user_id + 1]], data=1.0)
+
+    return builder.get_SparseMatrix()
+
+
+def _build_by_chunks(builder_class, URM, chunk_size=100000, **builder_args):
+
+    builder = builder_class(**builder_args)
+    URM = URM.tocoo()
+
+    for start_position in range(0, URM.nnz, chunk_size):
+        end_position = start_position + chunk_size
+        builder.add_data_lists(URM.row[start_position:end_position], URM.col[start_position:end_position],
+                               URM.data[start_position:end_position])
+
+    return builder.get_SparseMatrix()
+
+
+def benchmark_incremental_sparse_matrix():
+
+    print("\n ... IncrementalSparseMatrix: element by element vs array slices ... ")
+
+    URM_all = sps.csr_matrix(data_manager.build_URM())
+    n_users, n_items = URM_all.shape
+
+    for mapper_name, builder_args in [("indices", {"n_rows": n_users, "n_cols": n_items}),
+                                      ("ID mappers", {"auto_create_row_mapper": True, "auto_create_col_mapper": True})]:
+
+        for build_name, build_function in [("by rows", _build_by_rows), ("by 100k chunks", _build_by_chunks)]:
+
+            previous_time, previous_URM = time_function(build_function, _ElementWiseIncrementalSparseMatrix, URM_all,
+                                                        n_repetitions=1, **builder_args)
+            current_time, current_URM = time_function(build_function, IncrementalSparseMatrix, URM_all, **builder_args)
+
+            assert previous_URM.shape == current_URM.shape and (previous_URM != current_URM).nnz == 0, \
+                "benchmark_incremental_sparse_matrix: builders disagree"
+
+            print_comparison("{}, {}".format(build_name, mapper_name), previous_time, current_time)
+
+
+# -------------------------------------------
+# Streaming URM builder
+# -------------------------------------------
+
+def _run_in_subprocess(statement):
+    # Each builder runs in a fresh interpreter, so that the peak RSS is not shared among them
+
+    script = "import time\n" \
+             "from utils import data_manager\n" \
+             "start_time = time.time()\n" \
+             "{}\n" \
+             "print(time.time() - start_time, data_manager.get_peak_RSS_MB())".format(statement)
+
+    output = subprocess.run([sys.executable, "-c", script], stdout=subprocess.PIPE, check=True,
+                            universal_newlines=True).stdout
+
+    elapsed_time, peak_RSS_MB = output.strip().split("\n")[-1].split(" ")
+
+    return float(elapsed_time), float(peak_RSS_MB)
+
+
+def benchmark_URM_streaming():
+
+    print("\n ... URM builder: whole file vs two-pass streaming ... ")
+
+    baseline_time, baseline_RSS = _run_in_subprocess("pass")
+    print("{:<40} {:8.3f} s, peak RSS {:8.1f} MB".format("interpreter and imports", baseline_time, baseline_RSS))
+
+    for builder_name, statement in [("whole file", "data_manager.build_URM(use_cache=False, streaming=False)"),
+                                    ("streaming", "data_manager.build_URM_streaming(chunk_size=100000)"),
+                                    ("streaming, memory-mapped", "data_manager.build_URM_streaming("
+                                                                 "chunk_size=100000, mmap_folder='.temp_URM_mmap/')")]:
+
+        elapsed_time, peak_RSS = _run_in_subprocess(statement)
+        print("{:<40} {:8.3f} s, peak RSS {:8.1f} MB".format(builder_name, elapsed_time, peak_RSS))
+
+    shutil.rmtree(".temp_URM_mmap/", ignore_errors=True)
+
+
+# -------------------------------------------
+# Submission writer
+# -------------------------------------------
+
+def _create_csv_row_by_row(csv_file, user_id_array, item_list):
+    # Previous writer: one str(np.array) and two replace for each user
+
+    items_by_user = list(zip(user_id_array, item_list))
+
+    with open(csv_file, 'w', newline='') as file:
+        file.write('user_id,item_list' + '\n')
+
+        for item_list in items_by_user:
+            row = str(item_list[0]) + ',' + str(np.array(item_list[1])) + '\n'
+            file.write(row.replace('[', '').replace(']', ''))
+
+
+def benchmark_submission_writer(scale_factor=10, cutoff=10, batch_size=1000):
+
+    print("\n ... Submission writer: {}x target users ... ".format(scale_factor))
+
+    n_target_users = len(data_manager.get_target_users()) * scale_factor
+    n_items = 18495
+
+    user_id_array = np.arange(n_target_users)
+    recommendation_array = np.random.randint(0, n_items, size=(n_target_users, cutoff)).astype(np.int32)
+    recommendation_list = recommendation_array.tolist()
+
+    temp_folder = ".temp_submission_benchmark/"
+    os.makedirs(temp_folder, exist_ok=True)
+
+    previous_time, _ = time_function(_create_csv_row_by_row, temp_folder + "previous.csv",
+                                     user_id_array, recommendation_list, n_repetitions=1)
+
+    def _write_in_blocks():
+        with SubmissionWriter(temp_folder + "current.csv") as writer:
+            for start_position in range(0, n_target_users, batch_size):
+                writer.write_block(user_id_array[start_position:start_position + batch_size],
+                                   recommendation_array[start_position:start_position + batch_size])
+
+    current_time, _ = time_function(_write_in_blocks, n_repetitions=1)
+
+    print_comparison("{} users, row by row vs blocks".format(n_target_users), previous_time, current_time)
+    print("{:<40} {:.0f} users/sec".format("current throughput", n_target_users / current_time))
+
+    # The previous writer pads the numbers with spaces when their width differs, compare the parsed values
+    with open(temp_folder + "previous.csv") as previous_file, open(temp_folder + "current.csv") as current_file:
+        for previous_line, current_line in zip(previous_file, current_file):
+            assert previous_line.split() == current_line.split() or \
+                   previous_line.replace(",", " ").split() == current_line.replace(",", " ").split(), \
+                "benchmark_submission_writer: writers disagree on '{}'".format(current_line)
+
+    shutil.rmtree(temp_folder, ignore_errors=True)
+
+
+# -------------------------------------------
+# Similarity TopK selection
+# -------------------------------------------
+
+def _compute_column_range_column_by_column(similarity, start_col, end_col, block_size=100):
+
+    values = []
+    rows = []
+    cols = []
+
+    for start_col_block in range(start_col, end_col, block_size):
+        end_col_block = min(start_col_block + block_size, end_col)
+
+        # One column of the block at a time, as the columns of the dense product
+        this_block_weights = similarity._compute_block_similarity(start_col_block, end_col_block).T
+
+        for col_index_in_block in range(end_col_block - start_col_block):
+            this_column_weights = this_block_weights[:, col_index_in_block]
+
+            relevant_items_partition = (-this_column_weights).argpartition(similarity.TopK - 1)[0:similarity.TopK]
+            relevant_items_partition_sorting = np.argsort(-this_column_weights[relevant_items_partition])
+            top_k_idx = relevant_items_partition[relevant_items_partition_sorting]
+
+            notZerosMask = this_column_weights[top_k_idx] != 0.0
+            numNotZeros = np.sum(notZerosMask)
+
+            values.extend(this_column_weights[top_k_idx][notZerosMask])
+            rows.extend(top_k_idx[notZerosMask])
+            cols.extend(np.ones(numNotZeros) * (col_index_in_block + start_col_block))
+
+    return sps.csr_matrix((values, (rows, cols)), shape=(similarity.n_columns, similarity.n_columns), dtype=np.float32)
+
+
+def benchmark_similarity(n_columns=5000, topK=100):
+
+    print("\n ... item-item cosine similarity of {} columns: column by column vs block TopK ... ".format(n_columns))
+
+    URM_all = sps.csr_matrix(data_manager.build_URM(), dtype=np.float32)
+
+    similarity = Compute_Similarity_Python(URM_all, topK=topK, shrink=10)
+    similarity._prepare_data()
+
+    # The same dense blocks of 100 columns for both
+    block_list = [(start_col, min(start_col + 100, n_columns)) for start_col in range(0, n_columns, 100)]
+
+    def _compute_block_top_k():
+        return similarity._compute_column_range(block_list, False, verbose=False)
+
+    previous_time, W_previous = time_function(_compute_column_range_column_by_column, similarity, 0, n_columns,
+                                              n_repetitions=1)
+    current_time, (values, rows, column_nnz) = time_function(_compute_block_top_k, n_repetitions=1)
+
+    print_comparison("TopK of {} columns".format(n_columns), previous_time, current_time)
+    print("{:<40} previous {:8.1f}, current {:8.1f}".format("column/sec", n_columns / previous_time,
+                                                          n_columns / current_time))
+
+    indptr = np.zeros(similarity.n_columns + 1, dtype=np.int32)
+    indptr[1:n_columns + 1] = np.cumsum(column_nnz)
+    indptr[n_columns + 1:] = indptr[n_columns]
+
+    W_current = sps.csc_matrix((values, rows, indptr), shape=W_previous.shape)
+
+    assert abs(W_previous - W_current).max() < 1e-6, "benchmark_similarity: the similarities differ"
+
+
+def benchmark_similarity_parallel(n_workers=None, topK=100):
+
+    n_workers = n_workers if n_workers is not None else max(2, os.cpu_count())
+
+    print("\n ... item-item cosine similarity: 1 process vs {} processes on {} cores ... ".format(n_workers,
+                                                                                              os.cpu_count()))
+
+    URM_all = sps.csr_matrix(data_manager.build_URM(), dtype=np.float32)
+
+    def _compute_similarity(n_workers):
+        return Compute_Similarity_Python(URM_all, topK=topK, shrink=10, n_workers=n_workers).compute_similarity()
+
+    previous_time, W_previous = time_function(_compute_similarity, 1, n_repetitions=1)
+    current_time, W_current = time_function(_compute_similarity, n_workers, n_repetitions=1)
+
+    print_comparison("similarity with {} workers".format(n_workers), previous_time, current_time)
+
+    assert (W_previous != W_current).nnz == 0, "benchmark_similarity_parallel: the similarities differ"
+
+
+def benchmark_similarity_blocks(memory_budget_bytes=2 ** 28, topK=100):
+
+    print("\n ... similarity with dense blocks of 100 columns vs blocks planned on a {:.0f} MB budget ... ".format(
+        memory_budget_bytes / 2 ** 20))
+
+    URM_all = sps.csr_matrix(data_manager.build_URM(), dtype=np.float32)
+    ICM_all = sps.csr_matrix(data_manager.build_ICM(), dtype=np.float32)
+    UCM_all = sps.csr_matrix(data_manager.build_UCM(URM_all), dtype=np.float32)
+
+    data_matrix_dict = {"ItemKNNCF": URM_all, "UserKNNCF": URM_all.T, "ItemKNNCBF": ICM_all.T, "UserKNNCBF": UCM_all.T}
+
+    def _compute_similarity(data_matrix, block_size, sparse_density_threshold):
+        similarity = Compute_Similarity_Python(data_matrix, topK=topK, shrink=10, memory_budget_bytes=memory_budget_bytes,
+                                               sparse_density_threshold=sparse_density_threshold)
+        return similarity.compute_similarity(block_size=block_size)
+
+    for recommender_name, data_matrix in data_matrix_dict.items():
+
+        # A threshold below zero never chooses the sparse product
+        previous_time, W_previous = time_function(_compute_similarity, data_matrix, 100, -1.0, n_repetitions=1)
+        current_time, W_current = time_function(_compute_similarity, data_matrix, None, 0.05, n_repetitions=1)
+
+        previous_bytes = _measure_peak_memory(_compute_similarity, data_matrix, 100, -1.0)
+        current_bytes = _measure_peak_memory(_compute_similarity, data_matrix, None, 0.05)
+
+        print_comparison(recommender_name, previous_time, current_time)
+        print("{:<40} previous {:8.1f} MB, current {:8.1f} MB".format("peak memory", previous_bytes / 2 ** 20,
+                                                                     current_bytes / 2 ** 20))
+
+        # Ties in the TopK may be broken differently, the total similarity of each column must be the same
+        assert W_previous.nnz == W_current.nnz and \
+               np.allclose(W_previous.sum(axis=0), W_current.sum(axis=0), atol=1e-4), \
+            "benchmark_similarity_blocks: the similarities differ"
+
+
+def benchmark_similarity_cache(K_max=1000, n_items=5000):
+
+    hyperparameters_list = [(50, 0), (100, 10), (200, 100), (500, 50), (800, 500)]
+
+    print("\n ... user-user cosine similarity on {} items, {} topK/shrink trials: "
+          "computed each time vs derived from a cached base ... ".format(n_items, len(hyperparameters_list)))
+
+    URM_all = sps.csr_matrix(data_manager.build_URM(), dtype=np.float32)
+    data_matrix = URM_all[:, :n_items].T
+
+    similarity_cache = SimilarityCache("result_experiments/benchmark_similarity_cache/", K_max=K_max, verbose=False)
+
+    previous_time = 0.0
+    current_time = 0.0
+
+    for topK, shrink in hyperparameters_list:
+
+        trial_previous_time, W_previous = time_function(
+            lambda: Compute_Similarity_Python(data_matrix, topK=topK, shrink=shrink).compute_similarity(), n_repetitions=1)
+
+        trial_current_time, W_current = time_function(
+            similarity_cache.compute_similarity, data_matrix, topK=topK, shrink=shrink, n_repetitions=1)
+
+        # Among equal similarities the two may keep different users, so the columns are compared on their sum
+        columns_matching = np.isclose(np.asarray(W_previous.sum(axis=0)).ravel(),
+                                      np.asarray(W_current.sum(axis=0)).ravel(), rtol=1e-4, atol=1e-4).mean()
+
+        print("{:<40} previous {:8.3f} s, current {:8.3f} s, columns matching {:.4f}".format(
+            "topK {}, shrink {}".format(topK, shrink), trial_previous_time, trial_current_time, columns_matching))
+
+        previous_time += trial_previous_time
+        current_time += trial_current_time
+
+    print_comparison("all the trials", previous_time, current_time)
+
+    shutil.rmtree("result_experiments/benchmark_similarity_cache/", ignore_errors=True)
+
+
+def benchmark_similarity_symmetric(topK=100):
+
+    print("\n ... cosine similarity computing all the products vs only the upper triangular ones ... ")
+
+    URM_all = sps.csr_matrix(data_manager.build_URM(), dtype=np.float32)
+    ICM_all = sps.csr_matrix(data_manager.build_ICM(), dtype=np.float32)
+    UCM_all = sps.csr_matrix(data_manager.build_UCM(URM_all), dtype=np.float32)
+
+    data_matrix_dict = {"ItemKNNCF": URM_all, "UserKNNCF": URM_all.T, "ItemKNNCBF": ICM_all.T, "UserKNNCBF": UCM_all.T}
+
+    def _compute_similarity(data_matrix, use_symmetry):
+        similarity = Compute_Similarity_Python(data_matrix, topK=topK, shrink=10, use_symmetry=use_symmetry)
+        return similarity.compute_similarity()
+
+    for recommender_name, data_matrix in data_matrix_dict.items():
+
+        previous_time, W_previous = time_function(_compute_similarity, data_matrix, False, n_repetitions=1)
+        current_time, W_current = time_function(_compute_similarity, data_matrix, True, n_repetitions=1)
+
+        print_comparison(recommender_name, previous_time, current_time)
+
+        # Ties in the TopK may be broken differently, the total similarity of each column must be the same
+        assert W_previous.nnz == W_current.nnz and \
+               np.allclose(W_previous.sum(axis=0), W_current.sum(axis=0), atol=1e-4), \
+            "benchmark_similarity_symmetric: the similarities differ"
+
+
+def benchmark_similarity_cooccurrence(topK=100, similarity="jaccard"):
+
+    print("\n ... {} similarity on float ones vs on integer co-occurrence counts ... ".format(similarity))
+
+    URM_all = sps.csr_matrix(data_manager.build_URM(), dtype=np.float32)
+    ICM_all = sps.csr_matrix(data_manager.build_ICM(), dtype=np.float32)
+    UCM_all = sps.csr_matrix(data_manager.build_UCM(URM_all), dtype=np.float32)
+
+    data_matrix_dict = {"ItemKNNCF": URM_all, "UserKNNCF": URM_all.T, "ItemKNNCBF": ICM_all.T, "UserKNNCBF": UCM_all.T}
+
+    def _compute_similarity(data_matrix, use_cooccurrence_counts):
+        similarity_object = Compute_Similarity_Python(data_matrix, topK=topK, shrink=10, similarity=similarity)
+        similarity_object.use_cooccurrence_counts = use_cooccurrence_counts
+        return similarity_object.compute_similarity()
+
+    for recommender_name, data_matrix in data_matrix_dict.items():
+
+        previous_time, W_previous = time_function(_compute_similarity, data_matrix, False, n_repetitions=1)
+        current_time, W_current = time_function(_compute_similarity, data_matrix, True, n_repetitions=1)
+
+        previous_bytes = _measure_peak_memory(_compute_similarity, data_matrix, False)
+        current_bytes = _measure_peak_memory(_compute_similarity, data_matrix, True)
+
+        print_comparison(recommender_name, previous_time, current_time)
+        print("{:<40} previous {:8.1f} MB, current {:8.1f} MB".format("peak memory", previous_bytes / 2 ** 20,
+                                                                     current_bytes / 2 ** 20))
+
+        # Ties in the TopK may be broken differently, the total similarity of each column must be the same
+        assert W_previous.nnz == W_current.nnz and \
+               np.allclose(W_previous.sum(axis=0), W_current.sum(axis=0), atol=1e-4), \
+            "benchmark_similarity_cooccurrence: the similarities differ"
+
+
+def _similarity_matrix_top_k_column_by_column(item_weights, k=100):
+
+    nitems = item_weights.shape[1]
+    item_weights = sps.csc_matrix(item_weights, dtype=np.float32)
+
+    data, rows_indices, cols_indptr = [], [], []
+
+    for item_idx in range(nitems):
+        cols_indptr.append(len(data))
+
+        column_data = item_weights.data[item_weights.indptr[item_idx]:item_weights.indptr[item_idx + 1]]
+        column_row_index = item_weights.indices[item_weights.indptr[item_idx]:item_weights.indptr[item_idx + 1]]
+
+        non_zero_data = column_data != 0
+
+        top_k_idx = np.argsort(column_data[non_zero_data])[-k:]
+
+        data.extend(column_data[non_zero_data][top_k_idx])
+        rows_indices.extend(column_row_index[non_zero_data][top_k_idx])
+
+    cols_indptr.append(len(data))
+
+    W_sparse = sps.csc_matrix((data, rows_indices, cols_indptr), shape=(nitems, nitems), dtype=np.float32)
+
+    return W_sparse.tocsr()
+
+
+def _similarity_matrix_top_k_argsort(item_weights, k=100):
+
+    nitems = item_weights.shape[1]
+
+    W = item_weights.copy()
+    W[np.argsort(W, axis=0)[:-k, :], np.arange(nitems)] = 0.0
+
+    return sps.csr_matrix(W, shape=(nitems, nitems))
+
+
+def benchmark_similarity_matrix_top_k(k=100, n_dense_items=5000):
+
+    print("\n ... similarityMatrixTopK of the item-item co-occurrences, previous loop and sort vs segment-wise TopK ... ")
+
+    URM_all = sps.csr_matrix(data_manager.build_URM(), dtype=np.float32)
+
+    # A similarity as dense as the one of RP3beta and P3alpha before the TopK
+    W_sparse = sps.csr_matrix(URM_all.T.dot(URM_all), dtype=np.float32)
+    W_sparse = W_sparse - sps.diags(W_sparse.diagonal())
+    W_sparse.eliminate_zeros()
+
+    W_dense = W_sparse[:n_dense_items, :n_dense_items].toarray()
+
+    for name, W, previous_function in [("sparse {}x{}, {} nonzeros".format(*W_sparse.shape, W_sparse.nnz), W_sparse,
+                                        _similarity_matrix_top_k_column_by_column),
+                                       ("dense {}x{}".format(*W_dense.shape), W_dense, _similarity_matrix_top_k_argsort)]:
+
+        previous_time, W_previous = time_function(previous_function, W, k=k, n_repetitions=1)
+        current_time, W_current = time_function(similarityMatrixTopK, W, k=k, inplace=False, n_repetitions=1)
+
+        print_comparison(name, previous_time, current_time)
+
+        # Ties in the TopK may be broken differently, the total similarity of each column must be the same
+        assert W_previous.nnz == W_current.nnz and \
+               np.allclose(W_previous.sum(axis=0), W_current.sum(axis=0)), \
+            "benchmark_similarity_matrix_top_k: the TopK differ"
+
+
+def _euclidean_similarity_column_by_column(data_matrix, end_col, topK=100, block_size=100):
+
+    data_matrix = sps.csc_matrix(data_matrix, dtype=np.float32)
+    n_columns = data_matrix.shape[1]
+
+    item_distance_initial = np.array(data_matrix.power(2).sum(axis=0)).ravel()
+
+    values = []
+    rows = []
+    cols = []
+
+    for start_col_block in range(0, end_col, block_size):
+        end_col_block = min(start_col_block + block_size, end_col)
+
+        this_block_weights = data_matrix.T.dot(data_matrix[:, start_col_block:end_col_block].toarray())
+
+        for col_index_in_block in range(end_col_block - start_col_block):
+            columnIndex = col_index_in_block + start_col_block
+
+            # (a-b)^2 = a^2 + b^2 - 2ab
+            item_distance = item_distance_initial + item_distance_initial[columnIndex]
+            item_distance -= 2 * this_block_weights[:, col_index_in_block]
+
+            item_similarity = 1 / (1 + np.sqrt(np.maximum(item_distance, 0.0)))
+            item_similarity[columnIndex] = 0.0
+
+            top_k_idx = (-item_similarity).argpartition(topK - 1)[0:topK]
+
+            notZerosMask = item_similarity[top_k_idx] != 0.0
+
+            values.extend(item_similarity[top_k_idx][notZerosMask])
+            rows.extend(top_k_idx[notZerosMask])
+            cols.extend(np.ones(np.sum(notZerosMask)) * columnIndex)
+
+    return sps.csr_matrix((values, (rows, cols)), shape=(n_columns, n_columns), dtype=np.float32)
+
+
+def benchmark_similarity_euclidean(n_columns=5000, topK=100):
+
+    print("\n ... item-item euclidean similarity of {} columns on the URM: column by column vs blocks ... ".format(n_columns))
+
+    URM_all = sps.csr_matrix(data_manager.build_URM(), dtype=np.float32)
+
+    def _compute_similarity():
+        similarity = Compute_Similarity_Euclidean(URM_all, topK=topK, similarity_from_distance_mode="lin")
+        return similarity.compute_similarity(end_col=n_columns)
+
+    previous_time, W_previous = time_function(_euclidean_similarity_column_by_column, URM_all, n_columns, topK=topK,
+                                              n_repetitions=1)
+    current_time, W_current = time_function(_compute_similarity, n_repetitions=1)
+
+    print_comparison("TopK of {} columns".format(n_columns), previous_time, current_time)
+
+    # Ties in the TopK may be broken differently, the total similarity of each column must be the same
+    assert W_previous.nnz == W_current.nnz and \
+           np.allclose(W_previous.sum(axis=0), W_current.sum(axis=0), rtol=1e-4), \
+        "benchmark_similarity_euclidean: the similarities differ"
+
+
+def _get_top_k_recall(W_exact, W_approximate):
+    """
+    Fraction of the nonzero similarities of W_exact that are also in W_approximate
+    """
+
+    W_exact = sps.csr_matrix(W_exact)
+    W_approximate = sps.csr_matrix(W_approximate)
+
+    W_approximate_pattern = W_approximate.copy()
+    W_approximate_pattern.data[:] = 1.0
+
+    return W_exact.multiply(W_approximate_pattern).nnz / max(1, W_exact.nnz)
+
+
+def benchmark_similarity_approximate(topK=100, shrink=10):
+
+    print("\n ... item-item and user-user similarity of the whole URM: exact vs locality sensitive hashing candidates ... ")
+
+    URM_all = sps.csr_matrix(data_manager.build_URM(), dtype=np.float32)
+
+    URM_train, URM_test = split_train_leave_k_out_user_wise(URM_all, k_out=1, use_validation_set=False, random_seed=42)
+    evaluator_test = EvaluatorHoldout(URM_test, cutoff_list=[10], verbose=False)
+
+    # Exact, then (hash function, number of bands, band size) of the approximate index
+    configuration_list = [None, ("minhash", 32, 4), ("minhash", 64, 4), ("projection", 32, 12)]
+
+    for recommender_class in [ItemKNNCFRecommender, UserKNNCFRecommender]:
+
+        W_exact = None
+        exact_time = None
+
+        for configuration in configuration_list:
+
+            if configuration is None:
+                configuration_name = "exact"
+                similarity_args = {}
+            else:
+                configuration_name = "{} {}x{}".format(*configuration)
+                similarity_args = {"use_implementation": "approximate", "hash_function": configuration[0],
+                                   "n_bands": configuration[1], "band_size": configuration[2], "random_seed": 42}
+
+            recommender = recommender_class(URM_train, verbose=False)
+
+            fit_time, _ = time_function(recommender.fit, topK=topK, shrink=shrink, similarity="cosine",
+                                        n_repetitions=1, **similarity_args)
+
+            if W_exact is None:
+                W_exact = recommender.W_sparse
+                exact_time = fit_time
+
+            results_dict, _ = evaluator_test.evaluateRecommender(recommender)
+
+            print("{:<25} {:<20} fit {:8.3f} s, speedup {:6.2f}x, recall of the exact TopK {:.3f}, MAP@10 {:.5f}".format(
+                recommender_class.RECOMMENDER_NAME, configuration_name, fit_time, exact_time / (fit_time + 1e-9),
+                _get_top_k_recall(W_exact, recommender.W_sparse), results_dict[10]["MAP"]))
+
+
+def benchmark_incremental_similarity(batch_size_list=(10, 100, 1000), topK=100, shrink=10, similarity="cosine"):
+
+    print("\n ... item-item similarity after adding a batch of interactions: fit on the whole URM vs add_interactions ... ")
+
+    URM_all = sps.coo_matrix(data_manager.build_URM(), dtype=np.float32)
+
+    for batch_size in batch_size_list:
+
+        # The batch is a random sample of the interactions, the model is fitted on the others
+        is_in_batch = np.zeros(URM_all.nnz, dtype=np.bool_)
+        is_in_batch[np.random.RandomState(42).choice(URM_all.nnz, batch_size, replace=False)] = True
+
+        URM_previous = sps.csr_matrix((URM_all.data[~is_in_batch], (URM_all.row[~is_in_batch], URM_all.col[~is_in_batch])),
+                                      shape=URM_all.shape)
+
+        recommender_full = ItemKNNCFRecommender(URM_all.tocsr(), verbose=False)
+        previous_time, _ = time_function(recommender_full.fit, topK=topK, shrink=shrink, similarity=similarity,
+                                         n_repetitions=1)
+
+        recommender_incremental = ItemKNNCFRecommender(URM_previous, verbose=False)
+        recommender_incremental.fit(topK=topK, shrink=shrink, similarity=similarity)
+
+        current_time, _ = time_function(recommender_incremental.add_interactions, URM_all.row[is_in_batch],
+                                        URM_all.col[is_in_batch], URM_all.data[is_in_batch], n_repetitions=1)
+
+        print_comparison("Batch of {} interactions".format(batch_size), previous_time, current_time)
+
+        W_previous = recommender_full.W_sparse
+        W_current = recommender_incremental.W_sparse
+
+        # Ties in the TopK may be broken differently, the total similarity of each column must be the same
+        assert W_previous.nnz == W_current.nnz and \
+               np.allclose(W_previous.sum(axis=0), W_current.sum(axis=0), rtol=1e-4), \
+            "benchmark_incremental_similarity: the similarities differ"
+
+
+def _check_add_interactions(URM_train, row_weights, n_batches, batch_size, random_state, implicit, **fit_args):
+    """
+    Adds n_batches random batches to a fitted ItemKNNCFRecommender, forcing the incremental path, and fits a second
+    recommender on the final URM. Each batch has interactions of new users and items and the last one removes an
+    existing interaction. Without row weights the batches may add new users, the row weights have a fixed length
+    :return:    W_sparse of add_interactions and of fit
+    """
+
+    similarity_args = {} if row_weights is None else {"row_weights": row_weights}
+
+    recommender_incremental = ItemKNNCFRecommender(URM_train.copy(), verbose=False)
+    recommender_incremental.fit(**fit_args, **similarity_args)
+
+    URM_all = URM_train.copy()
+
+    for batch_index in range(n_batches):
+
+        n_users, n_items = recommender_incremental.URM_train.shape
+
+        user_id_array = random_state.randint(0, n_users + (0 if row_weights is not None else 3), batch_size)
+        item_id_array = random_state.randint(0, n_items + 2, batch_size)
+        data_array = np.ones(batch_size) if implicit else random_state.rand(batch_size) + 0.5
+
+        if batch_index == n_batches - 1:
+            URM_all_coo = URM_all.tocoo()
+            removed_index = random_state.randint(URM_all_coo.nnz)
+
+            user_id_array = np.append(user_id_array, URM_all_coo.row[removed_index])
+            item_id_array = np.append(item_id_array, URM_all_coo.col[removed_index])
+            data_array = np.append(data_array, -URM_all_coo.data[removed_index])
+
+        data_array = data_array.astype(np.float32)
+
+        recommender_incremental.add_interactions(user_id_array, item_id_array, data_array, max_recomputed_fraction=1.0)
+
+        URM_all.resize(recommender_incremental.URM_train.shape)
+        URM_all = sps.csr_matrix(URM_all + sps.csr_matrix((data_array, (user_id_array, item_id_array)),
+                                                          shape=URM_all.shape))
+        URM_all.eliminate_zeros()
+
+    recommender_full = ItemKNNCFRecommender(URM_all, verbose=False)
+    recommender_full.fit(**fit_args, **similarity_args)
+
+    return recommender_incremental.W_sparse, recommender_full.W_sparse
+
+
+def benchmark_incremental_similarity_equivalence(n_seeds=6, n_batches=3, batch_size=15, shrink=2):
+
+    print("\n ... add_interactions vs fit on the final URM, random data, every similarity ... ")
+
+    similarity_list = ["cosine", "adjusted", "pearson", "asymmetric", "jaccard", "tanimoto", "dice", "tversky",
+                       "euclidean", "cosine with row weights"]
+
+    n_checked = 0
+    start_time = time.time()
+
+    for random_seed in range(n_seeds):
+
+        random_state = np.random.RandomState(random_seed)
+
+        # Implicit and explicit data alternate, the explicit values also change the norms of the existing items
+        implicit = random_seed % 2 == 0
+
+        URM_train = sps.random(120, 70, density=0.06, random_state=random_state, format="csr", dtype=np.float32)
+        URM_train.data[:] = 1.0 if implicit else random_state.rand(URM_train.nnz) + 0.5
+
+        for similarity in similarity_list:
+
+            row_weights = None
+
+            if similarity == "cosine with row weights":
+                similarity = "cosine"
+                row_weights = random_state.rand(URM_train.shape[0]).astype(np.float32)
+
+            # TopK below and above the number of items
+            for topK in [5, 100]:
+
+                with contextlib.redirect_stdout(io.StringIO()):
+                    W_incremental, W_full = _check_add_interactions(URM_train, row_weights, n_batches, batch_size,
+                                                                    random_state, implicit, topK=topK, shrink=shrink,
+                                                                    similarity=similarity)
+
+                # Ties in the TopK may be broken differently, the total similarity of each column must be the same
+                assert W_incremental.shape == W_full.shape and W_incremental.nnz == W_full.nnz and \
+                       np.allclose(W_incremental.sum(axis=0), W_full.sum(axis=0), rtol=1e-4, atol=1e-4), \
+                    "benchmark_incremental_similarity_equivalence: add_interactions differs from fit, seed {}, " \
+                    "similarity '{}'{}, topK {}".format(random_seed, similarity,
+                                                        "" if row_weights is None else " with row weights", topK)
+
+                n_checked += 1
+
+    print("{} random cases of {} batches equal to fit in {:.2f} s".format(n_checked, n_batches, time.time() - start_time))
+
+
+def benchmark_compact_similarity(topK=100, shrink=10, batch_size=1000, cutoff=10):
+
+    print("\n ... item-item similarity served as float32 CSR vs quantized compact storage ... ")
+
+    URM_all = sps.csr_matrix(data_manager.build_URM(), dtype=np.float32)
+
+    URM_train, URM_test = split_train_leave_k_out_user_wise(URM_all, k_out=1, use_validation_set=False, random_seed=42)
+    evaluator_test = EvaluatorHoldout(URM_test, cutoff_list=[cutoff], verbose=False)
+
+    recommender = ItemKNNCFRecommender(URM_train, verbose=False)
+    recommender.fit(topK=topK, shrink=shrink, similarity="cosine")
+
+    W_sparse = recommender.W_sparse
+    W_sparse_bytes = W_sparse.data.nbytes + W_sparse.indices.nbytes + W_sparse.indptr.nbytes
+
+    def _compute_all_scores(compute_scores):
+        for start_user in range(0, URM_train.shape[0], batch_size):
+            compute_scores(URM_train[start_user:start_user + batch_size])
+
+    def _compare_scores(compute_scores):
+        # Largest score error relative to the largest score of the batch, and fraction of the top items of each user
+        # that are the same, ignoring their order
+        max_error, n_same_top_k = 0.0, 0
+
+        for start_user in range(0, URM_train.shape[0], batch_size):
+            URM_batch = URM_train[start_user:start_user + batch_size]
+
+            item_scores_previous = URM_batch.dot(W_sparse).toarray()
+            item_scores_current = compute_scores(URM_batch)
+
+            max_error = max(max_error, np.abs(item_scores_current - item_scores_previous).max() /
+                            (np.abs(item_scores_previous).max() + 1e-9))
+
+            top_k_previous = np.sort((-item_scores_previous).argpartition(cutoff - 1, axis=1)[:, :cutoff], axis=1)
+            top_k_current = (-item_scores_current).argpartition(cutoff - 1, axis=1)[:, :cutoff]
+
+            n_same_top_k += sum(np.isin(top_k_current[user_index], top_k_previous[user_index]).sum()
+                                for user_index in range(URM_batch.shape[0]))
+
+        return max_error, n_same_top_k / (URM_train.shape[0] * cutoff)
+
+    previous_time, _ = time_function(_compute_all_scores, lambda URM_batch: URM_batch.dot(W_sparse).toarray())
+    results_dict, _ = evaluator_test.evaluateRecommender(recommender)
+
+    print("{:<10} {:8.2f} MB, scores {:7.3f} s, MAP@{} {:.5f}".format("float32", W_sparse_bytes / 2 ** 20, previous_time,
+                                                                   cutoff, results_dict[cutoff]["MAP"]))
+
+    for data_dtype in CompactSimilarityMatrix.DATA_DTYPE_VALUES:
+
+        W_compact = CompactSimilarityMatrix(W_sparse, data_dtype=data_dtype)
+
+        current_time, _ = time_function(_compute_all_scores, W_compact.compute_scores)
+        max_error, top_k_overlap = _compare_scores(W_compact.compute_scores)
+
+        recommender.W_sparse = W_compact
+        results_dict, _ = evaluator_test.evaluateRecommender(recommender)
+        recommender.W_sparse = W_sparse
+
+        print("{:<10} {:8.2f} MB, scores {:7.3f} s, MAP@{} {:.5f}, size {:.2f}x, speedup {:.2f}x, "
+              "max relative error {:.2e}, top-{} overlap {:.4f}".format(
+            data_dtype, W_compact.nbytes / 2 ** 20, current_time, cutoff, results_dict[cutoff]["MAP"],
+            W_sparse_bytes / W_compact.nbytes, previous_time / current_time, max_error, cutoff, top_k_overlap))
+
+
+BENCHMARKS = {
+    "csv_loader": benchmark_csv_loader,
+    "concurrent_loading": benchmark_concurrent_loading,
+    "leave_k_out_split": benchmark_leave_k_out_split,
+    "k_fold_split": benchmark_k_fold_split,
+    "split_integrity": benchmark_split_integrity,
+    "incremental_sparse_matrix": benchmark_incremental_sparse_matrix,
+    "URM_streaming": benchmark_URM_streaming,
+    "submission_writer": benchmark_submission_writer,
+    "similarity": benchmark_similarity,
+    "similarity_parallel": benchmark_similarity_parallel,
+    "similarity_blocks": benchmark_similarity_blocks,
+    "similarity_cache": benchmark_similarity_cache,
+    "similarity_symmetric": benchmark_similarity_symmetric,
+    "similarity_cooccurrence": benchmark_similarity_cooccurrence,
+    "similarity_matrix_top_k": benchmark_similarity_matrix_top_k,
+    "similarity_euclidean": benchmark_similarity_euclidean,
+    "similarity_approximate": benchmark_similarity_approximate,
+    "incremental_similarity": benchmark_incremental_similarity,
+    "incremental_similarity_equivalence": benchmark_incremental_similarity_equivalence,
+    "compact_similarity": benchmark_compact_similarity,
+}
+
+
+if __name__ == '__main__':
+
+    benchmark_name_list = sys.argv[1:] if len(sys.argv) > 1 else list(BENCHMARKS.keys())
+
+    for benchmark_name in benchmark_name_list:
+        BENCHMARKS[benchmark_name]()
@@ -9,12 +9,13 @@ warnings.warn = warn
 import traceback
 import os
 import numpy as np
-from utils.data_manager import build_URM, build_ICM, build_UCM, get_statistics_URM, get_target_users
+from utils.data_manager import load_URM_ICM_UCM, get_statistics_URM, get_target_users
 from utils.Evaluation.Evaluator import EvaluatorHoldout
 from utils.ParameterTuning.hyperparameter_search import runParameterSearch_Collaborative, runParameterSearch_Content, runParameterSearch_CFW
 from utils.DataIO import DataIO
-from utils.create_submission_file import create_csv
-from utils.data_splitter import split_train_validation_random_holdout, split_train_leave_k_out_user_wise
+from utils.split_store import SplitStore
+from utils.create_submission_file import create_csv, recommend_in_batches
+from utils.data_splitter import split_train_validation_random_holdout, split_train_leave_k_out_user_wise, assert_split_integrity
 
 ######################################################################
 ##########                                                  ##########
@@ -69,9 +70,7 @@ from recommenders.Hybrid.ItemKNNScoresHybridRecommender import ItemKNNScoresHybr
 # Build URM, ICM and UCM
 # ----------------------
 
-URM_all = build_URM()
-ICM_all = build_ICM()
-UCM_all = build_UCM(URM_all)
+URM_all, ICM_all, UCM_all = load_URM_ICM_UCM()
 # get_statistics_URM(URM_all)
 
 cutoff = 10  # k recommended_items
@@ -83,15 +82,19 @@ k_out = 4
 # URM_train, URM_test = split_train_validation_random_holdout(URM_all, train_split=0.8)
 # URM_train, URM_validation = split_train_validation_random_holdout(URM_train, train_split=0.9)
 
-URM_train, URM_test = split_train_leave_k_out_user_wise(URM_all,
-                                                        k_out=k_out,
-                                                        use_validation_set=False,
-                                                        leave_random_out=True)
+# The split is saved with its seed and the fingerprint of URM_all, so every run and every worker evaluates on the same data.
+# Test gets k_out random interactions per user, validation the next k_out and train the rest
+split_random_seed = 42
+split_store = SplitStore("result_experiments/splits/")
 
-URM_train, URM_validation = split_train_leave_k_out_user_wise(URM_train,
-                                                              k_out=k_out,
-                                                              use_validation_set=False,
-                                                              leave_random_out=True)
+URM_train, URM_validation, URM_test = split_store.get_split("leave_{}_out".format(k_out), URM_all,
+                                                            split_train_leave_k_out_user_wise,
+                                                            random_seed=split_random_seed,
+                                                            k_out=k_out,
+                                                            use_validation_set=True,
+                                                            leave_random_out=True)
+
+assert_split_integrity([URM_train, URM_validation, URM_test], URM_all=URM_all, k_out=k_out)
 
 # Non-personalized recommenders
 non_personalized_list = [
@@ -790,7 +793,7 @@ def recommendations_quality_by_group():
 
 ################################################################################################################
 
-def recommendations_with_fallback():
+def recommendations_with_fallback(compact_data_dtype=None):
     # Train models on the whole dataset
     # ---------------------------------
 
@@ -811,11 +814,20 @@ def recommendations_with_fallback():
     best_parameters = {'alpha': 0.6}
     itemCF_alpha_similarity_hybrid.fit(**best_parameters)
 
+    # The hybrid keeps its own copy of the two similarities, the component models are not used to serve
+    del itemKNNCF, P3alpha
+
     # TopPop + ItemKNNCBF
     topPop_ItemCBF_scores_hybrid = ItemKNNScoresHybridRecommender(URM_train, topPop, itemKNNCBF)
     best_parameters = {'alpha': 0.6}
     topPop_ItemCBF_scores_hybrid.fit(**best_parameters)
 
+    # Quantized W_sparse of the models that serve the predictions, "int8" or "float16".
+    # The hybrid also drops its copies of the two similarities, which are only needed by fit
+    if compact_data_dtype is not None:
+        itemCF_alpha_similarity_hybrid.compact_W_sparse(data_dtype=compact_data_dtype)
+        itemKNNCBF.compact_W_sparse(data_dtype=compact_data_dtype)
+
     # User-wise discrimination
     # --------------------------
 
@@ -915,10 +927,11 @@ while True:
             recommender = fit_recommender(recommender_class, URM_all, ICM_all)
 
             user_id_array = get_target_users()
-            item_list = recommender.recommend(user_id_array,
-                                              cutoff=cutoff,
-                                              remove_seen_flag=True,
-                                              remove_top_pop_flag=True)
+            # Recommendations are written to the csv as each batch of users is computed
+            item_list = recommend_in_batches(recommender, user_id_array,
+                                             cutoff=cutoff,
+                                             remove_seen_flag=True,
+                                             remove_top_pop_flag=True)
 
             create_csv(user_id_array, item_list, recommender_class.RECOMMENDER_NAME)
 
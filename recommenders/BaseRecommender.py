@@ -24,6 +24,7 @@ class BaseRecommender(object):
 
         self.filterTopPop = False
         self.filterTopPop_ItemsID = np.array([], dtype=np.int)
+        self._filterTopPop_mask = None
 
         self.items_to_ignore_flag = False
         self.items_to_ignore_ID = np.array([], dtype=np.int)
@@ -67,6 +68,17 @@ class BaseRecommender(object):
         self.items_to_ignore_flag = False
         self.items_to_ignore_ID = np.array([], dtype=np.int)
 
+    def set_popularity_index(self, popularity_index):
+        """
+        Items flagged as popular by the PopularityIndex are removed when recommend is called with remove_top_pop_flag,
+        without an index remove_top_pop_flag removes no item
+        :param popularity_index:    e.g. get_popularity_index(URM_train), shared by the recommenders trained on it
+        :return:
+        """
+        self.filterTopPop = True
+        self.filterTopPop_ItemsID = popularity_index.popular_items
+        self._filterTopPop_mask = popularity_index.popular_item_mask
+
 
     #########################################################################################################
     ##########                                                                                     ##########
@@ -76,7 +88,12 @@ class BaseRecommender(object):
 
 
     def _remove_TopPop_on_scores(self, scores_batch):
-        scores_batch[:, self.filterTopPop_ItemsID] = -np.inf
+
+        if self._filterTopPop_mask is not None:
+            scores_batch[:, self._filterTopPop_mask] = -np.inf
+        else:
+            scores_batch[:, self.filterTopPop_ItemsID] = -np.inf
+
         return scores_batch
 
 
@@ -184,3 +201,46 @@ class BaseRecommender(object):
 
         else:
             return ranking_list
+
+
+    def recommend_original_ID(self, user_id_array, user_mapper=None, item_mapper=None, **recommend_args):
+        """
+        Recommends using the original user and item IDs when the model was trained on a compacted URM.
+        Users removed by the compaction get an empty list, any other argument (e.g. items_to_compute) uses dense indices
+        :param user_id_array:       original user IDs
+        :param user_mapper:         IDMapper of the users, None if the users were not compacted
+        :param item_mapper:         IDMapper of the items, None if the items were not compacted
+        :param recommend_args:      same arguments of recommend, except return_scores
+        :return:                    list of recommended original item IDs for each user
+        """
+
+        assert not recommend_args.get("return_scores", False), \
+            "{}: return_scores is not supported with original IDs, scores are indexed by dense item".format(self.RECOMMENDER_NAME)
+
+        single_user = np.isscalar(user_id_array)
+        user_id_array = np.atleast_1d(user_id_array)
+
+        if user_mapper is not None:
+            dense_user_id_array = user_mapper.to_dense(user_id_array)
+        else:
+            dense_user_id_array = user_id_array
+
+        warm_user_mask = dense_user_id_array >= 0
+
+        ranking_list = [[] for _ in range(len(user_id_array))]
+
+        if warm_user_mask.any():
+            warm_ranking_list = self.recommend(dense_user_id_array[warm_user_mask], **recommend_args)
+
+            for user_index, user_recommendation_list in zip(np.flatnonzero(warm_user_mask), warm_ranking_list):
+
+                if item_mapper is not None:
+                    user_recommendation_list = item_mapper.to_original(user_recommendation_list).tolist()
+
+                ranking_list[user_index] = user_recommendation_list
+
+        # Return single list for one user, instead of list of lists
+        if single_user:
+            ranking_list = ranking_list[0]
+
+        return ranking_list
@@ -7,6 +7,7 @@ Created on 16/09/2017
 
 from recommenders.BaseRecommender import BaseRecommender
 from utils.DataIO import DataIO
+from utils.compact_similarity import CompactSimilarityMatrix
 import numpy as np
 
 
@@ -35,7 +36,7 @@ class BaseSimilarityMatrixRecommender(BaseRecommender):
 
         if not self._W_sparse_format_checked:
 
-            if self.W_sparse.getformat() != "csr":
+            if not isinstance(self.W_sparse, CompactSimilarityMatrix) and self.W_sparse.getformat() != "csr":
                 self._print("PERFORMANCE ALERT compute_item_score: {} is not {}, this will significantly slow down the computation.".format("W_sparse", "csr"))
 
             self._W_sparse_format_checked = True
@@ -50,6 +51,9 @@ class BaseSimilarityMatrixRecommender(BaseRecommender):
 
         self._print("Saving model in file '{}'".format(folder_path + file_name))
 
+        assert not isinstance(self.W_sparse, CompactSimilarityMatrix), \
+            "{}: W_sparse is compact, save the model before calling compact_W_sparse".format(self.RECOMMENDER_NAME)
+
         data_dict_to_save = {"W_sparse": self.W_sparse}
 
         dataIO = DataIO(folder_path=folder_path)
@@ -68,6 +72,21 @@ class BaseSimilarityMatrixRecommender(BaseRecommender):
 
 class BaseItemSimilarityMatrixRecommender(BaseSimilarityMatrixRecommender):
 
+    def compact_W_sparse(self, data_dtype="int8"):
+        """
+        Replaces W_sparse with its quantized CompactSimilarityMatrix, to serve the recommendations with less memory.
+        It is the last step after fit: W_sparse can no longer be saved or used to build other models
+        :param data_dtype:  "int8" or "float16"
+        :return:
+        """
+
+        if not isinstance(self.W_sparse, CompactSimilarityMatrix):
+            W_sparse_bytes = self.W_sparse.data.nbytes + self.W_sparse.indices.nbytes + self.W_sparse.indptr.nbytes
+            self.W_sparse = CompactSimilarityMatrix(self.W_sparse, data_dtype=data_dtype)
+
+            self._print("W_sparse compacted to {}, {:.2f} MB instead of {:.2f} MB".format(
+                data_dtype, self.W_sparse.nbytes / 2 ** 20, W_sparse_bytes / 2 ** 20))
+
     def _compute_item_score(self, user_id_array, items_to_compute=None):
         """
         URM_train and W_sparse must have the same format, CSR
@@ -80,12 +99,16 @@ class BaseItemSimilarityMatrixRecommender(BaseSimilarityMatrixRecommender):
 
         user_profile_array = self.URM_train[user_id_array]
 
+        if isinstance(self.W_sparse, CompactSimilarityMatrix):
+            item_scores_all = self.W_sparse.compute_scores(user_profile_array)
+        else:
+            item_scores_all = user_profile_array.dot(self.W_sparse).toarray()
+
         if items_to_compute is not None:
             item_scores = - np.ones((len(user_id_array), self.URM_train.shape[1]), dtype=np.float32)*np.inf
-            item_scores_all = user_profile_array.dot(self.W_sparse).toarray()
             item_scores[:, items_to_compute] = item_scores_all[:, items_to_compute]
         else:
-            item_scores = user_profile_array.dot(self.W_sparse).toarray()
+            item_scores = item_scores_all
 
         return item_scores
 
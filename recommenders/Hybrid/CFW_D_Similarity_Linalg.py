@@ -9,6 +9,7 @@ from scipy.sparse import linalg
 import time, sys
 import numpy as np
 from utils.compute_similarity import Compute_Similarity, check_matrix
+from utils.data_splitter import IncrementalSparseMatrix
 from recommenders.BaseSimilarityMatrixRecommender import BaseItemSimilarityMatrixRecommender
 
 
@@ -90,11 +91,8 @@ class CFW_D_Similarity_Linalg(BaseItemSimilarityMatrixRecommender):
 
         estimated_n_samples = int(S_matrix_contentKNN.nnz*(1+self.add_zeros_quota)*1.2)
 
-        self.row_list = np.zeros(estimated_n_samples, dtype=np.int32)
-        self.col_list = np.zeros(estimated_n_samples, dtype=np.int32)
-        self.data_list = np.zeros(estimated_n_samples, dtype=np.float64)
-
-        num_samples = 0
+        train_data_builder = IncrementalSparseMatrix(n_rows=self.n_items, n_cols=self.n_items,
+                                                     initial_capacity=estimated_n_samples)
 
 
         for row_index in range(self.n_items):
@@ -108,6 +106,7 @@ class CFW_D_Similarity_Linalg(BaseItemSimilarityMatrixRecommender):
             end_pos_target = self.S_matrix_target.indptr[row_index+1]
 
             target_coordinates = self.S_matrix_target.indices[start_pos_target:end_pos_target]
+            target_data = self.S_matrix_target.data[start_pos_target:end_pos_target]
 
             # Chech whether the content coordinate is associated to a non zero target value
             # If true, the content coordinate has a collaborative non-zero value
@@ -117,44 +116,25 @@ class CFW_D_Similarity_Linalg(BaseItemSimilarityMatrixRecommender):
             num_common_in_current_row = is_common.sum()
             num_common_coordinates += num_common_in_current_row
 
+            # If cell exists in target matrix, add its value
+            # Otherwise it will remain zero with a certain probability
+            # The random numbers are drawn in the same order as one per non common coordinate
+            is_sampled = is_common.copy()
+            is_sampled[~is_common] = np.random.rand(len(is_common) - num_common_in_current_row) <= self.add_zeros_quota
 
-            for index in range(len(is_common)):
-
-                if num_samples == estimated_n_samples:
-                    dataBlock = 1000000
-                    self.row_list = np.concatenate((self.row_list, np.zeros(dataBlock, dtype=np.int32)))
-                    self.col_list = np.concatenate((self.col_list, np.zeros(dataBlock, dtype=np.int32)))
-                    self.data_list = np.concatenate((self.data_list, np.zeros(dataBlock, dtype=np.float64)))
-
-                if is_common[index]:
-                    # If cell exists in target matrix, add its value
-                    # Otherwise it will remain zero with a certain probability
-
-                    col_index = content_coordinates[index]
-
-                    self.row_list[num_samples] = row_index
-                    self.col_list[num_samples] = col_index
-
-                    new_data_value = self.S_matrix_target[row_index, col_index]
-
-                    if self.normalize_similarity:
-                        new_data_value *= sum_of_squared_features[row_index]*sum_of_squared_features[col_index]
-
-                    self.data_list[num_samples] = new_data_value
-
-                    num_samples += 1
-
-
-                elif np.random.rand() <= self.add_zeros_quota:
+            new_data_value = np.zeros(len(is_common), dtype=np.float64)
 
-                    col_index = content_coordinates[index]
+            target_sorting = np.argsort(target_coordinates)
+            common_target_position = target_sorting[np.searchsorted(target_coordinates, content_coordinates[is_common],
+                                                                    sorter=target_sorting)]
+            new_data_value[is_common] = target_data[common_target_position]
 
-                    self.row_list[num_samples] = row_index
-                    self.col_list[num_samples] = col_index
-                    self.data_list[num_samples] = 0.0
+            if self.normalize_similarity:
+                new_data_value[is_common] *= sum_of_squared_features[row_index]*sum_of_squared_features[content_coordinates[is_common]]
 
-                    num_samples += 1
+            train_data_builder.add_single_row(row_index, content_coordinates[is_sampled], new_data_value[is_sampled])
 
+            num_samples = train_data_builder.get_nnz()
 
 
             if time.time() - start_time_batch > 30 or num_samples == S_matrix_contentKNN.nnz*(1+self.add_zeros_quota):
@@ -173,10 +153,10 @@ class CFW_D_Similarity_Linalg(BaseItemSimilarityMatrixRecommender):
 
 
 
-        # Discard extra cells at the left of the array
-        self.row_list = self.row_list[:num_samples]
-        self.col_list = self.col_list[:num_samples]
-        self.data_list = self.data_list[:num_samples]
+        # The zeros are samples as well, take the data points as they were added
+        self.row_list, self.col_list, self.data_list = train_data_builder.get_data_arrays()
+        self.row_list = self.row_list.astype(np.int32)
+        self.col_list = self.col_list.astype(np.int32)
 
 
         data_nnz = sum(np.array(self.data_list)!=0)
@@ -37,4 +37,12 @@ class ItemKNNSimilarityHybridRecommender(BaseItemSimilarityMatrixRecommender):
         self.W_sparse = self.Similarity_1*self.alpha + self.Similarity_2*(1-self.alpha)
 
         self.W_sparse = similarityMatrixTopK(self.W_sparse, k=self.topK)
-        self.W_sparse = check_matrix(self.W_sparse, format='csr')
\ No newline at end of file
+        self.W_sparse = check_matrix(self.W_sparse, format='csr')
+
+
+    def compact_W_sparse(self, data_dtype="int8"):
+        super(ItemKNNSimilarityHybridRecommender, self).compact_W_sparse(data_dtype=data_dtype)
+
+        # fit cannot be called again, the copies of the two similarities are no longer needed
+        self.Similarity_1 = None
+        self.Similarity_2 = None
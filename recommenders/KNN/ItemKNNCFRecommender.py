@@ -10,8 +10,9 @@ from recommenders.BaseSimilarityMatrixRecommender import BaseItemSimilarityMatri
 
 from utils.IR_feature_weighting import okapi_BM_25, TF_IDF
 import numpy as np
+import scipy.sparse as sps
 
-from utils.compute_similarity import Compute_Similarity
+from utils.compute_similarity import Compute_Similarity, Compute_Similarity_Python, Compute_Similarity_Euclidean
 
 
 class ItemKNNCFRecommender(BaseItemSimilarityMatrixRecommender):
@@ -25,10 +26,15 @@ class ItemKNNCFRecommender(BaseItemSimilarityMatrixRecommender):
         super(ItemKNNCFRecommender, self).__init__(URM_train, verbose = verbose)
 
 
-    def fit(self, topK=50, shrink=100, similarity='cosine', normalize=True, feature_weighting = "none", **similarity_args):
+    def fit(self, topK=50, shrink=100, similarity='cosine', normalize=True, feature_weighting = "none",
+            similarity_cache=None, **similarity_args):
 
         self.topK = topK
         self.shrink = shrink
+        self.similarity = similarity
+        self.normalize = normalize
+        self.feature_weighting = feature_weighting
+        self.similarity_args = similarity_args
 
         if feature_weighting not in self.FEATURE_WEIGHTING_VALUES:
             raise ValueError("Value for 'feature_weighting' not recognized. Acceptable values are {}, provided was '{}'".format(self.FEATURE_WEIGHTING_VALUES, feature_weighting))
@@ -44,8 +50,188 @@ class ItemKNNCFRecommender(BaseItemSimilarityMatrixRecommender):
             self.URM_train = TF_IDF(self.URM_train.T).T
             self.URM_train = check_matrix(self.URM_train, 'csr')
 
-        similarity = Compute_Similarity(self.URM_train, shrink=shrink, topK=topK, normalize=normalize, similarity = similarity, **similarity_args)
+        # The similarity cache derives the similarity from the dot products of a previous fit on the same data
+        if similarity_cache is not None:
+            self.W_sparse = similarity_cache.compute_similarity(self.URM_train, shrink=shrink, topK=topK, normalize=normalize,
+                                                                similarity=similarity, **similarity_args)
+        else:
+            similarity = Compute_Similarity(self.URM_train, shrink=shrink, topK=topK, normalize=normalize, similarity = similarity, **similarity_args)
+            self.W_sparse = similarity.compute_similarity()
+
+        self.W_sparse = check_matrix(self.W_sparse, format='csr')
+
+
+    def _compute_similarity_columns(self, item_id_array, topK):
+        """
+        Computes the similarity of the given items with all the items, moving them to the first columns of the URM
+        :param item_id_array:   sorted items
+        :param topK:
+        :return:                COO matrix whose nonzero columns are the TopK of the given items
+        """
+
+        is_selected = np.zeros(self.n_items, dtype=np.bool_)
+        is_selected[item_id_array] = True
 
+        item_order = np.concatenate((item_id_array, np.flatnonzero(~is_selected)))
+
+        similarity = Compute_Similarity(self.URM_train[:, item_order], shrink=self.shrink, topK=topK,
+                                        normalize=self.normalize, similarity=self.similarity, **self.similarity_args)
+        W_columns = similarity.compute_similarity(end_col=len(item_id_array)).tocoo()
+
+        return sps.coo_matrix((W_columns.data, (item_order[W_columns.row], item_id_array[W_columns.col])),
+                              shape=(self.n_items, self.n_items))
+
+    def add_interactions(self, user_id_array, item_id_array, data_array=None, max_recomputed_fraction=0.005):
+        """
+        Adds a batch of interactions to URM_train and updates W_sparse without fitting again on the whole URM.
+        A new interaction changes the column of its item, or with the adjusted cosine the columns of all the items of
+        its user, whose average changes. Only the similarities with a changed item can change: the changed items are
+        computed again with all the items and, if the similarity is symmetric, their values are merged into the TopK
+        of the other items. The other items are computed again only when the merged values cannot tell their TopK,
+        because some of their previous TopK decreased. The result is the same as fit on the updated URM up to the ties in the TopK
+        :param user_id_array:
+        :param item_id_array:
+        :param data_array:      value of each interaction, by default 1. Existing interactions are summed as in the URM
+        :param max_recomputed_fraction: Above this fraction of the items computed again, fit on the whole URM is called
+                                instead. They are the changed items, whose similarity with all the items costs several
+                                times a column of fit, or for a non symmetric similarity all the items co-occurring
+                                with them. On the URM of the competition fit is faster from about 0.7% of the items
+        :return:
+        """
 
-        self.W_sparse = similarity.compute_similarity()
-        self.W_sparse = check_matrix(self.W_sparse, format='csr')
\ No newline at end of file
+        assert self.feature_weighting == "none", \
+            "ItemKNNCFRecommender: add_interactions requires feature_weighting 'none', " \
+            "'{}' depends on the whole URM".format(self.feature_weighting)
+
+        user_id_array = np.asarray(user_id_array, dtype=np.int32)
+        item_id_array = np.asarray(item_id_array, dtype=np.int32)
+
+        if len(user_id_array) == 0:
+            return
+
+        if data_array is None:
+            data_array = np.ones(len(user_id_array), dtype=np.float32)
+
+        # The new users and items extend the URM
+        n_users = max(self.n_users, user_id_array.max() + 1)
+        n_items = max(self.n_items, item_id_array.max() + 1)
+        new_items = np.arange(self.n_items, n_items, dtype=np.int32)
+
+        URM_batch = sps.csr_matrix((data_array, (user_id_array, item_id_array)), shape=(n_users, n_items), dtype=np.float32)
+
+        self.URM_train.resize((n_users, n_items))
+        self.URM_train = check_matrix(self.URM_train + URM_batch, 'csr', dtype=np.float32)
+        self.URM_train.eliminate_zeros()
+
+        self.n_users, self.n_items = n_users, n_items
+        self._cold_user_mask = np.ediff1d(self.URM_train.indptr) == 0
+        self._cold_item_mask = np.ediff1d(self.URM_train.tocsc().indptr) == 0
+
+        # The mask of a popularity index has the previous number of items, its popular item IDs are still valid
+        self._filterTopPop_mask = None
+
+        batch_users = np.unique(user_id_array)
+
+        if self.similarity == "adjusted":
+            changed_items = np.union1d(item_id_array, self.URM_train[batch_users].indices)
+        else:
+            changed_items = np.unique(item_id_array)
+
+        # The new items without interactions are not in W_sparse either, the euclidean similarity of an empty item is not zero
+        changed_items = np.union1d(changed_items, new_items)
+
+        is_changed = np.zeros(n_items, dtype=np.bool_)
+        is_changed[changed_items] = True
+
+        W_previous = sps.csc_matrix(self.W_sparse)
+        W_previous.resize((n_items, n_items))
+
+        previous_nnz = np.ediff1d(W_previous.indptr)
+        previous_col = np.repeat(np.arange(n_items, dtype=np.int32), previous_nnz)
+
+        similarity_args = {key: value for key, value in self.similarity_args.items() if key != "use_implementation"}
+        # Only used to tell whether the similarity is symmetric and to select the TopK, the euclidean similarity
+        # has its own implementation as in Compute_Similarity
+        similarity_class = Compute_Similarity_Euclidean if self.similarity == "euclidean" else Compute_Similarity_Python
+        similarity_object = similarity_class(self.URM_train, shrink=self.shrink, topK=self.topK,
+                                             normalize=self.normalize, similarity=self.similarity, **similarity_args)
+
+        if not similarity_object._is_symmetric():
+            # The similarity of a changed item with the others is not in its column, all the items co-occurring
+            # with a changed item are computed again
+            touched_users = np.flatnonzero(np.ediff1d(self.URM_train[:, changed_items].indptr))
+
+            is_recomputed = is_changed.copy()
+            is_recomputed[self.URM_train[touched_users].indices] = True
+
+            n_recomputed_items = np.count_nonzero(is_recomputed)
+        else:
+            n_recomputed_items = len(changed_items)
+
+        if n_recomputed_items > max_recomputed_fraction * n_items:
+            self._print("Added {} interactions, {} ({:.2f} %) items would be computed again, fitting on the whole URM".format(
+                len(user_id_array), n_recomputed_items, n_recomputed_items/n_items*100))
+
+            self.fit(topK=self.topK, shrink=self.shrink, similarity=self.similarity, normalize=self.normalize,
+                     feature_weighting=self.feature_weighting, **self.similarity_args)
+            return
+
+        if not similarity_object._is_symmetric():
+            row, col, data = W_previous.indices, previous_col, W_previous.data
+
+        else:
+            # All the similarities of the changed items, which are also their row of the similarity
+            W_changed = self._compute_similarity_columns(changed_items, topK=n_items)
+
+            # The values missing from the previous TopK of a full column are at most its smallest one: the new TopK is
+            # among the merged values only if at least TopK of them are above it, and the new values below it are not needed
+            is_full = previous_nnz >= similarity_object.TopK
+
+            previous_min = np.full(n_items, np.inf, dtype=np.float32)
+            previous_min[previous_nnz > 0] = np.minimum.reduceat(W_previous.data, W_previous.indptr[:-1][previous_nnz > 0])
+
+            threshold = np.where(is_full & ~is_changed, previous_min, -np.inf)
+
+            # The previous TopK of the other items without the changed items, merged with the new values of the changed items
+            is_kept = ~is_changed[W_previous.indices] & ~is_changed[previous_col]
+            is_new_row = ~is_changed[W_changed.row]
+
+            new_row = np.concatenate((W_changed.row, W_changed.col[is_new_row]))
+            new_col = np.concatenate((W_changed.col, W_changed.row[is_new_row]))
+            new_data = np.concatenate((W_changed.data, W_changed.data[is_new_row]))
+
+            is_candidate = new_data >= threshold[new_col]
+
+            row = np.concatenate((W_previous.indices[is_kept], new_row[is_candidate]))
+            col = np.concatenate((previous_col[is_kept], new_col[is_candidate]))
+            data = np.concatenate((W_previous.data[is_kept], new_data[is_candidate]))
+
+            column_nnz = np.bincount(col, minlength=n_items)
+
+            is_recomputed = ~is_changed & is_full & ((column_nnz < similarity_object.TopK) | (previous_min <= 0.0))
+
+            # Only the columns with more than TopK values, or with negative values ranking after the zeros, are selected
+            is_ranked = (column_nnz > similarity_object.TopK) | (np.bincount(col[data < 0.0], minlength=n_items) > 0)
+            is_ranked = is_ranked[col]
+
+            is_top_k = np.ones(len(data), dtype=np.bool_)
+            is_top_k[is_ranked] = similarity_object._get_top_k_mask_triplets(col[is_ranked], data[is_ranked], n_items)
+
+            row, col, data = row[is_top_k], col[is_top_k], data[is_top_k]
+
+        recomputed_items = np.flatnonzero(is_recomputed)
+
+        self._print("Added {} interactions, {} changed items, computing again the TopK of {} ({:.2f} %) items".format(
+            len(user_id_array), len(changed_items), len(recomputed_items), len(recomputed_items)/n_items*100))
+
+        is_kept = ~is_recomputed[col]
+        row, col, data = row[is_kept], col[is_kept], data[is_kept]
+
+        if len(recomputed_items) > 0:
+            W_recomputed = self._compute_similarity_columns(recomputed_items, topK=self.topK)
+
+            row = np.concatenate((row, W_recomputed.row))
+            col = np.concatenate((col, W_recomputed.col))
+            data = np.concatenate((data, W_recomputed.data))
+
+        self.W_sparse = sps.csr_matrix((data, (row, col)), shape=(n_items, n_items), dtype=np.float32)
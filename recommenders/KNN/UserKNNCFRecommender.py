@@ -26,7 +26,8 @@ class UserKNNCFRecommender(BaseUserSimilarityMatrixRecommender):
 
 
 
-    def fit(self, topK=50, shrink=100, similarity='cosine', normalize=True, feature_weighting = "none", **similarity_args):
+    def fit(self, topK=50, shrink=100, similarity='cosine', normalize=True, feature_weighting = "none",
+            similarity_cache=None, **similarity_args):
 
         self.topK = topK
         self.shrink = shrink
@@ -45,7 +46,12 @@ class UserKNNCFRecommender(BaseUserSimilarityMatrixRecommender):
             self.URM_train = TF_IDF(self.URM_train.T).T
             self.URM_train = check_matrix(self.URM_train, 'csr')
 
-        similarity = Compute_Similarity(self.URM_train.T, shrink=shrink, topK=topK, normalize=normalize, similarity = similarity, **similarity_args)
+        # The similarity cache derives the similarity from the dot products of a previous fit on the same data
+        if similarity_cache is not None:
+            self.W_sparse = similarity_cache.compute_similarity(self.URM_train.T, shrink=shrink, topK=topK, normalize=normalize,
+                                                                similarity=similarity, **similarity_args)
+        else:
+            similarity = Compute_Similarity(self.URM_train.T, shrink=shrink, topK=topK, normalize=normalize, similarity = similarity, **similarity_args)
+            self.W_sparse = similarity.compute_similarity()
 
-        self.W_sparse = similarity.compute_similarity()
         self.W_sparse = check_matrix(self.W_sparse, format='csr')
\ No newline at end of file
@@ -5,7 +5,7 @@ import numpy as np
 import time
 
 from utils import masks, compute_similarity
-from utils.data_manager import top_5_percept_popular_items
+from utils.data_manager import get_popularity_index
 
 
 # SLIM with BPR
@@ -213,19 +213,10 @@ class SLIM_BPR_Recommender(object):
 
     # Do not recommend 5% top popular items.
     def filter_popular(self, ranking, at=10):
-        # get 5 % top popular items
-        five_perc_pop = top_5_percept_popular_items(self.URM)
-
-        i = 0
-        recommended_items = []
+        # get 5 % top popular items, the popularity index is built once per URM
+        popularity_index = get_popularity_index(self.URM)
 
         # Return 10 non-popular items to recommend
-        while len(recommended_items) < at:
-
-            # if the item in the ranking is not popular
-            if ranking[i] not in five_perc_pop:
-                # append to items to be recommended
-                recommended_items.append(ranking[i])
-            i += 1
+        recommended_items = popularity_index.filter_popular(ranking, cutoff=at)
 
-        return recommended_items
\ No newline at end of file
+        return recommended_items.tolist()
\ No newline at end of file
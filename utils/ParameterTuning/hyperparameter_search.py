@@ -66,6 +66,7 @@ import traceback
 from utils.ParameterTuning.SearchBayesianSkopt import SearchBayesianSkopt
 from utils.ParameterTuning.SearchAbstractClass import SearchInputRecommenderArgs
 from utils.ParameterTuning.searchSingleCase import SearchSingleCase
+from utils.similarity_cache import SimilarityCache
 
 
 def run_KNNRecommender_on_similarity_type(similarity_type, parameterSearch,
@@ -198,7 +199,7 @@ def runParameterSearch_Collaborative(recommender_class, URM_train, URM_train_las
                                      output_folder_path="result_experiments/", parallelizeKNN=True,
                                      n_cases=35, n_random_starts=5, resume_from_saved=False, save_model="best",
                                      allow_weighting=True,
-                                     similarity_type_list=None):
+                                     similarity_type_list=None, use_similarity_cache=True):
 
     # If directory does not exist, create
     if not os.path.exists(output_folder_path):
@@ -265,11 +266,19 @@ def runParameterSearch_Collaborative(recommender_class, URM_train, URM_train_las
             if similarity_type_list is None:
                 similarity_type_list = ['cosine', 'jaccard', "asymmetric", "dice", "tversky"]
 
+            # The trials with the same similarity and feature weighting share the dot products,
+            # only the topK, shrink and normalization change
+            fit_keyword_args = {}
+
+            if use_similarity_cache:
+                fit_keyword_args["similarity_cache"] = SimilarityCache(output_folder_path + "similarity_cache/",
+                                                                       K_max=1000)
+
             recommender_input_args = SearchInputRecommenderArgs(
                 CONSTRUCTOR_POSITIONAL_ARGS=[URM_train],
                 CONSTRUCTOR_KEYWORD_ARGS={},
                 FIT_POSITIONAL_ARGS=[],
-                FIT_KEYWORD_ARGS={}
+                FIT_KEYWORD_ARGS=fit_keyword_args
             )
 
             if URM_train_last_test is not None:
@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+#  -*- coding: utf-8 -*-
+
+"""
+	artifact_cache.py: content-addressed cache for the objects derived from the data (splits, weighted matrices,
+	similarities). Each result is keyed by a fingerprint of the input matrices and of the parameters of the function
+	that produced it, kept in an in-memory LRU with a byte budget and saved on disk through DataIO.
+"""
+
+import os
+import json
+import hashlib
+import functools
+from collections import OrderedDict
+
+import numpy as np
+import scipy.sparse as sps
+
+from utils.DataIO import DataIO
+
+
+def _update_fingerprint(content_hash, value):
+
+    if isinstance(value, sps.spmatrix):
+        content_hash.update("sparse_{}_{}_{}".format(value.format, value.shape, value.dtype).encode())
+
+        if value.format in ["csr", "csc", "bsr"]:
+            attribute_list = ["indptr", "indices", "data"]
+        elif value.format == "coo":
+            attribute_list = ["row", "col", "data"]
+        else:
+            value = value.tocsr()
+            attribute_list = ["indptr", "indices", "data"]
+
+        for attribute_name in attribute_list:
+            _update_fingerprint(content_hash, getattr(value, attribute_name))
+
+    elif isinstance(value, np.ndarray):
+        content_hash.update("ndarray_{}_{}".format(value.shape, value.dtype).encode())
+        content_hash.update(np.ascontiguousarray(value).view(np.uint8).data)
+
+    elif isinstance(value, (list, tuple)):
+        content_hash.update("{}_{}".format(type(value).__name__, len(value)).encode())
+
+        for element in value:
+            _update_fingerprint(content_hash, element)
+
+    elif isinstance(value, dict):
+        content_hash.update("dict_{}".format(len(value)).encode())
+
+        for key in sorted(value.keys(), key=str):
+            _update_fingerprint(content_hash, str(key))
+            _update_fingerprint(content_hash, value[key])
+
+    else:
+        # Numbers, strings, booleans and None, numpy scalars are converted to the equivalent Python type
+        if isinstance(value, np.generic):
+            value = value.item()
+
+        content_hash.update(json.dumps(value, sort_keys=True).encode())
+
+
+def compute_fingerprint(*values):
+    """
+    Hash of the content of the given values: sparse matrices, numpy arrays and json serializable parameters,
+    possibly nested in lists, tuples and dictionaries. Equal content gives the same fingerprint across runs.
+    :param values:
+    :return:            hex digest
+    """
+
+    content_hash = hashlib.sha1()
+
+    for value in values:
+        _update_fingerprint(content_hash, value)
+
+    return content_hash.hexdigest()
+
+
+def get_size_bytes(value):
+    """
+    Memory occupied by the arrays of the value, the small Python objects are not counted
+    """
+
+    if isinstance(value, sps.spmatrix):
+        if value.format in ["csr", "csc", "bsr"]:
+            return value.data.nbytes + value.indices.nbytes + value.indptr.nbytes
+        elif value.format == "coo":
+            return value.data.nbytes + value.row.nbytes + value.col.nbytes
+
+        return get_size_bytes(value.tocsr())
+
+    elif isinstance(value, np.ndarray):
+        return value.nbytes
+
+    elif isinstance(value, (list, tuple)):
+        return sum(get_size_bytes(element) for element in value)
+
+    return 0
+
+
+class ArtifactCache(object):
+    """
+    Cache of the results of deterministic functions of the data. The result of a function is identified by its name
+    and by the fingerprint of its arguments, it is looked up first in memory and then on disk, and computed only if missing.
+
+    A function opts in with the decorator:
+
+        artifact_cache = ArtifactCache("result_experiments/artifact_cache/")
+
+        @artifact_cache.cached()
+        def weighted_URM(URM, K1, B):
+            ...
+
+    or, for an existing function, weighted_URM = artifact_cache.cached("okapi_BM_25")(okapi_BM_25)
+
+    The result can be a sparse matrix, a numpy array or a tuple of them. The same object is returned to every caller
+    hitting the memory cache, so it must not be modified in place.
+    """
+
+    def __init__(self, folder_path, max_memory_bytes=2 ** 30, verbose=True):
+        super(ArtifactCache, self).__init__()
+
+        # DataIO concatenates the folder path and the file name
+        self.folder_path = os.path.join(folder_path, "")
+        self.max_memory_bytes = max_memory_bytes
+        self.verbose = verbose
+
+        self._dataIO = DataIO(folder_path=self.folder_path)
+
+        # key -> (value, size in bytes), the most recently used entries are at the end
+        self._memory_cache = OrderedDict()
+        self._memory_bytes = 0
+
+        self.reset_statistics()
+
+    def _print(self, message):
+        if self.verbose:
+            print("{}: {}".format("ArtifactCache", message))
+
+    def reset_statistics(self):
+        self.n_memory_hits = 0
+        self.n_disk_hits = 0
+        self.n_misses = 0
+
+    def get_statistics(self):
+        """
+        :return:    dictionary with the number of hits and misses and the memory currently used
+        """
+
+        n_requests = self.n_memory_hits + self.n_disk_hits + self.n_misses
+
+        return {"memory_hits": self.n_memory_hits,
+                "disk_hits": self.n_disk_hits,
+                "misses": self.n_misses,
+                "hit_rate": (self.n_memory_hits + self.n_disk_hits) / n_requests if n_requests > 0 else 0.0,
+                "memory_entries": len(self._memory_cache),
+                "memory_bytes": self._memory_bytes}
+
+    def print_statistics(self):
+
+        statistics = self.get_statistics()
+
+        self._print("Memory hits {}, disk hits {}, misses {}, hit rate {:.2f}. "
+                    "In memory {} entries, {:.2f} MB".format(statistics["memory_hits"], statistics["disk_hits"],
+                                                            statistics["misses"], statistics["hit_rate"],
+                                                            statistics["memory_entries"],
+                                                            statistics["memory_bytes"] / 2 ** 20))
+
+    def get_key(self, artifact_name, *args, **kwargs):
+        return "{}_{}".format(artifact_name, compute_fingerprint(args, kwargs))
+
+    def _add_to_memory(self, key, value):
+
+        value_bytes = get_size_bytes(value)
+
+        # Values larger than the whole budget are only kept on disk
+        if value_bytes > self.max_memory_bytes:
+            return
+
+        if key in self._memory_cache:
+            self._memory_bytes -= self._memory_cache.pop(key)[1]
+
+        self._memory_cache[key] = (value, value_bytes)
+        self._memory_bytes += value_bytes
+
+        while self._memory_bytes > self.max_memory_bytes:
+            _, (_, evicted_bytes) = self._memory_cache.popitem(last=False)
+            self._memory_bytes -= evicted_bytes
+
+    def _save_to_disk(self, key, value):
+
+        if isinstance(value, tuple):
+            data_dict_to_save = {"artifact_{}".format(index): element for index, element in enumerate(value)}
+            data_dict_to_save["artifact_is_tuple"] = True
+        else:
+            data_dict_to_save = {"artifact_0": value, "artifact_is_tuple": False}
+
+        self._dataIO.save_data(file_name=key, data_dict_to_save=data_dict_to_save)
+
+    def _load_from_disk(self, key):
+
+        data_dict = self._dataIO.load_data(file_name=key)
+
+        if not data_dict["artifact_is_tuple"]:
+            return data_dict["artifact_0"]
+
+        return tuple(data_dict["artifact_{}".format(index)] for index in range(len(data_dict) - 1))
+
+    def _is_on_disk(self, key):
+        return os.path.exists(os.path.join(self.folder_path, key + ".zip"))
+
+    def get_or_compute(self, artifact_name, function, *args, **kwargs):
+        """
+        Returns the result of function(*args, **kwargs) from the cache, computing and caching it if missing
+        :param artifact_name:   identifies the function, must change whenever the function changes behaviour
+        :param function:
+        :return:
+        """
+
+        key = self.get_key(artifact_name, *args, **kwargs)
+
+        if key in self._memory_cache:
+            self.n_memory_hits += 1
+            self._memory_cache.move_to_end(key)
+            return self._memory_cache[key][0]
+
+        if self._is_on_disk(key):
+            self.n_disk_hits += 1
+            self._print("Loading '{}' from disk".format(artifact_name))
+
+            value = self._load_from_disk(key)
+            self._add_to_memory(key, value)
+            return value
+
+        self.n_misses += 1
+        self._print("'{}' not found, computing it".format(artifact_name))
+
+        value = function(*args, **kwargs)
+
+        self._save_to_disk(key, value)
+        self._add_to_memory(key, value)
+
+        return value
+
+    def cached(self, artifact_name=None):
+        """
+        Decorator caching the results of the function, by default the artifact is named after the function
+        :param artifact_name:
+        :return:
+        """
+
+        def decorator(function):
+
+            name = artifact_name if artifact_name is not None else function.__name__
+
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                return self.get_or_compute(name, function, *args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def clear_memory(self):
+        self._memory_cache.clear()
+        self._memory_bytes = 0
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+#  -*- coding: utf-8 -*-
+
+"""
+	compact_similarity.py: quantized storage of a sparse similarity for serving. The values are stored as int8 or float16
+	relative to a scale for each row and the column indices as uint16 when the number of columns allows, the scores
+	of a batch of users are computed on this form without converting it back to float32.
+"""
+
+import numpy as np
+import scipy.sparse as sps
+
+
+class CompactSimilarityMatrix(object):
+    """
+    Compact version of a CSR similarity W, only used to compute the scores URM_batch . W
+
+        W_compact = CompactSimilarityMatrix(recommender.W_sparse, data_dtype="int8")
+        item_scores = W_compact.compute_scores(URM_train[user_id_array])
+
+    Each row is divided by its largest absolute value: int8 keeps 127 levels of it, float16 about 3 significant digits.
+    """
+
+    DATA_DTYPE_VALUES = ["int8", "float16"]
+
+    def __init__(self, W_sparse, data_dtype="int8"):
+        super(CompactSimilarityMatrix, self).__init__()
+
+        if data_dtype not in self.DATA_DTYPE_VALUES:
+            raise ValueError("CompactSimilarityMatrix: value for parameter 'data_dtype' not recognized."
+                             " Allowed values are {}, provided was '{}'".format(self.DATA_DTYPE_VALUES, data_dtype))
+
+        W_sparse = sps.csr_matrix(W_sparse, dtype=np.float32)
+        W_sparse.sort_indices()
+
+        self.shape = W_sparse.shape
+        self.nnz = W_sparse.nnz
+        self.data_dtype = data_dtype
+
+        self.indptr = W_sparse.indptr.astype(np.int32 if self.nnz < 2 ** 31 else np.int64)
+        self.indices = W_sparse.indices.astype(np.uint16 if self.shape[1] <= 2 ** 16 else np.int32)
+
+        row_nnz = np.ediff1d(W_sparse.indptr)
+        row_max = np.zeros(self.shape[0], dtype=np.float32)
+        row_max[row_nnz > 0] = np.maximum.reduceat(np.abs(W_sparse.data), W_sparse.indptr[:-1][row_nnz > 0])
+        row_max[row_max == 0.0] = 1.0
+
+        if data_dtype == "int8":
+            self.row_scale = row_max / 127
+            self.data = np.rint(W_sparse.data / np.repeat(self.row_scale, row_nnz)).astype(np.int8)
+        else:
+            self.row_scale = row_max
+            self.data = (W_sparse.data / np.repeat(self.row_scale, row_nnz)).astype(np.float16)
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes + self.indices.nbytes + self.indptr.nbytes + self.row_scale.nbytes
+
+    def tocsr(self):
+        """
+        :return:    the dequantized similarity as a float32 CSR matrix
+        """
+
+        values = self.data.astype(np.float32) * np.repeat(self.row_scale, np.ediff1d(self.indptr))
+
+        return sps.csr_matrix((values, self.indices.astype(np.int32), self.indptr), shape=self.shape)
+
+    def compute_scores(self, URM_batch):
+        """
+        Computes URM_batch . W from the compact data. The scale of each row of W is applied to the interactions
+        of URM_batch, so that only the quantized values of the rows the batch interacted with are cast to float32
+        for the sparse product: the float32 copy of W is never built
+        :param URM_batch:   sparse matrix (n_users_batch, n_rows of W), e.g. the profiles of the users to score
+        :return:            dense float32 array (n_users_batch, n_columns of W)
+        """
+
+        URM_batch = sps.csr_matrix(URM_batch)
+
+        assert URM_batch.shape[1] == self.shape[0], \
+            "CompactSimilarityMatrix: URM_batch has {} columns, W has {} rows".format(URM_batch.shape[1], self.shape[0])
+
+        rows, batch_indices = np.unique(URM_batch.indices, return_inverse=True)
+
+        batch_values = URM_batch.data.astype(np.float32) * self.row_scale[rows][batch_indices]
+        URM_batch = sps.csr_matrix((batch_values, batch_indices, URM_batch.indptr), shape=(URM_batch.shape[0], len(rows)))
+
+        # Position in data of every value of the selected rows of W
+        row_nnz = self.indptr[rows + 1] - self.indptr[rows]
+        rows_indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum(row_nnz, out=rows_indptr[1:])
+
+        position = np.arange(rows_indptr[-1]) - np.repeat(rows_indptr[:-1] - self.indptr[rows], row_nnz)
+
+        W_rows = sps.csr_matrix((self.data[position].astype(np.float32), self.indices[position].astype(np.int32),
+                                 rows_indptr), shape=(len(rows), self.shape[1]))
+
+        return URM_batch.dot(W_rows).toarray()
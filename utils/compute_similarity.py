@@ -6,16 +6,129 @@ Created on 23/10/17
 """
 
 import numpy as np
-import time, sys
+import time, sys, os
 import scipy.sparse as sps
-from utils import data_manager as dp
+import multiprocessing
+from multiprocessing import shared_memory
+
+
+# Environment variables read by the BLAS and OpenMP runtimes when a process starts
+_BLAS_THREADS_ENV_VARIABLES = ["OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS",
+                               "VECLIB_MAXIMUM_THREADS", "NUMEXPR_NUM_THREADS"]
+
+
+def _share_array(array):
+    """
+    Copies the array in a new shared memory block
+    :param array:
+    :return:        the shared memory, to be closed and unlinked by the caller, and the descriptor to attach to it
+    """
+
+    array_shared_memory = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+
+    shared_array = np.ndarray(array.shape, dtype=array.dtype, buffer=array_shared_memory.buf)
+    shared_array[:] = array
+
+    return array_shared_memory, (array_shared_memory.name, array.shape, array.dtype.str)
+
+
+def _attach_array(array_descriptor):
+    """
+    Opens, without copying, an array shared by another process with _share_array
+    :param array_descriptor:
+    :return:                    the shared memory, which must be kept open while the array is used, and the array
+    """
+
+    name, shape, dtype = array_descriptor
+
+    # The workers share the resource tracker of the process that created the block, which unlinks it
+    array_shared_memory = shared_memory.SharedMemory(name=name)
+
+    return array_shared_memory, np.ndarray(shape, dtype=dtype, buffer=array_shared_memory.buf)
+
+
+def _limit_blas_threads(n_threads):
+    """
+    Caps the threads of the BLAS libraries already loaded in a worker, so that the workers do not oversubscribe the cores
+    """
+
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(limits=n_threads)
+    except ImportError:
+        # The workers are spawned, they load BLAS after the parent set the environment variables, which cap it
+        pass
+
+
+def _rank_in_columns(column_index, values, n_columns):
+    """
+    Ranks the values of each column by decreasing value, with a single sort of all the values
+    :param column_index:    column of each value of a matrix given as triplets, in any order
+    :param values:
+    :param n_columns:
+    :return:                position of each value in its column, from 0, and the number of values of each column
+    """
+
+    ranking = np.lexsort((-values, column_index))
+
+    column_nnz = np.bincount(column_index, minlength=n_columns)
+    column_start = np.cumsum(column_nnz) - column_nnz
+
+    rank_in_column = np.empty(len(values), dtype=np.int64)
+    rank_in_column[ranking] = np.arange(len(values)) - np.repeat(column_start, column_nnz)
+
+    return rank_in_column, column_nnz
+
+
+# State of each similarity worker, set by _init_similarity_worker
+_worker_similarity = None
+_worker_shared_memory_list = []
+
+
+def _init_similarity_worker(similarity_class, similarity_state, shared_matrix_dict, n_blas_threads):
+
+    global _worker_similarity, _worker_shared_memory_list
+
+    _limit_blas_threads(n_blas_threads)
+
+    _worker_similarity = similarity_class.__new__(similarity_class)
+    _worker_similarity.__dict__.update(similarity_state)
+
+    for attribute_name, (matrix_format, shape, array_descriptor_list) in shared_matrix_dict.items():
+
+        array_list = []
+
+        for array_descriptor in array_descriptor_list:
+            array_shared_memory, array = _attach_array(array_descriptor)
+            _worker_shared_memory_list.append(array_shared_memory)
+            array_list.append(array)
+
+        indptr, indices, data = array_list
+        matrix_class = sps.csc_matrix if matrix_format == "csc" else sps.csr_matrix
+
+        setattr(_worker_similarity, attribute_name, matrix_class((data, indices, indptr), shape=shape, copy=False))
+
+
+def _compute_similarity_worker(column_range):
+
+    block_list, use_sparse_product = column_range
+
+    values, rows, column_nnz = _worker_similarity._compute_column_range(block_list, use_sparse_product, verbose=False)
+
+    return block_list[0][0], values, rows, column_nnz
 
 
 class Compute_Similarity_Python:
 
+    # Approximate bytes used for each value of the similarity block: the product, its normalization
+    # and the selection of the TopK, with the indices and the sorting permutations for the sparse product
+    _DENSE_BYTES_PER_VALUE = 32
+    _SPARSE_BYTES_PER_VALUE = 64
+
     def __init__(self, dataMatrix, topK=100, shrink=0, normalize=True,
                  asymmetric_alpha=0.5, tversky_alpha=1.0, tversky_beta=1.0,
-                 similarity="cosine", row_weights=None):
+                 similarity="cosine", row_weights=None, n_workers=1,
+                 memory_budget_bytes=2 ** 28, sparse_density_threshold=0.05, use_symmetry=True):
         """
         Computes the cosine similarity on the columns of dataMatrix
         If it is computed on URM=|users|x|items|, pass the URM as is.
@@ -34,10 +147,23 @@ class Compute_Similarity_Python:
                             "dice"          computes Dice similarity for binary interactions
                             "tversky"       computes Tversky similarity for binary interactions
                             "tanimoto"      computes Tanimoto coefficient for binary interactions
+        :param n_workers:           Number of processes computing the similarity, each on a range of columns.
+                                    None uses all the cores. The workers are started with spawn, a script using
+                                    more than one must guard its code with if __name__ == '__main__'
+        :param memory_budget_bytes: Memory available for the blocks of columns computed at once, shared by the workers
+        :param sparse_density_threshold: Below this estimated fraction of nonzero similarities the blocks are computed
+                                    with a sparse product, ranking only the nonzero values
+        :param use_symmetry:        If the similarity is symmetric, compute only the products of each column with the
+                                    following ones and pass each value to the TopK of both columns
         """
 
         super(Compute_Similarity_Python, self).__init__()
 
+        self.n_workers = multiprocessing.cpu_count() if n_workers is None else n_workers
+        self.memory_budget_bytes = memory_budget_bytes
+        self.sparse_density_threshold = sparse_density_threshold
+        self.use_symmetry = use_symmetry
+
         self.shrink = shrink
         self.normalize = normalize
 
@@ -84,6 +210,8 @@ class Compute_Similarity_Python:
                              "dice, tversky."
                              " Passed value was '{}'".format(similarity))
 
+        self._data_prepared = False
+        self._base_ranking_shrink_list = None
         self.use_row_weights = False
 
         if row_weights is not None:
@@ -99,6 +227,11 @@ class Compute_Similarity_Python:
 
             self.dataMatrix_weighted = self.dataMatrix.T.dot(self.row_weights_diag).T
 
+        # The set similarities need only the co-occurrence counts and the degrees of the columns, computed with integer
+        # arithmetic on the nonzero pattern. With row weights the products are weighted sums and stay floating point
+        self.use_cooccurrence_counts = (self.tanimoto_coefficient or self.dice_coefficient or self.tversky_coefficient) and \
+                                       not self.use_row_weights
+
     def applyAdjustedCosine(self):
         """
         Remove from every data point the average for the corresponding row
@@ -115,106 +248,898 @@ class Compute_Similarity_Python:
         rowAverage = np.zeros_like(sumPerRow)
         rowAverage[nonzeroRows] = sumPerRow[nonzeroRows] / interactionsPerRow[nonzeroRows]
 
-        # Split in blocks to avoid duplicating the whole data structure
-        start_row = 0
-        end_row = 0
+        # Split in blocks to avoid duplicating the whole data structure
+        start_row = 0
+        end_row = 0
+
+        blockSize = 1000
+
+        while end_row < self.n_rows:
+            end_row = min(self.n_rows, end_row + blockSize)
+
+            self.dataMatrix.data[self.dataMatrix.indptr[start_row]:self.dataMatrix.indptr[end_row]] -= \
+                np.repeat(rowAverage[start_row:end_row], interactionsPerRow[start_row:end_row])
+
+            start_row += blockSize
+
+    def applyPearsonCorrelation(self):
+        """
+        Remove from every data point the average for the corresponding column
+        :return:
+        """
+
+        self.dataMatrix = check_matrix(self.dataMatrix, 'csc')
+
+        interactionsPerCol = np.diff(self.dataMatrix.indptr)
+
+        nonzeroCols = interactionsPerCol > 0
+        sumPerCol = np.asarray(self.dataMatrix.sum(axis=0)).ravel()
+
+        colAverage = np.zeros_like(sumPerCol)
+        colAverage[nonzeroCols] = sumPerCol[nonzeroCols] / interactionsPerCol[nonzeroCols]
+
+        # Split in blocks to avoid duplicating the whole data structure
+        start_col = 0
+        end_col = 0
+
+        blockSize = 1000
+
+        while end_col < self.n_columns:
+            end_col = min(self.n_columns, end_col + blockSize)
+
+            self.dataMatrix.data[self.dataMatrix.indptr[start_col]:self.dataMatrix.indptr[end_col]] -= \
+                np.repeat(colAverage[start_col:end_col], interactionsPerCol[start_col:end_col])
+
+            start_col += blockSize
+
+    def useOnlyBooleanInteractions(self):
+
+        # Split in blocks to avoid duplicating the whole data structure
+        start_pos = 0
+        end_pos = 0
+
+        blockSize = 1000
+
+        while end_pos < len(self.dataMatrix.data):
+            end_pos = min(len(self.dataMatrix.data), end_pos + blockSize)
+
+            self.dataMatrix.data[start_pos:end_pos] = np.ones(end_pos - start_pos)
+
+            start_pos += blockSize
+
+    def useOnlyBooleanPattern(self):
+        """
+        Replaces the data with its nonzero pattern in CSC format, so that the dot products are the co-occurrence counts
+        of the columns. The counts are at most the largest degree of a column, the ones are stored in the smallest
+        unsigned integer type that holds it, so the products accumulate in it without overflowing
+        :return:
+        """
+
+        self.dataMatrix = self.dataMatrix.tocsc()
+
+        max_degree = np.diff(self.dataMatrix.indptr).max(initial=0)
+
+        self.dataMatrix = sps.csc_matrix((np.ones(self.dataMatrix.nnz, dtype=np.min_scalar_type(max_degree)),
+                                          self.dataMatrix.indices, self.dataMatrix.indptr), shape=self.dataMatrix.shape)
+
+    def _prepare_data(self):
+        """
+        Applies the transformation required by the similarity, moves the data to CSC
+        and computes the column norms used in the normalization. Done only once per object
+        :return:
+        """
+
+        if self._data_prepared:
+            return
+
+        if self.adjusted_cosine:
+            self.applyAdjustedCosine()
+
+        elif self.pearson_correlation:
+            self.applyPearsonCorrelation()
+
+        elif self.use_cooccurrence_counts:
+            self.useOnlyBooleanPattern()
+
+        elif self.tanimoto_coefficient or self.dice_coefficient or self.tversky_coefficient:
+            self.useOnlyBooleanInteractions()
+
+        # We explore the matrix column-wise, the pattern for the co-occurrence counts is already in CSC
+        if not self.use_cooccurrence_counts:
+            self.dataMatrix = check_matrix(self.dataMatrix, 'csc')
+
+        if self.use_row_weights:
+            self.dataMatrix_weighted = self.dataMatrix_weighted.tocsc()
+
+        if self.tanimoto_coefficient or self.dice_coefficient or self.tversky_coefficient:
+            # The set similarities are normalized by the degree of the columns, their number of nonzeros
+            sumOfSquared = np.diff(self.dataMatrix.indptr).astype(np.int32)
+
+        else:
+            # Compute sum of squared values to be used in normalization
+            sumOfSquared = np.sqrt(np.array(self.dataMatrix.power(2).sum(axis=0)).ravel())
+
+        self._set_sum_of_squared(sumOfSquared)
+
+        self._data_prepared = True
+
+    def _set_sum_of_squared(self, sumOfSquared):
+
+        self.sumOfSquared = sumOfSquared
+
+        if self.asymmetric_cosine:
+            self.sumOfSquared_to_1_minus_alpha = np.power(self.sumOfSquared, 2 * (1 - self.asymmetric_alpha))
+            self.sumOfSquared_to_alpha = np.power(self.sumOfSquared, 2 * self.asymmetric_alpha)
+
+    def _normalize_weights(self, weights, block_columns, other_columns, shrink=None):
+        """
+        Applies normalization and shrinkage to the dot products between the columns of the block and the other columns.
+        The indices are either a column and a row vector, for a dense block, or one pair for each value of a sparse block
+        :param weights:
+        :param block_columns:
+        :param other_columns:
+        :param shrink:          if None the one of the object
+        :return:
+        """
+
+        if shrink is None:
+            shrink = self.shrink
+
+        # Apply normalization and shrinkage, ensure denominator != 0
+        if self.normalize:
+
+            if self.asymmetric_cosine:
+                denominator = self.sumOfSquared_to_alpha[block_columns] * \
+                              self.sumOfSquared_to_1_minus_alpha[other_columns] + shrink + 1e-6
+            else:
+                denominator = self.sumOfSquared[block_columns] * self.sumOfSquared[other_columns] + shrink + 1e-6
+
+            weights = np.multiply(weights, 1 / denominator)
+
+        # Apply the specific denominator for Tanimoto, Dice and Tversky
+        elif self.tanimoto_coefficient or self.dice_coefficient or self.tversky_coefficient:
+            weights = self._normalize_counts(weights, block_columns, other_columns, shrink)
+
+        # If no normalization or tanimoto is selected, apply only shrink
+        elif shrink != 0:
+            weights = weights / shrink
+
+        return weights
+
+    def _normalize_counts(self, counts, block_columns, other_columns, shrink):
+        """
+        Computes the set similarities from the co-occurrence counts and the degrees of the columns. The denominator is
+        built in the float32 array that is returned, only Tversky with alpha + beta != 1 needs another one
+        :param counts:
+        :param block_columns:
+        :param other_columns:
+        :param shrink:
+        :return:
+        """
+
+        degrees = self.sumOfSquared
+
+        if self.tversky_coefficient:
+            # |A & B| + alpha |A - B| + beta |B - A| = alpha |A| + beta |B| + (1 - alpha - beta) |A & B|
+            denominator = np.add(self.tversky_alpha * degrees[block_columns], self.tversky_beta * degrees[other_columns],
+                                 dtype=np.float32)
+
+            if self.tversky_alpha + self.tversky_beta != 1.0:
+                denominator += np.multiply(counts, 1.0 - self.tversky_alpha - self.tversky_beta, dtype=np.float32)
+
+        else:
+            denominator = np.add(degrees[block_columns], degrees[other_columns], dtype=np.float32)
+
+            # Tanimoto divides by the size of the union, |A| + |B| - |A & B|
+            if self.tanimoto_coefficient:
+                np.subtract(denominator, counts, out=denominator, dtype=np.float32)
+
+        denominator += shrink + 1e-6
+
+        return np.divide(counts, denominator, out=denominator, dtype=np.float32)
+
+    def _get_ranking_weights_list(self, weights, block_columns, other_columns):
+        """
+        The values the TopK are selected on. They are the similarity, or for compute_raw_similarity
+        the dot products and their normalization with each of the shrink values the base is ranked on
+        :return:    values to keep, list of the values to rank them on
+        """
+
+        if self._base_ranking_shrink_list is None:
+            weights = self._normalize_weights(weights, block_columns, other_columns)
+            return weights, [weights]
+
+        # The co-occurrence counts are unsigned, they are ranked on their decreasing opposite
+        weights = weights.astype(np.float32, copy=False)
+
+        return weights, [weights if ranking_shrink is None else
+                         self._normalize_weights(weights, block_columns, other_columns, shrink=ranking_shrink)
+                         for ranking_shrink in self._base_ranking_shrink_list]
+
+    def _get_product_matrix(self):
+        return self.dataMatrix_weighted if self.use_row_weights else self.dataMatrix
+
+    def _compute_block_dot_products(self, start_col_block, end_col_block):
+        """
+        Computes the dot products of the columns in [start_col_block, end_col_block) with all the columns
+        :param start_col_block:
+        :param end_col_block:
+        :return:                dense array of shape (end_col_block - start_col_block, n_columns), one row per column
+                                of the block so that the selection of its TopK reads contiguous memory
+        """
+
+        # All data points for the items in the block, always two-dimensional even with one column or one feature
+        item_data = self.dataMatrix[:, start_col_block:end_col_block].toarray()
+
+        # Compute item similarities => using dot product
+        this_block_weights = self._get_product_matrix().T.dot(item_data)
+        this_block_weights = np.ascontiguousarray(this_block_weights.T)
+
+        block_columns = np.arange(start_col_block, end_col_block)
+
+        # The similarity of each item with itself is not considered
+        this_block_weights[block_columns - start_col_block, block_columns] = 0.0
+
+        return this_block_weights
+
+    def _compute_block_similarity(self, start_col_block, end_col_block):
+        """
+        Computes the normalized and shrunk similarity of the columns in [start_col_block, end_col_block) with all the columns
+        :return:    dense array of shape (end_col_block - start_col_block, n_columns)
+        """
+
+        return self._normalize_weights(self._compute_block_dot_products(start_col_block, end_col_block),
+                                       np.arange(start_col_block, end_col_block)[:, np.newaxis],
+                                       np.arange(self.n_columns)[np.newaxis, :])
+
+    def _get_top_k_mask_dense(self, this_block_weights):
+        """
+        :param this_block_weights:  dense array with one row per column of the block
+        :return:                    boolean mask of the TopK nonzero values of each row
+        """
+
+        # Do not add zeros. The columns with at most TopK nonzeros keep all of them, unless some are negative
+        # and rank after the zeros, the TopK of the others are selected with a single partition over the whole block
+        top_k_mask = this_block_weights != 0.0
+        is_over_top_k = (np.count_nonzero(top_k_mask, axis=1) > self.TopK) | np.any(this_block_weights < 0.0, axis=1)
+
+        if np.any(is_over_top_k):
+            over_top_k_weights = this_block_weights[is_over_top_k]
+            top_k_idx = np.argpartition(-over_top_k_weights, self.TopK - 1, axis=1)[:, :self.TopK]
+
+            over_top_k_mask = np.zeros_like(top_k_mask[is_over_top_k])
+            np.put_along_axis(over_top_k_mask, top_k_idx, True, axis=1)
+
+            # The TopK may include zeros when the column has few positive values
+            top_k_mask[is_over_top_k] = over_top_k_mask & (over_top_k_weights != 0.0)
+
+        return top_k_mask
+
+    def _get_top_k_dense(self, this_block_weights):
+        """
+        Selects the TopK of each row with a single partition of the whole block. The negative values rank after the
+        zeros, which are not kept, so they are selected only in the rows with less than TopK non negative values
+        :param this_block_weights:  dense array with one row per column of the block
+        :return:                    block column and index of the TopK nonzero values of each row, ordered by both
+        """
+
+        n_block_columns, n_values = this_block_weights.shape
+
+        if n_values <= self.TopK:
+            return np.nonzero(this_block_weights)
+
+        top_k_idx = np.argpartition(-this_block_weights, self.TopK - 1, axis=1)[:, :self.TopK]
+        top_k_idx.sort(axis=1)
+
+        is_nonzero = np.take_along_axis(this_block_weights, top_k_idx, axis=1) != 0.0
+
+        return np.nonzero(is_nonzero)[0], top_k_idx[is_nonzero]
+
+    def _get_top_k_mask_triplets(self, column_index, values, n_columns):
+        """
+        :param column_index:    column of each value of a matrix given as triplets
+        :param values:
+        :param n_columns:
+        :return:                boolean mask of the TopK nonzero values of each column
+        """
+
+        # Rank the values of each column by decreasing similarity
+        rank_in_column, column_nnz = _rank_in_columns(column_index, values, n_columns)
+
+        # The negative values rank after the zeros of the column, which are not in the triplets
+        is_negative = values < 0.0
+        rank_in_column[is_negative] += (self.n_columns - column_nnz)[column_index[is_negative]]
+
+        # The products that cancel out are not added
+        return (rank_in_column < self.TopK) & (values != 0.0)
+
+    def _compute_block_top_k_dense(self, start_col_block, end_col_block):
+        """
+        Computes the TopK of the columns in the block from the dense similarity of the block with all the columns
+        :return:    block column, row and value of the selected similarities, ordered by block column and row
+        """
+
+        this_block_weights, ranking_weights_list = self._get_ranking_weights_list(
+            self._compute_block_dot_products(start_col_block, end_col_block),
+            np.arange(start_col_block, end_col_block)[:, np.newaxis], np.arange(self.n_columns)[np.newaxis, :])
+
+        if len(ranking_weights_list) == 1:
+            block_column_index, row_index = self._get_top_k_dense(ranking_weights_list[0])
+
+        else:
+            top_k_mask = self._get_top_k_mask_dense(ranking_weights_list[0])
+
+            for ranking_weights in ranking_weights_list[1:]:
+                top_k_mask |= self._get_top_k_mask_dense(ranking_weights)
+
+            # Row-major order gives the data points ordered by column and then by row index
+            block_column_index, row_index = np.nonzero(top_k_mask)
+
+        return block_column_index, row_index, this_block_weights[block_column_index, row_index]
+
+    def _compute_block_top_k_sparse(self, start_col_block, end_col_block):
+        """
+        Computes the TopK of the columns in the block with a sparse product, for data so sparse that most similarities
+        are zero. Only the nonzero similarities are normalized and ranked
+        :return:    block column, row and value of the selected similarities, ordered by block column and row
+        """
+
+        item_data = self.dataMatrix[:, start_col_block:end_col_block]
+
+        # Same product as the dense block, in CSC the nonzeros are grouped by column of the block and sorted by row
+        this_block_weights = self._get_product_matrix().T.dot(item_data).tocsc()
+
+        block_column_index = np.repeat(np.arange(end_col_block - start_col_block, dtype=np.int32),
+                                       np.diff(this_block_weights.indptr))
+        row_index = this_block_weights.indices
+
+        # The similarity of each item with itself is not considered
+        is_not_diagonal = row_index != block_column_index + start_col_block
+
+        block_column_index = block_column_index[is_not_diagonal]
+        row_index = row_index[is_not_diagonal]
+
+        values, ranking_weights_list = self._get_ranking_weights_list(this_block_weights.data[is_not_diagonal],
+                                                                      block_column_index + start_col_block, row_index)
+
+        top_k_mask = np.zeros(len(values), dtype=np.bool_)
+
+        for ranking_weights in ranking_weights_list:
+            top_k_mask |= self._get_top_k_mask_triplets(block_column_index, ranking_weights,
+                                                        end_col_block - start_col_block)
+
+        return block_column_index[top_k_mask], row_index[top_k_mask], values[top_k_mask]
+
+    def _get_column_product_size(self, start_col, end_col):
+        """
+        Number of multiplications of the product of each column with all the others,
+        which bounds the number of its nonzero similarities
+        :param start_col:
+        :param end_col:
+        :return:
+        """
+
+        row_nnz = np.bincount(self.dataMatrix.indices, minlength=self.n_rows)
+
+        indptr = self.dataMatrix.indptr[start_col:end_col + 1].astype(np.int64) - self.dataMatrix.indptr[start_col]
+
+        product_size_cumsum = np.zeros(indptr[-1] + 1, dtype=np.int64)
+        np.cumsum(row_nnz[self.dataMatrix.indices[self.dataMatrix.indptr[start_col]:self.dataMatrix.indptr[end_col]]],
+                  out=product_size_cumsum[1:])
+
+        return product_size_cumsum[indptr[1:]] - product_size_cumsum[indptr[:-1]]
+
+    def _get_column_bytes(self, start_col, end_col):
+        """
+        Chooses between the dense and the sparse product and estimates the memory needed by each column of the range
+        :param start_col:
+        :param end_col:
+        :return:            whether to use the sparse product, bytes of each column and the estimated density of the similarity
+        """
+
+        n_columns_in_range = end_col - start_col
+
+        column_product_size = self._get_column_product_size(start_col, end_col)
+        estimated_density = min(1.0, column_product_size.sum() / max(1, n_columns_in_range * self.n_columns))
+
+        use_sparse_product = estimated_density <= self.sparse_density_threshold
+
+        if use_sparse_product:
+            column_bytes = (column_product_size + 1) * self._SPARSE_BYTES_PER_VALUE
+        else:
+            # The dense data of the column plus one row of the similarity block
+            column_bytes = np.full(n_columns_in_range,
+                                   self.n_rows * self.dataMatrix.dtype.itemsize + self.n_columns * self._DENSE_BYTES_PER_VALUE,
+                                   dtype=np.int64)
+
+        return use_sparse_product, column_bytes, estimated_density
+
+    def _plan_blocks(self, start_col, end_col, block_size=None, memory_budget_bytes=None, min_n_blocks=1):
+        """
+        Chooses between the dense and the sparse product and splits [start_col, end_col) into blocks that fit in
+        the memory budget. The sparse product is used when the estimated fraction of nonzero similarities is
+        below sparse_density_threshold, its blocks are sized on the number of multiplications of each column
+        :param start_col:
+        :param end_col:
+        :param block_size:          if given, fixed number of columns per block
+        :param memory_budget_bytes: if None the one of the object
+        :param min_n_blocks:        split the range in at least this many blocks, to share them among the workers
+        :return:                    whether to use the sparse product, list of (start, end) of the blocks
+                                    and the estimated density of the similarity
+        """
+
+        if memory_budget_bytes is None:
+            memory_budget_bytes = self.memory_budget_bytes
+
+        n_columns_in_range = end_col - start_col
+
+        use_sparse_product, column_bytes, estimated_density = self._get_column_bytes(start_col, end_col)
+
+        max_block_columns = int(np.ceil(n_columns_in_range / max(1, min_n_blocks)))
+
+        if block_size is not None:
+            max_block_columns = min(max_block_columns, block_size)
+            memory_budget_bytes = np.inf
+
+        column_bytes_cumsum = np.cumsum(column_bytes)
+
+        block_list = []
+        start_col_block = 0
+
+        while start_col_block < n_columns_in_range:
+
+            previous_bytes = column_bytes_cumsum[start_col_block - 1] if start_col_block > 0 else 0
+
+            # At least one column per block, even if it alone exceeds the budget
+            end_col_block = np.searchsorted(column_bytes_cumsum, previous_bytes + memory_budget_bytes, side='right')
+            end_col_block = int(min(max(end_col_block, start_col_block + 1), start_col_block + max_block_columns))
+
+            block_list.append((start_col + start_col_block, start_col + end_col_block))
+            start_col_block = end_col_block
+
+        return use_sparse_product, block_list, estimated_density
+
+    def _compute_column_range(self, block_list, use_sparse_product, verbose=True):
+        """
+        Computes the TopK most similar items of each column in a list of consecutive blocks of columns
+        :param block_list:          list of (start, end) of the blocks, see _plan_blocks
+        :param use_sparse_product:
+        :param verbose:
+        :return:                    values, row indices and number of nonzeros of each column, in column order
+        """
+
+        start_col = block_list[0][0]
+        end_col = block_list[-1][1]
+
+        n_columns_in_range = end_col - start_col
+
+        # Each column has at most TopK nonzeros for each ranking, the buffers are filled in place without intermediate lists
+        n_rankings = 1 if self._base_ranking_shrink_list is None else len(self._base_ranking_shrink_list)
+
+        values = np.zeros(n_columns_in_range * self.TopK * n_rankings, dtype=np.float32)
+        rows = np.zeros(n_columns_in_range * self.TopK * n_rankings, dtype=np.int32)
+        column_nnz = np.zeros(n_columns_in_range, dtype=np.int32)
+
+        n_values = 0
+
+        start_time = time.time()
+        start_time_print_batch = start_time
+        processedItems = 0
+
+        compute_block_top_k = self._compute_block_top_k_sparse if use_sparse_product else self._compute_block_top_k_dense
+
+        # Compute all similarities for each item using vectorization
+        for start_col_block, end_col_block in block_list:
+
+            this_block_size = end_col_block - start_col_block
+
+            block_column_index, block_row_index, block_values = compute_block_top_k(start_col_block, end_col_block)
+            block_nnz = len(block_row_index)
+
+            values[n_values:n_values + block_nnz] = block_values
+            rows[n_values:n_values + block_nnz] = block_row_index
+            column_nnz[start_col_block - start_col:end_col_block - start_col] = np.bincount(block_column_index,
+                                                                                            minlength=this_block_size)
+
+            n_values += block_nnz
+
+            # Add previous block size
+            processedItems += this_block_size
+
+            if verbose and (time.time() - start_time_print_batch >= 30 or end_col_block == end_col):
+                columnPerSec = processedItems / (time.time() - start_time + 1e-9)
+
+                print("Similarity column {} ( {:2.0f} % ), {:.2f} column/sec, elapsed time {:.2f} min".format(
+                    processedItems, processedItems / n_columns_in_range * 100, columnPerSec,
+                                    (time.time() - start_time) / 60))
+
+                sys.stdout.flush()
+                sys.stderr.flush()
+
+                start_time_print_batch = time.time()
+
+        return values[:n_values], rows[:n_values], column_nnz
+
+    def _is_symmetric(self):
+        """
+        The similarity of i with j is the same as the one of j with i for all the similarities except the asymmetric
+        cosine and the tversky with different alpha and beta. The row weights are applied to the data before the
+        transformation of the similarity, the product of the weighted and transformed data is symmetric only for cosine
+        """
+
+        if self.asymmetric_cosine or (self.tversky_coefficient and self.tversky_alpha != self.tversky_beta):
+            return False
+
+        return not self.use_row_weights or not (self.adjusted_cosine or self.pearson_correlation or self.tanimoto_coefficient or
+                                                self.dice_coefficient or self.tversky_coefficient)
+
+    def _compute_block_upper_dense(self, start_col_block, end_col_block):
+        """
+        Computes the similarity of the columns in [start_col_block, end_col_block) with the columns from start_col_block on
+        :return:    dense array of shape (end_col_block - start_col_block, n_columns - start_col_block)
+        """
+
+        item_data = self.dataMatrix[:, start_col_block:end_col_block].toarray()
+
+        this_block_weights = self._get_product_matrix()[:, start_col_block:].T.dot(item_data)
+        this_block_weights = np.ascontiguousarray(this_block_weights.T)
+
+        # The similarity of each item with itself is not considered
+        block_columns = np.arange(end_col_block - start_col_block)
+        this_block_weights[block_columns, block_columns] = 0.0
+
+        return self._normalize_weights(this_block_weights, np.arange(start_col_block, end_col_block)[:, np.newaxis],
+                                       np.arange(start_col_block, self.n_columns)[np.newaxis, :])
+
+    def _compute_block_upper_sparse(self, start_col_block, end_col_block):
+        """
+        Computes with a sparse product the similarity of the columns in [start_col_block, end_col_block)
+        with the columns from start_col_block on
+        :return:    block column, other column and value of the nonzero similarities
+        """
+
+        item_data = self.dataMatrix[:, start_col_block:end_col_block]
+
+        this_block_weights = self._get_product_matrix()[:, start_col_block:].T.dot(item_data).tocsc()
+
+        block_column_index = np.repeat(np.arange(end_col_block - start_col_block, dtype=np.int32),
+                                       np.diff(this_block_weights.indptr))
+        other_column_index = this_block_weights.indices + start_col_block
+
+        # The similarity of each item with itself is not considered
+        is_not_diagonal = other_column_index != block_column_index + start_col_block
+
+        block_column_index = block_column_index[is_not_diagonal]
+        other_column_index = other_column_index[is_not_diagonal]
+
+        values = self._normalize_weights(this_block_weights.data[is_not_diagonal],
+                                         block_column_index + start_col_block, other_column_index)
+
+        return block_column_index, other_column_index, values
+
+    def _merge_candidates(self, candidate_values, candidate_rows, column_index, new_column_index, new_values, new_rows):
+        """
+        Merges new positive candidates into the TopK candidates kept for the given columns
+        :param candidate_values:    array of shape (n_columns, TopK), zero where a column has fewer candidates
+        :param candidate_rows:
+        :param column_index:        columns receiving the new candidates
+        :param new_column_index:    position in column_index of the column of each new candidate, grouped by column
+        :param new_values:
+        :param new_rows:
+        :return:
+        """
+
+        # Each column is merged with its few new candidates, padded to the largest number of them
+        column_n_new = np.bincount(new_column_index, minlength=len(column_index))
+        new_position = np.arange(len(new_values)) - np.repeat(np.cumsum(column_n_new) - column_n_new, column_n_new)
+
+        merged_values = np.zeros((len(column_index), self.TopK + column_n_new.max()), dtype=np.float32)
+        merged_rows = np.zeros(merged_values.shape, dtype=np.int32)
+
+        merged_values[:, :self.TopK] = candidate_values[column_index]
+        merged_rows[:, :self.TopK] = candidate_rows[column_index]
+
+        merged_values[new_column_index, self.TopK + new_position] = new_values
+        merged_rows[new_column_index, self.TopK + new_position] = new_rows
+
+        top_k_idx = np.argpartition(-merged_values, self.TopK - 1, axis=1)[:, :self.TopK]
+
+        candidate_values[column_index] = np.take_along_axis(merged_values, top_k_idx, axis=1)
+        candidate_rows[column_index] = np.take_along_axis(merged_rows, top_k_idx, axis=1)
+
+    def _compute_column_range_symmetric(self, block_list, use_sparse_product, verbose=True):
+        """
+        Computes the TopK most similar items of each column in [0, end_col) for a symmetric similarity. Each block is
+        multiplied only with itself and the following columns: its values are the similarities of the block columns,
+        whose TopK are selected among them and the candidates passed by the previous blocks, and of the following
+        columns, which receive as candidates the values above the smallest of their current TopK
+        :param block_list:          list of (start, end) of the blocks starting from column 0, see _plan_blocks
+        :param use_sparse_product:
+        :param verbose:
+        :return:                    values, row indices and number of nonzeros of each column, in column order
+        """
+
+        end_col = block_list[-1][1]
+
+        # The running TopK positive candidates of each column, zero where there are fewer, and the smallest of them
+        candidate_values = np.zeros((end_col, self.TopK), dtype=np.float32)
+        candidate_rows = np.zeros((end_col, self.TopK), dtype=np.int32)
+        candidate_threshold = np.zeros(end_col, dtype=np.float32)
+
+        # The negative values rank after the zeros, they are in the TopK only of the columns with less than TopK
+        # non negative values, which are counted and recomputed without symmetry
+        can_be_negative = self.dataMatrix.data.min(initial=0.0) < 0.0 or self._get_product_matrix().data.min(initial=0.0) < 0.0
+        column_n_negative = np.zeros(end_col, dtype=np.int64)
+
+        values = np.zeros(end_col * self.TopK, dtype=np.float32)
+        rows = np.zeros(end_col * self.TopK, dtype=np.int32)
+        column_nnz = np.zeros(end_col, dtype=np.int32)
+
+        n_values = 0
+
+        start_time = time.time()
+        start_time_print_batch = start_time
+        processedItems = 0
+
+        for start_col_block, end_col_block in block_list:
+
+            this_block_size = end_col_block - start_col_block
+
+            if use_sparse_product:
+                block_column_index, other_column_index, block_weights = self._compute_block_upper_sparse(start_col_block,
+                                                                                                        end_col_block)
+
+                # The values of the following columns, as candidates of their TopK
+                is_candidate = (other_column_index >= end_col_block) & (other_column_index < end_col)
+                is_candidate[is_candidate] = block_weights[is_candidate] > candidate_threshold[other_column_index[is_candidate]]
+
+                candidate_column, candidate_column_index = np.unique(other_column_index[is_candidate], return_inverse=True)
+
+                if len(candidate_column) > 0:
+                    # The candidates are ordered by block column, group them by the column they are passed to
+                    ranking = np.argsort(candidate_column_index, kind="stable")
+
+                    self._merge_candidates(candidate_values, candidate_rows, candidate_column,
+                                           candidate_column_index[ranking], block_weights[is_candidate][ranking],
+                                           block_column_index[is_candidate][ranking] + start_col_block)
+
+                    candidate_threshold[candidate_column] = candidate_values[candidate_column].min(axis=1)
+
+                if can_be_negative:
+                    is_negative = block_weights < 0.0
+                    is_following_negative = is_negative & (other_column_index >= end_col_block) & (other_column_index < end_col)
+
+                    column_n_negative[start_col_block:end_col_block] += np.bincount(block_column_index[is_negative],
+                                                                                    minlength=this_block_size)
+                    column_n_negative += np.bincount(other_column_index[is_following_negative], minlength=end_col)
+
+                # The TopK of the block columns among their values with the following columns and their candidates
+                block_candidate_values = candidate_values[start_col_block:end_col_block]
+                is_block_candidate = block_candidate_values > 0.0
+
+                block_column_index = np.concatenate((np.nonzero(is_block_candidate)[0], block_column_index))
+                other_column_index = np.concatenate((candidate_rows[start_col_block:end_col_block][is_block_candidate],
+                                                     other_column_index))
+                block_weights = np.concatenate((block_candidate_values[is_block_candidate], block_weights))
+
+                top_k_mask = self._get_top_k_mask_triplets(block_column_index, block_weights, this_block_size)
+
+            else:
+                this_block_weights = self._compute_block_upper_dense(start_col_block, end_col_block)
+
+                # The values of the following columns, as candidates of their TopK
+                following_weights = this_block_weights[:, this_block_size:end_col - start_col_block]
+                is_candidate = following_weights > candidate_threshold[np.newaxis, end_col_block:]
+
+                candidate_column = np.flatnonzero(is_candidate.any(axis=0))
+
+                if len(candidate_column) > 0:
+                    # Scanning the transposed block groups the candidates by the column they are passed to
+                    candidate_column_index, candidate_block_column = np.nonzero(is_candidate[:, candidate_column].T)
+
+                    self._merge_candidates(candidate_values, candidate_rows, candidate_column + end_col_block,
+                                           candidate_column_index,
+                                           following_weights[candidate_block_column, candidate_column[candidate_column_index]],
+                                           candidate_block_column + start_col_block)
+
+                    candidate_threshold[candidate_column + end_col_block] = \
+                        candidate_values[candidate_column + end_col_block].min(axis=1)
+
+                if can_be_negative:
+                    is_negative = this_block_weights < 0.0
+                    column_n_negative[start_col_block:end_col_block] += np.count_nonzero(is_negative, axis=1)
+                    column_n_negative[end_col_block:] += np.count_nonzero(is_negative[:, this_block_size:end_col - start_col_block], axis=0)
+
+                # The TopK of the block columns among their values with the following columns and their candidates
+                block_weights = np.concatenate((candidate_values[start_col_block:end_col_block], this_block_weights), axis=1)
+
+                # The first TopK positions are the candidates, the others the columns from start_col_block on
+                block_column_index, position = self._get_top_k_dense(block_weights)
+                block_weights = block_weights[block_column_index, position]
+
+                is_candidate = position < self.TopK
+                other_column_index = position - self.TopK + start_col_block
+                other_column_index[is_candidate] = candidate_rows[block_column_index[is_candidate] + start_col_block,
+                                                                  position[is_candidate]]
+
+                top_k_mask = np.ones(len(block_weights), dtype=np.bool_)
+
+            # Order the selected similarities by block column and row
+            block_column_index = block_column_index[top_k_mask]
+            block_row_index = other_column_index[top_k_mask]
+            block_values = block_weights[top_k_mask]
+
+            ranking = np.lexsort((block_row_index, block_column_index))
+            block_nnz = len(ranking)
+
+            values[n_values:n_values + block_nnz] = block_values[ranking]
+            rows[n_values:n_values + block_nnz] = block_row_index[ranking]
+            column_nnz[start_col_block:end_col_block] = np.bincount(block_column_index, minlength=this_block_size)
+
+            n_values += block_nnz
+
+            processedItems += this_block_size
+
+            if verbose and (time.time() - start_time_print_batch >= 30 or end_col_block == end_col):
+                columnPerSec = processedItems / (time.time() - start_time + 1e-9)
+
+                print("Similarity column {} ( {:2.0f} % ), {:.2f} column/sec, elapsed time {:.2f} min".format(
+                    processedItems, processedItems / end_col * 100, columnPerSec, (time.time() - start_time) / 60))
+
+                sys.stdout.flush()
+                sys.stderr.flush()
+
+                start_time_print_batch = time.time()
+
+        values, rows = values[:n_values], rows[:n_values]
+
+        has_negative_in_top_k = self.n_columns - column_n_negative < self.TopK
+
+        if np.any(has_negative_in_top_k):
+            values, rows, column_nnz = self._recompute_columns(values, rows, column_nnz, np.flatnonzero(has_negative_in_top_k),
+                                                               use_sparse_product)
+
+        return values, rows, column_nnz
+
+    def _recompute_columns(self, values, rows, column_nnz, column_list, use_sparse_product):
+        """
+        Replaces the TopK of the given columns with the ones computed column by column without symmetry
+        :return:    values, row indices and number of nonzeros of each column, in column order
+        """
+
+        compute_block_top_k = self._compute_block_top_k_sparse if use_sparse_product else self._compute_block_top_k_dense
+
+        column_index = np.repeat(np.arange(len(column_nnz), dtype=np.int32), column_nnz)
+        is_kept = ~np.isin(column_index, column_list)
+
+        column_index_list, rows_list, values_list = [column_index[is_kept]], [rows[is_kept]], [values[is_kept]]
+
+        for column in column_list:
+            _, column_rows, column_values = compute_block_top_k(column, column + 1)
 
-        blockSize = 1000
+            column_index_list.append(np.full(len(column_rows), column, dtype=np.int32))
+            rows_list.append(column_rows)
+            values_list.append(column_values)
 
-        while end_row < self.n_rows:
-            end_row = min(self.n_rows, end_row + blockSize)
+        column_index = np.concatenate(column_index_list)
+        rows = np.concatenate(rows_list)
+        values = np.concatenate(values_list)
 
-            self.dataMatrix.data[self.dataMatrix.indptr[start_row]:self.dataMatrix.indptr[end_row]] -= \
-                np.repeat(rowAverage[start_row:end_row], interactionsPerRow[start_row:end_row])
+        ranking = np.lexsort((rows, column_index))
 
-            start_row += blockSize
+        return values[ranking], rows[ranking], np.bincount(column_index, minlength=len(column_nnz)).astype(np.int32)
 
-    def applyPearsonCorrelation(self):
+    def _get_shared_matrix_attributes(self):
+        return ["dataMatrix", "dataMatrix_weighted"] if self.use_row_weights else ["dataMatrix"]
+
+    def _compute_column_range_parallel(self, block_list, use_sparse_product, n_ranges):
         """
-        Remove from every data point the average for the corresponding column
-        :return:
+        Computes the TopK most similar items of each column in a list of consecutive blocks of columns with a pool
+        of n_workers processes. The prepared data is copied once in shared memory, which all the workers read,
+        and each worker receives ranges of consecutive blocks and returns their TopK
+        :param block_list:          list of (start, end) of the blocks, see _plan_blocks
+        :param use_sparse_product:
+        :param n_ranges:            number of ranges the blocks are divided into
+        :return:                    values, row indices and number of nonzeros of each column, in column order
         """
 
-        self.dataMatrix = check_matrix(self.dataMatrix, 'csc')
+        n_columns_in_range = block_list[-1][1] - block_list[0][0]
 
-        interactionsPerCol = np.diff(self.dataMatrix.indptr)
+        column_range_list = [(block_list[range_block_index[0]:range_block_index[-1] + 1], use_sparse_product)
+                             for range_block_index in np.array_split(np.arange(len(block_list)), n_ranges)
+                             if len(range_block_index) > 0]
 
-        nonzeroCols = interactionsPerCol > 0
-        sumPerCol = np.asarray(self.dataMatrix.sum(axis=0)).ravel()
+        shared_matrix_attributes = self._get_shared_matrix_attributes()
+        similarity_state = {attribute_name: attribute_value for attribute_name, attribute_value in self.__dict__.items()
+                            if attribute_name not in shared_matrix_attributes}
 
-        colAverage = np.zeros_like(sumPerCol)
-        colAverage[nonzeroCols] = sumPerCol[nonzeroCols] / interactionsPerCol[nonzeroCols]
+        n_blas_threads = max(1, multiprocessing.cpu_count() // self.n_workers)
 
-        # Split in blocks to avoid duplicating the whole data structure
-        start_col = 0
-        end_col = 0
+        shared_memory_list = []
+        shared_matrix_dict = {}
 
-        blockSize = 1000
+        previous_env_variables = {env_variable: os.environ.get(env_variable) for env_variable in _BLAS_THREADS_ENV_VARIABLES}
 
-        while end_col < self.n_columns:
-            end_col = min(self.n_columns, end_col + blockSize)
+        try:
+            for attribute_name in shared_matrix_attributes:
 
-            self.dataMatrix.data[self.dataMatrix.indptr[start_col]:self.dataMatrix.indptr[end_col]] -= \
-                np.repeat(colAverage[start_col:end_col], interactionsPerCol[start_col:end_col])
+                matrix = getattr(self, attribute_name)
 
-            start_col += blockSize
+                if matrix.format not in ["csr", "csc"]:
+                    matrix = matrix.tocsr()
 
-    def useOnlyBooleanInteractions(self):
+                array_descriptor_list = []
 
-        # Split in blocks to avoid duplicating the whole data structure
-        start_pos = 0
-        end_pos = 0
+                for array in [matrix.indptr, matrix.indices, matrix.data]:
+                    array_shared_memory, array_descriptor = _share_array(array)
+                    shared_memory_list.append(array_shared_memory)
+                    array_descriptor_list.append(array_descriptor)
 
-        blockSize = 1000
+                shared_matrix_dict[attribute_name] = (matrix.format, matrix.shape, array_descriptor_list)
 
-        while end_pos < len(self.dataMatrix.data):
-            end_pos = min(len(self.dataMatrix.data), end_pos + blockSize)
+            for env_variable in _BLAS_THREADS_ENV_VARIABLES:
+                os.environ[env_variable] = str(n_blas_threads)
 
-            self.dataMatrix.data[start_pos:end_pos] = np.ones(end_pos - start_pos)
+            start_time = time.time()
+            start_time_print_batch = start_time
+            processedItems = 0
 
-            start_pos += blockSize
+            result_list = []
 
-    def compute_similarity(self, start_col=None, end_col=None, block_size=100):
-        """
-        Compute the similarity for the given dataset
-        :param self:
-        :param start_col: column to begin with
-        :param end_col: column to stop before, end_col is excluded
-        :return:
-        """
+            # A forked worker inherits the BLAS already initialized by the parent, which ignores the environment
+            # variables. Spawned workers start a new interpreter and read them when they import numpy
+            with multiprocessing.get_context("spawn").Pool(processes=self.n_workers, initializer=_init_similarity_worker,
+                                                           initargs=(type(self), similarity_state, shared_matrix_dict,
+                                                                     n_blas_threads)) as pool:
 
-        values = []
-        rows = []
-        cols = []
+                for result in pool.imap_unordered(_compute_similarity_worker, column_range_list):
 
-        start_time = time.time()
-        start_time_print_batch = start_time
-        processedItems = 0
+                    result_list.append(result)
+                    processedItems += len(result[3])
 
-        if self.adjusted_cosine:
-            self.applyAdjustedCosine()
+                    if time.time() - start_time_print_batch >= 30 or processedItems == n_columns_in_range:
+                        columnPerSec = processedItems / (time.time() - start_time + 1e-9)
 
-        elif self.pearson_correlation:
-            self.applyPearsonCorrelation()
+                        print("Similarity column {} ( {:2.0f} % ), {:.2f} column/sec, elapsed time {:.2f} min, {} workers".format(
+                            processedItems, processedItems / n_columns_in_range * 100, columnPerSec,
+                                            (time.time() - start_time) / 60, self.n_workers))
 
-        elif self.tanimoto_coefficient or self.dice_coefficient or self.tversky_coefficient:
-            self.useOnlyBooleanInteractions()
+                        sys.stdout.flush()
+                        sys.stderr.flush()
 
-        # We explore the matrix column-wise
-        self.dataMatrix = check_matrix(self.dataMatrix, 'csc')
+                        start_time_print_batch = time.time()
 
-        # Compute sum of squared values to be used in normalization
-        sumOfSquared = np.array(self.dataMatrix.power(2).sum(axis=0)).ravel()
+        finally:
+            for env_variable, env_value in previous_env_variables.items():
+                if env_value is None:
+                    os.environ.pop(env_variable, None)
+                else:
+                    os.environ[env_variable] = env_value
 
-        # Tanimoto does not require the square root to be applied
-        if not (self.tanimoto_coefficient or self.dice_coefficient or self.tversky_coefficient):
-            sumOfSquared = np.sqrt(sumOfSquared)
+            for array_shared_memory in shared_memory_list:
+                array_shared_memory.close()
+                array_shared_memory.unlink()
 
-        if self.asymmetric_cosine:
-            sumOfSquared_to_1_minus_alpha = np.power(sumOfSquared, 2 * (1 - self.asymmetric_alpha))
-            sumOfSquared_to_alpha = np.power(sumOfSquared, 2 * self.asymmetric_alpha)
+        # Merge the ranges in column order
+        result_list.sort(key=lambda result: result[0])
 
-        self.dataMatrix = check_matrix(self.dataMatrix, 'csc')
+        values = np.concatenate([result[1] for result in result_list])
+        rows = np.concatenate([result[2] for result in result_list])
+        column_nnz = np.concatenate([result[3] for result in result_list])
+
+        return values, rows, column_nnz
+
+    def compute_similarity(self, start_col=None, end_col=None, block_size=None):
+        """
+        Compute the similarity for the given dataset
+        :param self:
+        :param start_col: column to begin with
+        :param end_col: column to stop before, end_col is excluded
+        :param block_size: number of columns computed at once, by default chosen from the memory budget
+        :return:
+        """
+
+        self._prepare_data()
 
         start_col_local = 0
         end_col_local = self.n_columns
@@ -225,115 +1150,131 @@ class Compute_Similarity_Python:
         if end_col is not None and end_col > start_col_local and end_col < self.n_columns:
             end_col_local = end_col
 
-        start_col_block = start_col_local
-
-        this_block_size = 0
-
-        # Compute all similarities for each item using vectorization
-        while start_col_block < end_col_local:
-
-            end_col_block = min(start_col_block + block_size, end_col_local)
-            this_block_size = end_col_block - start_col_block
-
-            # All data points for a given item
-            item_data = self.dataMatrix[:, start_col_block:end_col_block]
-            item_data = item_data.toarray().squeeze()
-
-            # If only 1 feature avoid last dimension to disappear
-            if item_data.ndim == 1:
-                item_data = np.atleast_2d(item_data)
-
-            if self.use_row_weights:
-                this_block_weights = self.dataMatrix_weighted.T.dot(item_data)
-
-            else:
-                # Compute item similarities => using dot product
-                this_block_weights = self.dataMatrix.T.dot(item_data)
-
-            for col_index_in_block in range(this_block_size):
+        # The symmetric computation passes the values of each block to the following columns, so it runs on a single
+        # process from the first column. The base of compute_raw_similarity is ranked on several values and does not use it
+        use_symmetry = self.use_symmetry and self._is_symmetric() and self._base_ranking_shrink_list is None and \
+                       start_col_local == 0 and self.n_workers == 1
+
+        # The budget is shared among the workers, each with a few ranges of blocks to balance the load
+        n_ranges = self.n_workers * 4 if self.n_workers > 1 else 1
+        memory_budget_bytes = self.memory_budget_bytes / self.n_workers
+
+        if use_symmetry:
+            # The running TopK candidates of each column, values and rows, are taken from the budget
+            candidate_bytes = end_col_local * self.TopK * 8
+            memory_budget_bytes = max(memory_budget_bytes - candidate_bytes, memory_budget_bytes / 4)
+
+        use_sparse_product, block_list, estimated_density = self._plan_blocks(start_col_local, end_col_local,
+                                                                              block_size=block_size,
+                                                                              memory_budget_bytes=memory_budget_bytes,
+                                                                              min_n_blocks=n_ranges)
+
+        print("Compute_Similarity_Python: {} product{}, {} blocks of up to {} columns, estimated similarity density {:.4f}, "
+              "memory budget {:.1f} MB".format("sparse" if use_sparse_product else "dense",
+                                               " exploiting symmetry" if use_symmetry and len(block_list) > 1 else "",
+                                               len(block_list),
+                                               max(end - start for start, end in block_list), estimated_density,
+                                               self.memory_budget_bytes / 2 ** 20))
+
+        # With a single block there are no following columns to pass the values to
+        if use_symmetry and len(block_list) > 1:
+            values, rows, column_nnz = self._compute_column_range_symmetric(block_list, use_sparse_product)
+
+        # Parallel only if there is more than one block of columns to share among the workers
+        elif self.n_workers > 1 and len(block_list) > 1:
+            values, rows, column_nnz = self._compute_column_range_parallel(block_list, use_sparse_product, n_ranges)
+        else:
+            values, rows, column_nnz = self._compute_column_range(block_list, use_sparse_product)
 
-                if this_block_size == 1:
-                    this_column_weights = this_block_weights
-                else:
-                    this_column_weights = this_block_weights[:, col_index_in_block]
+        # The columns outside of the range are empty
+        indptr = np.zeros(self.n_columns + 1, dtype=np.int32)
+        indptr[start_col_local + 1:end_col_local + 1] = np.cumsum(column_nnz)
+        indptr[end_col_local + 1:] = indptr[end_col_local]
 
-                columnIndex = col_index_in_block + start_col_block
-                this_column_weights[columnIndex] = 0.0
+        W_sparse = sps.csc_matrix((values, rows, indptr), shape=(self.n_columns, self.n_columns), dtype=np.float32)
 
-                # Apply normalization and shrinkage, ensure denominator != 0
-                if self.normalize:
+        return W_sparse.tocsr()
 
-                    if self.asymmetric_cosine:
-                        denominator = sumOfSquared_to_alpha[
-                                          columnIndex] * sumOfSquared_to_1_minus_alpha + self.shrink + 1e-6
-                    else:
-                        denominator = sumOfSquared[columnIndex] * sumOfSquared + self.shrink + 1e-6
+    def compute_raw_similarity(self, block_size=None, ranking_shrink_list=(None, 0)):
+        """
+        Computes the dot products of the columns after the transformation required by the similarity, without
+        normalization or shrink. Together with the column norms they are the base from which
+        compute_similarity_from_base derives the similarity for any smaller TopK, shrink and normalize.
+        Each column keeps the union of its TopK values ranked by each entry of ranking_shrink_list, None ranks on the
+        dot products, which is the order of the large shrink values, and a number on the similarity with that shrink
+        :param block_size:
+        :param ranking_shrink_list:
+        :return:            W_base, sumOfSquared
+        """
 
-                    this_column_weights = np.multiply(this_column_weights, 1 / denominator)
+        self._base_ranking_shrink_list = list(ranking_shrink_list)
 
+        try:
+            W_base = self.compute_similarity(block_size=block_size)
+        finally:
+            self._base_ranking_shrink_list = None
 
-                # Apply the specific denominator for Tanimoto
-                elif self.tanimoto_coefficient:
-                    denominator = sumOfSquared[columnIndex] + sumOfSquared - this_column_weights + self.shrink + 1e-6
-                    this_column_weights = np.multiply(this_column_weights, 1 / denominator)
+        return W_base, self.sumOfSquared.copy()
 
-                elif self.dice_coefficient:
-                    denominator = sumOfSquared[columnIndex] + sumOfSquared + self.shrink + 1e-6
-                    this_column_weights = np.multiply(this_column_weights, 1 / denominator)
+    def compute_similarity_from_base(self, W_base, sumOfSquared):
+        """
+        Derives the similarity from the output of compute_raw_similarity for the same data, similarity type and row
+        weights, renormalizing its values and pruning them to TopK. The result is the same as compute_similarity as
+        long as the TopK of each column are among the values kept in the base, which holds whenever the base kept all
+        the nonzero products of the column
+        :param W_base:
+        :param sumOfSquared:
+        :return:
+        """
 
-                elif self.tversky_coefficient:
-                    denominator = this_column_weights + \
-                                  (sumOfSquared[columnIndex] - this_column_weights) * self.tversky_alpha + \
-                                  (sumOfSquared - this_column_weights) * self.tversky_beta + self.shrink + 1e-6
-                    this_column_weights = np.multiply(this_column_weights, 1 / denominator)
+        assert W_base.shape == (self.n_columns, self.n_columns), \
+            "Compute_Similarity_Python: base shape {} does not match the number of columns {}".format(W_base.shape,
+                                                                                                   self.n_columns)
 
-                # If no normalization or tanimoto is selected, apply only shrink
-                elif self.shrink != 0:
-                    this_column_weights = this_column_weights / self.shrink
+        self._set_sum_of_squared(sumOfSquared)
 
-                # this_column_weights = this_column_weights.toarray().ravel()
+        W_base = sps.csc_matrix(W_base)
+        W_base.sort_indices()
 
-                # Sort indices and select TopK
-                # Sorting is done in three steps. Faster then plain np.argsort for higher number of items
-                # - Partition the data to extract the set of relevant items
-                # - Sort only the relevant items
-                # - Get the original item index
-                relevant_items_partition = (-this_column_weights).argpartition(self.TopK - 1)[0:self.TopK]
-                relevant_items_partition_sorting = np.argsort(-this_column_weights[relevant_items_partition])
-                top_k_idx = relevant_items_partition[relevant_items_partition_sorting]
+        column_nnz = np.diff(W_base.indptr)
+        column_index = np.repeat(np.arange(self.n_columns, dtype=np.int32), column_nnz)
+        values = self._normalize_weights(W_base.data, column_index, W_base.indices)
 
-                # Incrementally build sparse matrix, do not add zeros
-                notZerosMask = this_column_weights[top_k_idx] != 0.0
-                numNotZeros = np.sum(notZerosMask)
+        # The negative values rank after the zeros of the column, only the columns with less than TopK
+        # non negative values keep some of them. Their TopK are selected by ranking their triplets
+        is_negative = values < 0.0
+        has_negative_in_top_k = self.n_columns - np.bincount(column_index[is_negative], minlength=self.n_columns) < self.TopK
 
-                values.extend(this_column_weights[top_k_idx][notZerosMask])
-                rows.extend(top_k_idx[notZerosMask])
-                cols.extend(np.ones(numNotZeros) * columnIndex)
+        # The columns of the base are short, the TopK positive values are selected with a partition over a
+        # (n_columns, longest column) array, where the other values and the missing ones are padded after them
+        position_in_column = np.arange(len(values)) - np.repeat(W_base.indptr[:-1], column_nnz)
 
-            # Add previous block size
-            processedItems += this_block_size
+        ranking_key = np.full((self.n_columns, max(1, column_nnz.max(initial=0))), np.inf, dtype=np.float32)
+        ranking_key[column_index, position_in_column] = np.where(values > 0.0, -values, np.inf)
 
-            if time.time() - start_time_print_batch >= 30 or end_col_block == end_col_local:
-                columnPerSec = processedItems / (time.time() - start_time + 1e-9)
+        is_top_k = np.ones(ranking_key.shape, dtype=np.bool_)
 
-                print("Similarity column {} ( {:2.0f} % ), {:.2f} column/sec, elapsed time {:.2f} min".format(
-                    processedItems, processedItems / (end_col_local - start_col_local) * 100, columnPerSec,
-                                    (time.time() - start_time) / 60))
+        if ranking_key.shape[1] > self.TopK:
+            is_top_k[:] = False
+            top_k_position = np.argpartition(ranking_key, self.TopK - 1, axis=1)[:, :self.TopK]
+            np.put_along_axis(is_top_k, top_k_position, True, axis=1)
 
-                sys.stdout.flush()
-                sys.stderr.flush()
+        is_kept = is_top_k[column_index, position_in_column] & (values > 0.0)
 
-                start_time_print_batch = time.time()
+        if np.any(has_negative_in_top_k):
+            is_in_column_with_negative = has_negative_in_top_k[column_index]
 
-            start_col_block += block_size
+            is_kept[is_in_column_with_negative] = self._get_top_k_mask_triplets(column_index[is_in_column_with_negative],
+                                                                                values[is_in_column_with_negative],
+                                                                                self.n_columns)
 
-        # End while on columns
+        indptr = np.zeros(self.n_columns + 1, dtype=np.int32)
+        indptr[1:] = np.cumsum(np.bincount(column_index[is_kept], minlength=self.n_columns))
 
-        W_sparse = sps.csr_matrix((values, (rows, cols)),
-                                  shape=(self.n_columns, self.n_columns),
-                                  dtype=np.float32)
+        W_sparse = sps.csc_matrix((values[is_kept], W_base.indices[is_kept], indptr),
+                                  shape=(self.n_columns, self.n_columns), dtype=np.float32)
 
-        return W_sparse
+        return W_sparse.tocsr()
 
 
 def similarityMatrixTopK(item_weights, forceSparseOutput=True, k=100, verbose=False, inplace=True):
@@ -363,59 +1304,56 @@ def similarityMatrixTopK(item_weights, forceSparseOutput=True, k=100, verbose=Fa
 
     if not sparse_weights:
 
-        idx_sorted = np.argsort(item_weights, axis=0)  # sort data inside each column
-
-        if inplace:
-            W = item_weights
-        else:
-            W = item_weights.copy()
-
-        # index of the items that don't belong to the top-k similar items of each column
-        not_top_k = idx_sorted[:-k, :]
-        # use numpy fancy indexing to zero-out the values in sim without using a for loop
-        W[not_top_k, np.arange(nitems)] = 0.0
+        # index of the top-k items of each column, partitioning the columns instead of sorting them
+        top_k_rows = np.argpartition(-item_weights, k - 1, axis=0)[:k, :]
+        top_k_cols = np.broadcast_to(np.arange(nitems), top_k_rows.shape)
 
         if forceSparseOutput:
-            W_sparse = sps.csr_matrix(W, shape=(nitems, nitems))
+            # The CSR matrix is built from the top-k values only, the other ones are never read
+            W_sparse = sps.csr_matrix((item_weights[top_k_rows, top_k_cols].ravel(),
+                                       (top_k_rows.ravel(), top_k_cols.ravel())),
+                                      shape=(nitems, nitems))
+            W_sparse.eliminate_zeros()
 
             if verbose:
                 print("Sparse TopK matrix generated in {:.2f} seconds".format(time.time() - start_time))
 
             return W_sparse
 
+        if inplace:
+            W = item_weights
+        else:
+            W = item_weights.copy()
+
+        top_k_mask = np.zeros(W.shape, dtype=np.bool_)
+        top_k_mask[top_k_rows, top_k_cols] = True
+
+        # use numpy boolean indexing to zero-out the values in sim without using a for loop
+        W[~top_k_mask] = 0.0
+
         if verbose:
             print("Dense TopK matrix generated in {:.2f} seconds".format(time.time() - start_time))
 
         return W
 
     else:
-        # iterate over each column and keep only the top-k similar items
-        data, rows_indices, cols_indptr = [], [], []
-
-        item_weights = check_matrix(item_weights, format='csc', dtype=np.float32)
+        # rank the nonzero values of each column with a single sort of the whole matrix. In CSR the values
+        # are grouped by row, those that are kept remain so and the result is built without converting it
+        item_weights = check_matrix(item_weights, format='csr', dtype=np.float32)
 
-        for item_idx in range(nitems):
-            cols_indptr.append(len(data))
+        nonzero_index = np.flatnonzero(item_weights.data != 0)
+        rank_in_column, _ = _rank_in_columns(item_weights.indices[nonzero_index], item_weights.data[nonzero_index], nitems)
 
-            start_position = item_weights.indptr[item_idx]
-            end_position = item_weights.indptr[item_idx + 1]
+        top_k_index = nonzero_index[rank_in_column < k]
 
-            column_data = item_weights.data[start_position:end_position]
-            column_row_index = item_weights.indices[start_position:end_position]
+        row_index = np.repeat(np.arange(nitems, dtype=np.int32), np.diff(item_weights.indptr))
 
-            non_zero_data = column_data != 0
-
-            idx_sorted = np.argsort(column_data[non_zero_data])  # sort by column
-            top_k_idx = idx_sorted[-k:]
-
-            data.extend(column_data[non_zero_data][top_k_idx])
-            rows_indices.extend(column_row_index[non_zero_data][top_k_idx])
-
-        cols_indptr.append(len(data))
+        rows_indptr = np.zeros(nitems + 1, dtype=np.int32)
+        rows_indptr[1:] = np.cumsum(np.bincount(row_index[top_k_index], minlength=nitems))
 
         # During testing CSR is faster
-        W_sparse = sps.csc_matrix((data, rows_indices, cols_indptr), shape=(nitems, nitems), dtype=np.float32)
-        W_sparse = W_sparse.tocsr()
+        W_sparse = sps.csr_matrix((item_weights.data[top_k_index], item_weights.indices[top_k_index], rows_indptr),
+                                  shape=(nitems, nitems), dtype=np.float32)
 
         if verbose:
             print("Sparse TopK matrix generated in {:.2f} seconds".format(time.time() - start_time))
@@ -480,6 +1418,8 @@ class Compute_Similarity:
         :param use_implementation:      "density" will choose the most efficient implementation automatically
                                         "cython" will use the cython implementation, if available. Most efficient for sparse matrix
                                         "python" will use the python implementation. Most efficent for dense matrix
+                                        "approximate" will compute the similarity only for the candidates found
+                                        by locality sensitive hashing, see Compute_Similarity_LSH
         :param similarity:              the type of similarity to use, see SimilarityFunction enum
         :param args:                    other args required by the specific similarity implementation
         """
@@ -533,7 +1473,11 @@ class Compute_Similarity:
 
                 try:
                     from Base.Similarity.Cython.Compute_Similarity_Cython import Compute_Similarity_Cython
-                    self.compute_similarity_object = Compute_Similarity_Cython(dataMatrix, **args)
+
+                    # The Cython implementation runs on a single process with its own blocks
+                    cython_args = {key: value for key, value in args.items()
+                                   if key not in ["n_workers", "memory_budget_bytes", "sparse_density_threshold", "use_symmetry"]}
+                    self.compute_similarity_object = Compute_Similarity_Cython(dataMatrix, **cython_args)
 
                 except ImportError:
                     print("Unable to load Cython Compute_Similarity, reverting to Python")
@@ -543,6 +1487,9 @@ class Compute_Similarity:
             elif use_implementation == "python":
                 self.compute_similarity_object = Compute_Similarity_Python(dataMatrix, **args)
 
+            elif use_implementation == "approximate":
+                self.compute_similarity_object = Compute_Similarity_LSH(dataMatrix, **args)
+
             else:
 
                 raise  ValueError("Compute_Similarity: value for argument 'use_implementation' not recognized")
@@ -555,36 +1502,40 @@ class Compute_Similarity:
 
 
 
-class Compute_Similarity_Euclidean:
-
+class Compute_Similarity_Euclidean(Compute_Similarity_Python):
 
-    def __init__(self, dataMatrix, topK=100, shrink = 0, normalize=False, normalize_avg_row=False,
-                 similarity_from_distance_mode ="lin", row_weights = None, **args):
+    def __init__(self, dataMatrix, topK=100, shrink=0, normalize=False, normalize_avg_row=False,
+                 similarity_from_distance_mode="lin", row_weights=None, n_workers=1, memory_budget_bytes=2 ** 28,
+                 use_symmetry=True, **args):
         """
         Computes the euclidean similarity on the columns of dataMatrix
         If it is computed on URM=|users|x|items|, pass the URM as is.
         If it is computed on ICM=|items|x|features|, pass the ICM transposed.
+        The squared distances are computed in blocks of columns as ||a||^2 + ||b||^2 - 2ab, with the same blocks,
+        workers and TopK selection of Compute_Similarity_Python
         :param dataMatrix:
         :param topK:
-        :param normalize
+        :param shrink:              Added to the denominator of the similarity
+        :param normalize:           If True divide the squared distance by the product of the norms
+        :param normalize_avg_row:   If True divide the squared distance by the number of rows
         :param row_weights:         Multiply the values in each row by a specified value. Array
         :param similarity_from_distance_mode:       "exp"   euclidean_similarity = 1/(e ^ euclidean_distance)
                                                     "lin"        euclidean_similarity = 1/(1 + euclidean_distance)
-                                                    "log"        euclidean_similarity = 1/(1 + euclidean_distance)
+                                                    "log"        euclidean_similarity = 1/(1 + log(1 + euclidean_distance))
+        :param n_workers:           see Compute_Similarity_Python
+        :param memory_budget_bytes: see Compute_Similarity_Python
+        :param use_symmetry:        see Compute_Similarity_Python
         :param args:                accepts other parameters not needed by the current object
         """
 
-        super(Compute_Similarity_Euclidean, self).__init__()
+        # Every pair of columns has a nonzero similarity, the blocks always use the dense product
+        super(Compute_Similarity_Euclidean, self).__init__(dataMatrix, topK=topK, shrink=shrink, normalize=normalize,
+                                                           similarity="cosine", row_weights=row_weights,
+                                                           n_workers=n_workers, memory_budget_bytes=memory_budget_bytes,
+                                                           sparse_density_threshold=-1.0, use_symmetry=use_symmetry)
 
-        self.shrink = shrink
-        self.normalize = normalize
         self.normalize_avg_row = normalize_avg_row
 
-        self.n_rows, self.n_columns = dataMatrix.shape
-        self.TopK = min(topK, self.n_columns)
-
-        self.dataMatrix = dataMatrix.copy()
-
         self.similarity_is_exp = False
         self.similarity_is_lin = False
         self.similarity_is_log = False
@@ -600,18 +1551,375 @@ class Compute_Similarity_Euclidean:
                              " Allowed values are: 'exp', 'lin', 'log'."
                              " Passed value was '{}'".format(similarity_from_distance_mode))
 
+    def _prepare_data(self):
+        """
+        Moves the data to CSC and computes the squared norms of the columns, weighted as the dot products
+        :return:
+        """
 
+        if self._data_prepared:
+            return
 
-        self.use_row_weights = False
+        self.dataMatrix = check_matrix(self.dataMatrix, 'csc')
 
-        if row_weights is not None:
+        if self.use_row_weights:
+            self.dataMatrix_weighted = self.dataMatrix_weighted.tocsc()
+            sumOfSquared = self.dataMatrix.power(2).T.dot(self.row_weights)
+        else:
+            sumOfSquared = np.array(self.dataMatrix.power(2).sum(axis=0)).ravel()
 
-            if dataMatrix.shape[0] != len(row_weights):
-                raise ValueError("Compute_Similarity_Euclidean: provided row_weights and dataMatrix have different number of rows."
-                                 "row_weights has {} rows, dataMatrix has {}.".format(len(row_weights), dataMatrix.shape[0]))
+        self._set_sum_of_squared(np.asarray(sumOfSquared, dtype=np.float32))
+        self.norms = np.sqrt(self.sumOfSquared)
 
-            self.use_row_weights = True
-            self.row_weights = row_weights.copy()
-            self.row_weights_diag = sps.diags(self.row_weights)
+        self._data_prepared = True
+
+    def _normalize_weights(self, weights, block_columns, other_columns, shrink=None):
+        """
+        Turns the dot products between the columns of the block and the other columns into the similarity
+        derived from their distance, see Compute_Similarity_Python._normalize_weights
+        """
+
+        if shrink is None:
+            shrink = self.shrink
+
+        # (a-b)^2 = a^2 + b^2 - 2ab, the cancellation may leave small negative values
+        item_distance = np.add(self.sumOfSquared[block_columns], self.sumOfSquared[other_columns], dtype=np.float32)
+        item_distance -= weights
+        item_distance -= weights
+        np.maximum(item_distance, 0.0, out=item_distance)
+
+        if self.normalize:
+            item_distance /= self.norms[block_columns] * self.norms[other_columns] + 1e-6
+
+        if self.normalize_avg_row:
+            item_distance /= self.n_rows
+
+        np.sqrt(item_distance, out=item_distance)
+
+        if self.similarity_is_exp:
+            # The similarity of the very distant columns becomes zero
+            with np.errstate(over='ignore'):
+                np.exp(item_distance, out=item_distance)
+
+        elif self.similarity_is_lin:
+            item_distance += 1.0
+
+        elif self.similarity_is_log:
+            np.log1p(item_distance, out=item_distance)
+            item_distance += 1.0
+
+        item_distance += shrink
+        item_similarity = np.reciprocal(item_distance, out=item_distance)
+
+        # The similarity of each item with itself is not considered. The other columns of a dense block are consecutive
+        if item_similarity.ndim == 2:
+            block_columns = np.ravel(block_columns)
+            other_columns = np.ravel(other_columns)
+
+            block_index = np.flatnonzero((block_columns >= other_columns[0]) & (block_columns <= other_columns[-1]))
+            item_similarity[block_index, block_columns[block_index] - other_columns[0]] = 0.0
+
+        else:
+            item_similarity[block_columns == other_columns] = 0.0
+
+        return item_similarity
+
+    def compute_raw_similarity(self, block_size=None, ranking_shrink_list=(None, 0)):
+        """
+        Not supported: the similarity depends on the distance, so the columns without common rows have a nonzero
+        similarity and the TopK cannot be derived from a base keeping only the largest dot products
+        """
+
+        raise ValueError("Compute_Similarity_Euclidean: the similarity cannot be derived from a base of the largest "
+                         "dot products, use compute_similarity")
+
+    def compute_similarity_from_base(self, W_base, sumOfSquared):
+        """
+        Not supported, see compute_raw_similarity
+        """
+
+        raise ValueError("Compute_Similarity_Euclidean: the similarity cannot be derived from a base of the largest "
+                         "dot products, use compute_similarity")
+
+
+class Compute_Similarity_LSH(Compute_Similarity_Python):
+
+    # Approximate bytes used for each value gathered to compute the similarity of a candidate: its position, the pair
+    # it belongs to and the product
+    _CANDIDATE_BYTES_PER_VALUE = 24
+
+    # Below this estimated recall of the exact TopK a warning is printed
+    _MIN_RECALL = 0.5
+
+    def __init__(self, dataMatrix, n_bands=32, band_size=None, hash_function="minhash", random_seed=None,
+                 recall_sample_size=100, **args):
+        """
+        Computes the similarity on the columns of dataMatrix only for the pairs of columns found by an approximate
+        nearest neighbour index, each column keeps the TopK most similar among its candidates.
+        The columns are hashed in n_bands bands of band_size hashes, two columns are candidates if all the hashes
+        of a band are equal. The hashes are MinHash of the nonzero pattern, where a band collides with probability
+        jaccard ^ band_size, or signed random projections, where a band collides with probability
+        (1 - angle / pi) ^ band_size.
+        More bands find more of the exact TopK, longer bands find fewer candidates and take less time.
+        On sparse implicit data most similarities are small: a random pair lies on the same side of a hyperplane
+        with probability 1/2, so signed random projections need long bands, which miss the neighbours with a low
+        cosine. MinHash of the nonzero pattern finds more of them in less time also for the other similarities.
+        The index only pays off on data much larger than the URM of the competition, where the exact similarity is
+        faster for both items and users. Items have few interactions each, so most of their neighbours have a very
+        low jaccard and are missed by MinHash too: the item-item similarity keeps a small fraction of the exact TopK
+        :param dataMatrix:
+        :param n_bands:         Number of bands, a pair is a candidate if it collides in at least one of them
+        :param band_size:       Number of hashes in each band, if None 4 for MinHash and 12 for the projections
+        :param hash_function:   "minhash" or "projection"
+        :param random_seed:     Seed of the hash functions
+        :param recall_sample_size: Number of consecutive columns, chosen at random, whose exact TopK is computed after
+                                the approximate one to estimate the recall, i.e. the fraction of the exact TopK found.
+                                A warning is printed when it is low, 0 disables the estimate
+        :param args:            see Compute_Similarity_Python
+        """
+
+        super(Compute_Similarity_LSH, self).__init__(dataMatrix, **args)
+
+        if hash_function not in ["minhash", "projection"]:
+            raise ValueError("Compute_Similarity_LSH: value for parameter 'hash_function' not recognized."
+                             " Allowed values are: 'minhash', 'projection'."
+                             " Passed value was '{}'".format(hash_function))
+
+        self.use_min_hash = hash_function == "minhash"
+
+        if band_size is None:
+            band_size = 4 if self.use_min_hash else 12
+
+        assert n_bands > 0 and band_size > 0, \
+            "Compute_Similarity_LSH: n_bands and band_size must be positive, provided were {} and {}".format(n_bands,
+                                                                                                           band_size)
+
+        self.n_bands = n_bands
+        self.band_size = band_size
+        self.random_seed = random_seed
+        self.recall_sample_size = recall_sample_size
+        self.estimated_recall = None
+
+    def _prepare_data(self):
+        """
+        Prepares the data as Compute_Similarity_Python and builds the buckets of the columns in each band
+        :return:
+        """
+
+        if self._data_prepared:
+            return
+
+        super(Compute_Similarity_LSH, self)._prepare_data()
+
+        self._build_buckets()
+
+    def _compute_band_keys(self):
+        """
+        Hashes each nonempty column in each band, the columns with the same key in a band are in the same bucket
+        :return:    keys of shape (n_bands, number of nonempty columns), nonempty columns
+        """
+
+        random_state = np.random.RandomState(self.random_seed)
+
+        column_nnz = np.diff(self.dataMatrix.indptr)
+        nonempty_columns = np.flatnonzero(column_nnz > 0)
+
+        band_keys = np.zeros((self.n_bands, len(nonempty_columns)), dtype=np.uint64)
+
+        if len(nonempty_columns) == 0:
+            return band_keys, nonempty_columns
+
+        for band_index in range(self.n_bands):
+
+            if self.use_min_hash:
+                # MinHash: the smallest hash of the rows of each column, for band_size random hashes of the rows
+                row_hash = random_state.randint(0, 2 ** 32, size=(self.band_size, self.n_rows), dtype=np.uint64)
+                signature = np.minimum.reduceat(row_hash[:, self.dataMatrix.indices],
+                                                self.dataMatrix.indptr[nonempty_columns], axis=1)
+            else:
+                # Signed random projections: on which side of band_size random hyperplanes each column lies
+                projection = random_state.standard_normal((self.n_rows, self.band_size)).astype(np.float32)
+                signature = (self.dataMatrix.T.dot(projection)[nonempty_columns] >= 0.0).T.astype(np.uint64)
+
+            # Combine the hashes of the band in a single key, the collisions of different signatures are negligible
+            for hash_value in signature:
+                band_keys[band_index] = band_keys[band_index] * np.uint64(1000003) ^ hash_value
+
+        return band_keys, nonempty_columns
+
+    def _build_buckets(self):
+        """
+        Sorts the nonempty columns by their key in each band, so that the candidates of a column in a band are the
+        consecutive columns of its bucket. The empty columns have no candidates
+        :return:
+        """
+
+        band_keys, nonempty_columns = self._compute_band_keys()
+
+        self._bucket_columns = np.zeros(band_keys.shape, dtype=np.int32)
+        self._bucket_start = np.zeros((self.n_bands, self.n_columns), dtype=np.int32)
+        self._bucket_end = np.zeros((self.n_bands, self.n_columns), dtype=np.int32)
+
+        for band_index in range(self.n_bands):
+            ranking = np.argsort(band_keys[band_index], kind="stable")
+            sorted_keys = band_keys[band_index][ranking]
+
+            self._bucket_columns[band_index] = nonempty_columns[ranking]
+            self._bucket_start[band_index, nonempty_columns] = np.searchsorted(sorted_keys, band_keys[band_index], side="left")
+            self._bucket_end[band_index, nonempty_columns] = np.searchsorted(sorted_keys, band_keys[band_index], side="right")
+
+    def _get_column_bytes(self, start_col, end_col):
+        """
+        The similarity is always computed on the candidate pairs, each column needs its dense data and the values of
+        all the candidates it collides with, counted once for each band
+        :return:    True, bytes of each column and the estimated density of the similarity
+        """
+
+        column_nnz = np.diff(self._get_product_matrix().indptr)
+
+        n_candidates = np.zeros(end_col - start_col, dtype=np.int64)
+        n_candidate_values = np.zeros(end_col - start_col, dtype=np.int64)
+
+        for band_index in range(self.n_bands):
+            bucket_start = self._bucket_start[band_index, start_col:end_col]
+            bucket_end = self._bucket_end[band_index, start_col:end_col]
+
+            bucket_column_nnz_cumsum = np.zeros(len(self._bucket_columns[band_index]) + 1, dtype=np.int64)
+            np.cumsum(column_nnz[self._bucket_columns[band_index]], out=bucket_column_nnz_cumsum[1:])
+
+            n_candidates += bucket_end - bucket_start
+            n_candidate_values += bucket_column_nnz_cumsum[bucket_end] - bucket_column_nnz_cumsum[bucket_start]
+
+        estimated_density = min(1.0, n_candidates.sum() / max(1, (end_col - start_col) * self.n_columns))
+
+        column_bytes = self.n_rows * self.dataMatrix.dtype.itemsize + \
+                       (n_candidate_values + n_candidates + 1) * self._CANDIDATE_BYTES_PER_VALUE
+
+        return True, column_bytes, estimated_density
+
+    def _is_symmetric(self):
+        # The candidates are computed for each column, they are not passed to the following columns
+        return False
+
+    def _get_block_candidates(self, start_col_block, end_col_block):
+        """
+        :return:    block column and candidate column of the distinct candidate pairs of the block,
+                    ordered by block column and candidate
+        """
+
+        block_column_index_list = []
+        candidate_list = []
+
+        for band_index in range(self.n_bands):
+            bucket_start = self._bucket_start[band_index, start_col_block:end_col_block]
+            bucket_size = self._bucket_end[band_index, start_col_block:end_col_block] - bucket_start
+
+            position = np.arange(bucket_size.sum()) - np.repeat(np.cumsum(bucket_size) - bucket_size - bucket_start,
+                                                                bucket_size)
+
+            block_column_index_list.append(np.repeat(np.arange(end_col_block - start_col_block), bucket_size))
+            candidate_list.append(self._bucket_columns[band_index, position])
+
+        # The pairs colliding in several bands are computed once
+        pair_key = np.concatenate(block_column_index_list) * self.n_columns + np.concatenate(candidate_list)
+        pair_key = np.unique(pair_key)
+
+        block_column_index = pair_key // self.n_columns
+        candidate = pair_key % self.n_columns
+
+        # The similarity of each item with itself is not considered
+        is_not_diagonal = candidate != block_column_index + start_col_block
+
+        return block_column_index[is_not_diagonal], candidate[is_not_diagonal]
+
+    def _compute_block_top_k_sparse(self, start_col_block, end_col_block):
+        """
+        Computes the TopK of the columns in the block among their candidates, the dot product of each pair is computed
+        from the nonzeros of the candidate and the dense data of the block column
+        :return:    block column, row and value of the selected similarities, ordered by block column and row
+        """
 
-            self.dataMatrix_weighted = self.dataMatrix.T.dot(self.row_weights_diag).T
\ No newline at end of file
+        block_column_index, candidate = self._get_block_candidates(start_col_block, end_col_block)
+
+        product_matrix = self._get_product_matrix()
+        item_data = self.dataMatrix[:, start_col_block:end_col_block].toarray()
+
+        candidate_nnz = np.diff(product_matrix.indptr)[candidate]
+        pair_index = np.repeat(np.arange(len(candidate)), candidate_nnz)
+
+        data_position = np.arange(len(pair_index)) - np.repeat(np.cumsum(candidate_nnz) - candidate_nnz -
+                                                               product_matrix.indptr[candidate], candidate_nnz)
+
+        products = product_matrix.data[data_position] * item_data[product_matrix.indices[data_position],
+                                                                  block_column_index[pair_index]]
+
+        this_block_weights = np.bincount(pair_index, weights=products, minlength=len(candidate)).astype(np.float32)
+
+        values, ranking_weights_list = self._get_ranking_weights_list(this_block_weights,
+                                                                      block_column_index + start_col_block, candidate)
+
+        top_k_mask = np.zeros(len(values), dtype=np.bool_)
+
+        for ranking_weights in ranking_weights_list:
+            top_k_mask |= self._get_top_k_mask_triplets(block_column_index, ranking_weights,
+                                                        end_col_block - start_col_block)
+
+        return block_column_index[top_k_mask], candidate[top_k_mask], values[top_k_mask]
+
+    def _estimate_recall(self, W_sparse, start_col, end_col):
+        """
+        Fraction of the exact TopK of recall_sample_size consecutive columns in [start_col, end_col) found in W_sparse
+        :return:    estimated recall, sample start column, sample end column
+        """
+
+        random_state = np.random.RandomState(self.random_seed)
+
+        sample_size = min(self.recall_sample_size, end_col - start_col)
+        sample_start_col = start_col + random_state.randint(0, end_col - start_col - sample_size + 1)
+        sample_end_col = sample_start_col + sample_size
+
+        # The exact TopK of the sample, computed on all the columns by the sparse product of Compute_Similarity_Python
+        exact_column_index, exact_row, _ = Compute_Similarity_Python._compute_block_top_k_sparse(self, sample_start_col,
+                                                                                                sample_end_col)
+
+        W_sample = sps.csc_matrix(W_sparse)[:, sample_start_col:sample_end_col].tocoo()
+
+        exact_pairs = exact_column_index.astype(np.int64) * self.n_columns + exact_row
+        approximate_pairs = W_sample.col.astype(np.int64) * self.n_columns + W_sample.row
+
+        if len(exact_pairs) == 0:
+            return 1.0, sample_start_col, sample_end_col
+
+        n_found = len(np.intersect1d(exact_pairs, approximate_pairs, assume_unique=True))
+
+        return n_found / len(exact_pairs), sample_start_col, sample_end_col
+
+    def compute_similarity(self, start_col=None, end_col=None, block_size=None):
+        """
+        Computes the TopK among the candidates as Compute_Similarity_Python.compute_similarity, then estimates the
+        recall of the exact TopK on a sample of columns, unless recall_sample_size is 0
+        """
+
+        W_sparse = super(Compute_Similarity_LSH, self).compute_similarity(start_col=start_col, end_col=end_col,
+                                                                          block_size=block_size)
+
+        # The base of compute_raw_similarity is ranked on several values, its recall is not estimated
+        if self.recall_sample_size == 0 or self._base_ranking_shrink_list is not None:
+            return W_sparse
+
+        start_col_local = start_col if start_col is not None and 0 <= start_col < self.n_columns else 0
+        end_col_local = end_col if end_col is not None and start_col_local < end_col < self.n_columns else self.n_columns
+
+        self.estimated_recall, sample_start_col, sample_end_col = self._estimate_recall(W_sparse, start_col_local,
+                                                                                         end_col_local)
+
+        print("Compute_Similarity_LSH: estimated recall of the exact TopK {:.3f}, on columns {} to {}".format(
+            self.estimated_recall, sample_start_col, sample_end_col))
+
+        if self.estimated_recall < self._MIN_RECALL:
+            print("Warning: Compute_Similarity_LSH found only {:.1f} % of the exact TopK with {} bands of {} {} hashes,"
+                  " use more bands, shorter bands or the exact implementation".format(
+                      self.estimated_recall * 100, self.n_bands, self.band_size,
+                      "MinHash" if self.use_min_hash else "projection"))
+
+        return W_sparse
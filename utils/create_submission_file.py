@@ -10,7 +10,18 @@ from datetime import datetime
 import numpy as np
 
 
-def create_csv(user_id_array, item_list, recommender_name):
+def create_csv(user_id_array, item_list, recommender_name, item_mapper=None):
+    """
+    :param user_id_array:       original user IDs
+    :param item_list:           recommended items for each user, either a list of lists, an (n_users, cutoff) array
+                                or an iterator of such blocks following the order of user_id_array,
+                                e.g. recommend_in_batches, which is written as each block arrives
+    :param recommender_name:
+    :param item_mapper:         IDMapper to translate dense item indices back to the original IDs,
+                                if the recommender was trained on a compacted URM
+    :return:                    path of the csv file
+    """
+
     print("\nGenerating submission csv ... ")
 
     # save on a different dir according to the recommender used
@@ -26,16 +37,138 @@ def create_csv(user_id_array, item_list, recommender_name):
     csv_fname = 'submission_' + datetime.now().strftime('%b%d_%H-%M-%S') + '.csv'
     csv_file = os.path.join(submissions_dir, csv_fname)
 
-    # field names
-    header = ['user_id', 'item_list']
+    # A single block unless the recommendations arrive as an iterator of blocks
+    if iter(item_list) is item_list:
+        block_iterator = item_list
+    else:
+        block_iterator = [item_list]
+
+    user_id_array = np.asarray(user_id_array)
+    n_users_written = 0
+
+    with SubmissionWriter(csv_file, item_mapper=item_mapper) as writer:
+
+        for block in block_iterator:
+            block = to_padded_array(block)
+
+            writer.write_block(user_id_array[n_users_written:n_users_written + len(block)], block)
+            n_users_written += len(block)
+
+    assert n_users_written == len(user_id_array), \
+        "create_csv: received recommendations for {} users, expected {}".format(n_users_written, len(user_id_array))
+
+    return csv_file
+
+
+def to_padded_array(item_list):
+    """
+    Transforms the recommendation lists in an int32 (n_users, cutoff) array,
+    shorter lists are padded with -1 at the end
+    :param item_list:   list of lists or 2-dimensional array
+    :return:
+    """
+
+    if isinstance(item_list, np.ndarray) and item_list.ndim == 2:
+        return item_list.astype(np.int32, copy=False)
+
+    list_length = np.array([len(user_item_list) for user_item_list in item_list], dtype=np.int32)
+    cutoff = list_length.max() if len(list_length) > 0 else 0
+
+    padded_array = np.full((len(item_list), cutoff), -1, dtype=np.int32)
+
+    if len(list_length) > 0 and np.all(list_length == cutoff):
+        padded_array[:] = np.asarray([np.asarray(user_item_list) for user_item_list in item_list])
+
+    elif len(list_length) > 0:
+        # Flatten all the lists and scatter them in the first positions of each row
+        padded_array[np.arange(cutoff) < list_length[:, None]] = np.concatenate(
+            [np.asarray(user_item_list, dtype=np.int32) for user_item_list in item_list])
+
+    return padded_array
+
+
+def recommend_in_batches(recommender, user_id_array, batch_size=1000, **recommend_args):
+    """
+    Yields the recommendations one block of users at a time, so that the whole score matrix
+    and the whole list of lists never exist in memory. To be passed to create_csv
+    :param recommender:
+    :param user_id_array:
+    :param batch_size:
+    :param recommend_args:  arguments of recommender.recommend
+    :return:
+    """
+
+    for start_position in range(0, len(user_id_array), batch_size):
+        user_batch = np.asarray(user_id_array[start_position:start_position + batch_size])
+
+        yield recommender.recommend(user_batch, **recommend_args)
+
+
+class SubmissionWriter(object):
+    """
+    Writes the submission file, formatting a whole block of users with a single string operation
+    and going through a large write buffer
+    """
+
+    HEADER = 'user_id,item_list\n'
+
+    def __init__(self, csv_file, item_mapper=None, buffer_size=2 ** 22):
+        super(SubmissionWriter, self).__init__()
+
+        self.item_mapper = item_mapper
+
+        self._file = open(csv_file, 'w', newline='', buffering=buffer_size)
+        self._file.write(self.HEADER)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self._file.close()
+
+    def write_block(self, user_id_array, recommendation_block):
+        """
+        :param user_id_array:           (n_users, ) array
+        :param recommendation_block:    (n_users, cutoff) int array, -1 in the last positions of shorter lists
+        :return:
+        """
+
+        # An empty block, e.g. the last one of an empty list of users, writes nothing
+        if len(user_id_array) == 0:
+            return
+
+        recommendation_block = np.asarray(recommendation_block, dtype=np.int32)
+
+        assert recommendation_block.ndim == 2 and len(user_id_array) == len(recommendation_block), \
+            "SubmissionWriter: recommendation_block must be a ({}, cutoff) array".format(len(user_id_array))
+
+        valid_mask = recommendation_block >= 0
+        list_length = valid_mask.sum(axis=1)
+
+        if self.item_mapper is not None:
+            dense_item_array = recommendation_block[valid_mask]
+            original_item_array = self.item_mapper.to_original(dense_item_array)
+
+            if np.any(original_item_array < 0):
+                raise ValueError("SubmissionWriter: {} recommended items are not dense IDs of item_mapper, e.g. {}".format(
+                    np.sum(original_item_array < 0), dense_item_array[original_item_array < 0][0]))
+
+            recommendation_block = recommendation_block.copy()
+            recommendation_block[valid_mask] = original_item_array
+
+        # Rows are formatted in runs of consecutive users with the same list length, usually a single run
+        run_start_list = np.flatnonzero(np.ediff1d(list_length, to_begin=1) != 0)
+        run_end_list = np.append(run_start_list[1:], len(list_length))
+
+        for run_start, run_end in zip(run_start_list, run_end_list):
+            run_length = list_length[run_start]
 
-    # data rows of csv file
-    items_by_user = list(zip(user_id_array, item_list))  # zip list
+            row_format = "%d," + " ".join(["%d"] * run_length) + "\n"
 
-    with open(csv_file, 'w', newline='') as file:
-        fieldnames = 'user_id,item_list'
-        file.write(fieldnames + '\n')
+            run_values = np.column_stack((user_id_array[run_start:run_end],
+                                          recommendation_block[run_start:run_end, :run_length]))
 
-        for item_list in items_by_user:
-            row = str(item_list[0]) + ',' + str(np.array(item_list[1])) + '\n'
-            file.write(row.replace('[', '').replace(']', ''))  # remove '[' ']' from item_list string
+            self._file.write((row_format * (run_end - run_start)) % tuple(run_values.ravel().tolist()))
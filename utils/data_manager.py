@@ -5,9 +5,14 @@
 	data_manager.py: module for loading and preparing data. Also for displaying some statistics.
 """
 
+import os
+import time
+import weakref
 import scipy.sparse as sps
 import numpy as np
+import pandas as pd
 from utils.compute_similarity import check_matrix
+from utils.dataset_cache import DatasetCache
 
 dataset_dir = "dataset/"
 
@@ -24,43 +29,35 @@ data_ICM_sub_class = dataset_dir + "/data_ICM_sub_class.csv"  # categorization o
 data_UCM_age = dataset_dir + "/data_UCM_age.csv"  # age of each user (already normalized)
 data_UCM_region = dataset_dir + "/data_UCM_region.csv"  # region of each user (already normalized)
 
-# global vars
-user_list = []
-item_list = []
-n_interactions = 0
-n_users = 0
-n_items = 0
-n_subclass = 0
-n_regions = 0
+# Binary cache of the built matrices, reopened memory-mapped on the next start
+dataset_cache = DatasetCache(dataset_dir + "/.cache/")
+
+# Interaction files larger than this are loaded with the two-pass streaming builder
+URM_STREAMING_THRESHOLD_BYTES = 2 ** 30
+URM_STREAMING_CHUNK_SIZE = 5000000  # lines
 
 
 # -------------------------------------------
 # User Rating Matrix from training data
 # -------------------------------------------
 
-def build_URM():
-    global user_list, item_list, n_interactions
-
-    matrix_tuples = []
-
-    with open(data_train, 'r') as file:  # read file's content
-        next(file)  # skip header row
-        for line in file:
-            if len(line.strip()) != 0:  # ignore lines with only whitespace
-                n_interactions += 1
-
-                # Create a tuple for each interaction (line in the file)
-                matrix_tuples.append(row_split(line))
+def build_URM(use_cache=True, streaming=None):
+    """
+    :param use_cache:
+    :param streaming:   True uses the two-pass chunked builder, False parses the whole file at once,
+                        None chooses according to the file size
+    :return:
+    """
 
-    # Separate user_id, item_id and rating
-    user_list, item_list, rating_list = zip(*matrix_tuples)  # join tuples together (zip() to map values)
+    if streaming is None:
+        streaming = os.path.getsize(data_train) > URM_STREAMING_THRESHOLD_BYTES
 
-    # Create lists of all users, items and contents (ratings)
-    user_list = list(user_list)  # row
-    item_list = list(item_list)  # col
-    rating_list = list(rating_list)  # data
+    read_function = build_URM_streaming if streaming else _read_URM
 
-    URM = csr_sparse_matrix(rating_list, user_list, item_list)
+    if use_cache:
+        URM = dataset_cache.load_or_build("URM_all", [data_train], read_function)
+    else:
+        URM = read_function()
 
     print("URM built!")
     # print(URM[1:3, :].todense())
@@ -69,26 +66,116 @@ def build_URM():
     return URM
 
 
-# Get statistics from interactions in the URM
-# -------------------------------------------
+def _read_URM(load_columns=None):
 
-def get_statistics_URM(URM):
-    print("\n ... Statistics on URM ... ")
-    global n_users, n_items
+    if load_columns is None:
+        load_columns = load_csv_columns
 
-    print("No. of interactions in the URM is {}".format(n_interactions))
+    # Read user_id, item_id and rating straight into typed columns
+    user_list, item_list, rating_list = load_columns(data_train)  # row, col, data
 
-    user_list_unique = get_user_list_unique()
-    item_list_unique = get_item_list_unique()
+    return csr_sparse_matrix(rating_list, user_list, item_list)
 
-    n_unique_users = len(user_list_unique)
-    n_unique_items = len(item_list_unique)
 
-    n_users, n_items = URM.shape
+def build_URM_streaming(file_path=data_train, chunk_size=URM_STREAMING_CHUNK_SIZE, mmap_folder=None):
+    """
+    Builds the URM reading the interaction file in chunks, so that besides the final CSR arrays
+    only one chunk is in memory at any time.
+    The first pass counts the interactions of each user to size indptr, the second pass writes
+    each chunk straight into its final position of the preallocated indices and data arrays.
+    :param file_path:
+    :param chunk_size:      number of lines read at a time
+    :param mmap_folder:     if not None, indices and data are preallocated as memory-mapped .npy files in this folder
+    :return:
+    """
+
+    # First pass: interactions per user and number of items
+    user_degree = np.zeros(0, dtype=np.int64)
+    n_items = 0
+
+    for user_array, item_array, _ in iterate_csv_chunks(file_path, chunk_size):
+
+        chunk_user_degree = np.bincount(user_array)
+
+        if len(chunk_user_degree) > len(user_degree):
+            user_degree = np.concatenate((user_degree, np.zeros(len(chunk_user_degree) - len(user_degree), dtype=np.int64)))
+
+        user_degree[:len(chunk_user_degree)] += chunk_user_degree
+        n_items = max(n_items, int(item_array.max()) + 1 if len(item_array) > 0 else 0)
+
+    n_users = len(user_degree)
+    n_interactions = int(user_degree.sum())
+
+    indptr_dtype = np.int32 if n_interactions <= np.iinfo(np.int32).max else np.int64
+
+    indptr = np.zeros(n_users + 1, dtype=indptr_dtype)
+    np.cumsum(user_degree, out=indptr[1:])
+    del user_degree
+
+    indices = _allocate_array(n_interactions, indptr_dtype, mmap_folder, "URM_indices.npy")
+    data = _allocate_array(n_interactions, np.float32, mmap_folder, "URM_data.npy")
+
+    # Second pass: next free position in each user row
+    row_cursor = indptr[:-1].astype(np.int64)
+
+    for user_array, item_array, rating_array in iterate_csv_chunks(file_path, chunk_size):
 
-    print("No. of unique items\t {}, No. of unique users\t {}".format(n_items, n_users))
-    print("No. of items\t {}, No. of users\t {}".format(n_unique_items, n_unique_users))
-    # print("\tMax ID items\t {}, Max ID users\t {}\n".format(max(item_list_unique), max(user_list_unique)))
+        # Group the chunk by user, keeping the file order within each user
+        chunk_order = np.argsort(user_array, kind="stable")
+        user_array = user_array[chunk_order]
+
+        # Position of each interaction among those of the same user in this chunk
+        rank_in_user = np.arange(len(user_array)) - np.searchsorted(user_array, user_array, side="left")
+        destination = row_cursor[user_array] + rank_in_user
+
+        indices[destination] = item_array[chunk_order]
+        data[destination] = rating_array[chunk_order]
+
+        row_cursor += np.bincount(user_array, minlength=n_users)
+
+    URM = sps.csr_matrix((data, indices, indptr), shape=(n_users, n_items), copy=False)
+
+    # Sort the items of each user and merge repeated interactions, as the COO conversion does
+    URM.sum_duplicates()
+
+    return URM
+
+
+def _allocate_array(size, dtype, mmap_folder, file_name):
+
+    if mmap_folder is None:
+        return np.empty(size, dtype=dtype)
+
+    if not os.path.exists(mmap_folder):
+        os.makedirs(mmap_folder)
+
+    return np.lib.format.open_memmap(os.path.join(mmap_folder, file_name), mode="w+", dtype=dtype, shape=(size,))
+
+
+def get_peak_RSS_MB():
+    """
+    Peak resident set size of the current process, in MB. None if it cannot be measured on this platform
+    """
+
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    peak_RSS = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Linux reports KB, macOS bytes
+    if os.uname().sysname == "Darwin":
+        return peak_RSS / 2 ** 20
+
+    return peak_RSS / 2 ** 10
+
+
+# Get statistics from interactions in the URM
+# -------------------------------------------
+
+def get_statistics_URM(URM):
+    DatasetReader(URM_all=URM).print_statistics()
 
 
 def get_statistics_splitted_URM(SPLIT_URM_DICT):
@@ -131,88 +218,187 @@ def compute_density(URM):
 
 
 # -------------------------------------------------------------------------
-# Build Item Content Matrix with three features: asset, price and sub-class
+# Dataset object owning the matrices and their statistics
 # -------------------------------------------------------------------------
 
-def build_ICM():
-    # features = [‘asset’, ’price’, ’subclass’] info about products
-    global n_subclass
+class DatasetReader(object):
+    """
+    Owns the URM, ICM and UCM of the dataset. Matrices not provided are built on first access,
+    statistics are computed lazily from the CSR index arrays and memoized, so asking for them again is free
+    """
 
-    # Load subclass data
-    matrix_tuples = []
+    def __init__(self, URM_all=None, ICM_all=None, UCM_all=None, use_cache=True):
+        super(DatasetReader, self).__init__()
 
-    with open(data_ICM_sub_class, 'r') as file:  # read file's content
-        next(file)  # skip header row
-        for line in file:
-            n_subclass += 1
+        self._URM_all = sps.csr_matrix(URM_all) if URM_all is not None else None
+        self._ICM_all = ICM_all
+        self._UCM_all = UCM_all
+        self._use_cache = use_cache
 
-            # Create a tuple for each interaction (line in the file)
-            matrix_tuples.append(row_split(line))
+        self._statistics = {}
 
-    # Separate user_id, item_id and rating
-    item_list, class_list, col_list = zip(*matrix_tuples)  # join tuples together (zip() to map values)
+    def get_URM_all(self):
+        if self._URM_all is None:
+            self._URM_all = sps.csr_matrix(build_URM(use_cache=self._use_cache))
+        return self._URM_all
 
-    # Convert values to list# Create lists of all users, items and contents (ratings)
-    item_list_icm = list(item_list)
-    class_list_icm = list(class_list)
-    col_list_icm = np.zeros(len(col_list))
+    def get_ICM_all(self):
+        if self._ICM_all is None:
+            self._ICM_all = build_ICM(use_cache=self._use_cache)
+        return self._ICM_all
 
-    # Number of items that are in the subclass list
-    num_items = max(item_list_icm) + 1
-    ICM_shape = (num_items, 1)
-    ICM_subclass = csr_sparse_matrix(class_list_icm, item_list_icm, col_list_icm, shape=ICM_shape)
+    def get_UCM_all(self):
+        if self._UCM_all is None:
+            self._UCM_all = build_UCM(self.get_URM_all(), use_cache=self._use_cache)
+        return self._UCM_all
 
-    ################################################################################################################
+    def _get_statistic(self, statistic_name, compute_function):
 
-    # Load price data
-    matrix_tuples = []
-    n_prices = 0
+        if statistic_name not in self._statistics:
+            self._statistics[statistic_name] = compute_function()
 
-    with open(data_ICM_price, 'r') as file:  # read file's content
-        next(file)  # skip header row
-        for line in file:
-            n_prices += 1
+        return self._statistics[statistic_name]
 
-            # Create a tuple for each interaction (line in the file)
-            matrix_tuples.append(row_split(line))
+    def get_n_interactions(self):
+        return self.get_URM_all().nnz
 
-    # Separate user_id, item_id and rating
-    item_list, col_list, price_list = zip(*matrix_tuples)  # join tuples together (zip() to map values)
+    def get_shape(self):
+        return self.get_URM_all().shape
 
-    # Convert values to list# Create lists of all users, items and contents (ratings)
-    item_list_icm = list(item_list)
-    col_list_icm = list(col_list)
-    price_list_icm = list(price_list)
+    def get_user_profile_length(self):
+        URM_all = self.get_URM_all()
+        return self._get_statistic("user_profile_length", lambda: np.ediff1d(URM_all.indptr))
 
-    ICM_price = csr_sparse_matrix(price_list_icm, item_list_icm, col_list_icm)
+    def get_item_popularity(self):
+        URM_all = self.get_URM_all()
+        return self._get_statistic("item_popularity",
+                                   lambda: np.bincount(URM_all.indices, minlength=URM_all.shape[1]))
 
-    ################################################################################################################
+    def get_user_list_unique(self):
+        # Users with at least one interaction
+        return self._get_statistic("user_list_unique", lambda: np.flatnonzero(self.get_user_profile_length()))
 
-    # Load asset data
-    matrix_tuples = []
-    n_assets = 0
+    def get_item_list_unique(self):
+        # Items with at least one interaction
+        return self._get_statistic("item_list_unique", lambda: np.flatnonzero(self.get_item_popularity()))
 
-    with open(data_ICM_asset, 'r') as file:  # read file's content
-        next(file)  # skip header row
-        for line in file:
-            n_assets += 1
+    def get_density(self):
+        return self._get_statistic("density", lambda: compute_density(self.get_URM_all()))
 
-            # Create a tuple for each interaction (line in the file)
-            matrix_tuples.append(row_split(line))
+    def print_statistics(self):
+        print("\n ... Statistics on URM ... ")
 
-    # Separate user_id, item_id and rating
-    item_list, col_list, asset_list = zip(*matrix_tuples)  # join tuples together (zip() to map values)
+        print("No. of interactions in the URM is {}".format(self.get_n_interactions()))
 
-    # Convert values to list# Create lists of all users, items and contents (ratings)
-    item_list_icm = list(item_list)
-    col_list_icm = list(col_list)
-    asset_list_icm = list(asset_list)
+        n_users, n_items = self.get_shape()
 
-    ICM_asset = csr_sparse_matrix(asset_list_icm, item_list_icm, col_list_icm)
+        n_unique_users = len(self.get_user_list_unique())
+        n_unique_items = len(self.get_item_list_unique())
 
-    ################################################################################################################
+        profile_length = self.get_user_profile_length()
 
-    ICM_all = sps.hstack([ICM_price, ICM_asset, ICM_subclass], format='csr')
+        print("No. of unique items\t {}, No. of unique users\t {}".format(n_items, n_users))
+        print("No. of items\t {}, No. of users\t {}".format(n_unique_items, n_unique_users))
+        print("Density {:.2E}, profile length min {}, max {}, average {:.2f}".format(
+            self.get_density(), profile_length.min(), profile_length.max(), profile_length.mean()))
+
+
+# -------------------------------------------------------------------------
+# Load URM, ICM and UCM together, parsing their csv files concurrently
+# -------------------------------------------------------------------------
+
+def load_URM_ICM_UCM(use_cache=True, n_workers=None, streaming=None):
+    """
+    Builds the three matrices reading all the csv files that are not already cached at the same time.
+    The C parser of pandas releases the GIL, so the files are parsed in parallel by a thread pool and each
+    matrix is assembled as soon as its own files are available.
+    :param use_cache:
+    :param n_workers:   number of reader threads, by default one per file to read
+    :param streaming:   as in build_URM, the URM is built by the two-pass chunked builder instead of the thread pool
+    :return:            URM_all, ICM_all, UCM_all
+    """
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    URM_sources = [data_train]
+    ICM_sources = [data_ICM_sub_class, data_ICM_price, data_ICM_asset]
+    UCM_sources = [data_UCM_age, data_UCM_region]
+
+    if streaming is None:
+        streaming = os.path.getsize(data_train) > URM_STREAMING_THRESHOLD_BYTES
+
+    # Only the files of the matrices missing from the cache are read
+    file_to_read_list = []
+    URM_cached = use_cache and dataset_cache.is_valid("URM_all", URM_sources)
+
+    # The streaming builder reads the interaction file by itself, in chunks
+    if not URM_cached and not streaming:
+        file_to_read_list.extend(URM_sources)
+
+    if not (use_cache and dataset_cache.is_valid("ICM_all", ICM_sources)):
+        file_to_read_list.extend(ICM_sources)
+
+    # The UCM depends on the number of users, which is known in advance only when the URM is cached, from the shape
+    # saved with it. Otherwise its files are read anyway, since a changed URM most likely means a different number of users
+    if not (URM_cached and dataset_cache.is_valid("UCM_all", UCM_sources,
+                                                  build_key={"num_users": dataset_cache.get_shape("URM_all")[0]})):
+        file_to_read_list.extend(UCM_sources)
+
+    load_time_dict = {}
+
+    def timed_load_csv_columns(file_path):
+        start_time = time.time()
+        columns = load_csv_columns(file_path)
+        load_time_dict[file_path] = time.time() - start_time
+        return columns
+
+    start_time = time.time()
+
+    with ThreadPoolExecutor(max_workers=n_workers or max(1, len(file_to_read_list))) as executor:
+
+        future_dict = {file_path: executor.submit(timed_load_csv_columns, file_path)
+                       for file_path in file_to_read_list}
+
+        def load_columns(file_path):
+            # Files not submitted (e.g. the UCM of a different number of users) are read on the spot
+            if file_path not in future_dict:
+                future_dict[file_path] = executor.submit(timed_load_csv_columns, file_path)
+
+            return future_dict[file_path].result()
+
+        def read_URM():
+            return build_URM_streaming() if streaming else _read_URM(load_columns)
+
+        if use_cache:
+            URM_all = dataset_cache.load_or_build("URM_all", URM_sources, read_URM)
+            ICM_all = dataset_cache.load_or_build("ICM_all", ICM_sources, lambda: _read_ICM(load_columns))
+
+            num_users = URM_all.shape[0]
+            UCM_all = dataset_cache.load_or_build("UCM_all", UCM_sources, lambda: _read_UCM(num_users, load_columns),
+                                                  build_key={"num_users": num_users})
+        else:
+            URM_all = read_URM()
+            ICM_all = _read_ICM(load_columns)
+            UCM_all = _read_UCM(URM_all.shape[0], load_columns)
+
+    for file_path, load_time in load_time_dict.items():
+        print("Loaded {} in {:.2f} sec".format(os.path.basename(file_path), load_time))
+
+    print("URM, ICM and UCM built in {:.2f} sec".format(time.time() - start_time))
+
+    return URM_all, ICM_all, UCM_all
+
+
+# -------------------------------------------------------------------------
+# Build Item Content Matrix with three features: asset, price and sub-class
+# -------------------------------------------------------------------------
+
+def build_ICM(use_cache=True):
+
+    if use_cache:
+        ICM_all = dataset_cache.load_or_build("ICM_all", [data_ICM_sub_class, data_ICM_price, data_ICM_asset], _read_ICM)
+    else:
+        ICM_all = _read_ICM()
 
     # item_feature_ratios(ICM_all)
 
@@ -223,57 +409,53 @@ def build_ICM():
     return ICM_all
 
 
-def build_UCM(URM):
+def _read_ICM(load_columns=None):
     # features = [‘asset’, ’price’, ’subclass’] info about products
 
+    if load_columns is None:
+        load_columns = load_csv_columns
+
     # Load subclass data
-    matrix_tuples = []
+    item_list_icm, class_list_icm, col_list = load_columns(data_ICM_sub_class)
 
-    with open(data_UCM_age, 'r') as file:  # read file's content
-        next(file)  # skip header row
-        for line in file:
-            # Create a tuple for each interaction (line in the file)
-            matrix_tuples.append(row_split(line))
+    col_list_icm = np.zeros(len(col_list), dtype=np.int32)
 
-    # Separate user_id and age
-    user_list, age_list, col_list = zip(*matrix_tuples)  # join tuples together (zip() to map values)
+    # Number of items that are in the subclass list
+    num_items = item_list_icm.max() + 1
+    ICM_shape = (num_items, 1)
+    ICM_subclass = csr_sparse_matrix(class_list_icm.astype(np.float32), item_list_icm, col_list_icm, shape=ICM_shape)
 
-    # Convert values to list# Create lists of all users and ages
-    user_list_icm = list(user_list)
-    age_list_icm = list(age_list)
-    col_list_icm = np.zeros(len(col_list))
+    ################################################################################################################
 
-    # Number of items that are in the subclass list
-    num_users = URM.shape[0]
-    UCM_shape = (num_users, 1)
-    UCM_age = csr_sparse_matrix(user_list_icm, age_list_icm, col_list_icm, shape=UCM_shape)
+    # Load price data
+    item_list_icm, col_list_icm, price_list_icm = load_columns(data_ICM_price)
 
-    # Load region data
-    matrix_tuples = []
-    global n_regions
+    ICM_price = csr_sparse_matrix(price_list_icm, item_list_icm, col_list_icm)
 
-    with open(data_UCM_region, 'r') as file:  # read file's content
-        next(file)  # skip header row
-        for line in file:
-            # Create a tuple for each interaction (line in the file)
-            matrix_tuples.append(row_split(line))
+    ################################################################################################################
 
-    # Separate user_id, item_id and rating
-    user_list, region_list, col_list = zip(*matrix_tuples)  # join tuples together (zip() to map values)
+    # Load asset data
+    item_list_icm, col_list_icm, asset_list_icm = load_columns(data_ICM_asset)
 
-    # Convert values to list# Create lists of all users, items and contents (ratings)
-    user_list_icm = list(user_list)
-    region_list_icm = list(region_list)
+    ICM_asset = csr_sparse_matrix(asset_list_icm, item_list_icm, col_list_icm)
 
-    n_regions = max(region_list_icm) + 1
+    ################################################################################################################
 
-    UCM_shape = (num_users, n_regions)
+    ICM_all = sps.hstack([ICM_price, ICM_asset, ICM_subclass], format='csr')
 
-    ones = np.ones(len(region_list_icm))
-    UCM_region = sps.coo_matrix((ones, (user_list_icm, region_list_icm)), shape = UCM_shape)
-    UCM_region = UCM_region.tocsr()
+    return ICM_all
 
-    UCM_all = sps.hstack([UCM_age, UCM_region], format='csr')
+
+def build_UCM(URM, use_cache=True):
+
+    # Number of users in the URM
+    num_users = URM.shape[0]
+
+    if use_cache:
+        UCM_all = dataset_cache.load_or_build("UCM_all", [data_UCM_age, data_UCM_region],
+                                              lambda: _read_UCM(num_users), build_key={"num_users": num_users})
+    else:
+        UCM_all = _read_UCM(num_users)
 
     # item_feature_ratios(ICM_all)
 
@@ -284,6 +466,36 @@ def build_UCM(URM):
     return UCM_all
 
 
+def _read_UCM(num_users, load_columns=None):
+    # features = [‘age’, ’region’] info about users
+
+    if load_columns is None:
+        load_columns = load_csv_columns
+
+    # Load age data
+    user_list_icm, age_list_icm, col_list = load_columns(data_UCM_age)
+
+    col_list_icm = np.zeros(len(col_list), dtype=np.int32)
+
+    UCM_shape = (num_users, 1)
+    UCM_age = csr_sparse_matrix(user_list_icm.astype(np.float64), age_list_icm, col_list_icm, shape=UCM_shape)
+
+    # Load region data
+    user_list_icm, region_list_icm, _ = load_columns(data_UCM_region)
+
+    n_regions = region_list_icm.max() + 1
+
+    UCM_shape = (num_users, n_regions)
+
+    ones = np.ones(len(region_list_icm), dtype=np.float32)
+    UCM_region = sps.coo_matrix((ones, (user_list_icm, region_list_icm)), shape = UCM_shape)
+    UCM_region = UCM_region.tocsr()
+
+    UCM_all = sps.hstack([UCM_age, UCM_region], format='csr')
+
+    return UCM_all
+
+
 # def get_statistics_ICM(self):
 #
 #     self._assert_is_initialized()
@@ -312,15 +524,13 @@ def build_UCM(URM):
 
 # Get all user_id list
 
-def get_user_list_unique():
-    list_unique = list(set(user_list))  # remove duplicates
-    return list_unique
+def get_user_list_unique(URM):
+    return DatasetReader(URM_all=URM).get_user_list_unique().tolist()
 
 
 # Get item_id list
-def get_item_list_unique():
-    list_unique = list(set(item_list))  # remove duplicates
-    return list_unique
+def get_item_list_unique(URM):
+    return DatasetReader(URM_all=URM).get_item_list_unique().tolist()
 
 
 # Get target user_id list
@@ -357,6 +567,7 @@ def get_user_profile(URM, user_id):
 
 # Get users that have no Train items
 def perc_user_no_item_train(URM_train):
+    n_users = URM_train.shape[0]
     user_no_item_train = np.sum(np.ediff1d(URM_train.indptr) == 0)
 
     if user_no_item_train != 0:
@@ -365,6 +576,43 @@ def perc_user_no_item_train(URM_train):
                                                                                  n_users))
 
 
+def load_csv_columns(file_path, column_dtypes=(np.int32, np.int32, np.float32)):
+    """
+    Reads a csv file with a header row (file format: 0,3568,1.0) in a single pass,
+    straight into one typed NumPy array per column. No Python object is created per line.
+    :param file_path:
+    :param column_dtypes:   dtype of each column, by default int32 ids and float32 values
+    :return:                tuple with one array per column
+    """
+
+    column_names = list(range(len(column_dtypes)))
+
+    data_frame = pd.read_csv(file_path, header=0, names=column_names, engine="c",
+                             skip_blank_lines=True,  # ignore lines with only whitespace
+                             dtype=dict(zip(column_names, column_dtypes)))
+
+    return tuple(data_frame[column].to_numpy() for column in column_names)
+
+
+def iterate_csv_chunks(file_path, chunk_size, column_dtypes=(np.int32, np.int32, np.float32)):
+    """
+    Same as load_csv_columns, but yields the columns of chunk_size lines at a time
+    """
+
+    column_names = list(range(len(column_dtypes)))
+
+    try:
+        chunk_reader = pd.read_csv(file_path, header=0, names=column_names, engine="c",
+                                   skip_blank_lines=True, chunksize=chunk_size,
+                                   dtype=dict(zip(column_names, column_dtypes)))
+    except pd.errors.EmptyDataError:
+        # Not even the header, there are no lines to yield
+        return
+
+    for data_frame in chunk_reader:
+        yield tuple(data_frame[column].to_numpy() for column in column_names)
+
+
 def row_split(row_string):
     # file format: 0,3568,1.0
 
@@ -397,33 +645,68 @@ def top_5_percept_popular_items(URM):
     # This is appropriate in cases where users can discover these items on their own,
     # and may not find these recommendations useful
 
-    # print("\n ... Item popularity ... ")4
-    item_popularity = (URM > 0).sum(axis=0)
-    item_popularity = np.array(item_popularity).squeeze()
-    item_popularity = np.sort(item_popularity)  # sorted array
+    return get_popularity_index(URM).popular_items
+
+
+class PopularityIndex(object):
+    """
+    Item popularity of a URM, computed once: the degree of each item, the items sorted by decreasing popularity
+    and a boolean mask flagging the popular ones, so that filtering them is a lookup instead of a search
+    """
+
+    def __init__(self, URM):
+        super(PopularityIndex, self).__init__()
+
+        URM = sps.csr_matrix(URM)
+        n_items = URM.shape[1]
+
+        # Number of positive interactions of each item
+        self.item_degree = np.bincount(URM.indices[URM.data > 0], minlength=n_items)
+
+        # We are not interested in sorting the popularity value,
+        # but to order the items according to it
+        self.popularity_order = np.flip(np.argsort(self.item_degree, kind="stable"), axis=0)
+
+        # The number of popular items is the degree of the item at the top 20% of the popularity ranking
+        top_percent = int(n_items / 5)
+        n_popular_items = int(self.item_degree[self.popularity_order[top_percent - 1]]) if top_percent > 0 \
+            else int(self.item_degree.min())
+
+        self.popular_items = self.popularity_order[0:n_popular_items]
+
+        self.popular_item_mask = np.zeros(n_items, dtype=bool)
+        self.popular_item_mask[self.popular_items] = True
+
+    def is_popular(self, item_id_array):
+        return self.popular_item_mask[item_id_array]
+
+    def filter_popular(self, ranking, cutoff=None):
+        """
+        :param ranking:     items sorted by decreasing score
+        :param cutoff:
+        :return:            the first cutoff items of the ranking that are not popular
+        """
+
+        ranking = np.asarray(ranking)
+        ranking = ranking[np.logical_not(self.popular_item_mask[ranking])]
+
+        return ranking[:cutoff]
 
-    n_items = URM.shape[1]
 
-    ten_percent = int(n_items / 5)
-    ten_percent_popular_items = item_popularity[-ten_percent].mean()
-    # print("Average per-item interactions for the top 10% popular items {:.2f}".
-    #       format(ten_percent_popular_items))
+# Popularity index of each URM in use, shared by all the recommenders trained on it.
+# Entries are removed as soon as the URM is garbage collected, the URM must not be modified afterwards.
+_popularity_index_by_URM = {}
 
-    # Number of cold items
-    # print("Number of items with zero interactions (cold items) {}".
-    #       format(np.sum(item_popularity == 0)))
 
-    item_popularity = (URM > 0).sum(axis=0)
-    item_popularity = np.array(item_popularity).squeeze()
+def get_popularity_index(URM):
 
-    # We are not interested in sorting the popularity value,
-    # but to order the items according to it
-    popular_items = np.argsort(item_popularity)  # sorted array indices
-    popular_items = np.flip(popular_items, axis=0)  # reverse order of elements along the given axis
+    URM_key = id(URM)
 
-    ten_perc_pop = popular_items[0:int(ten_percent_popular_items)]
+    if URM_key not in _popularity_index_by_URM:
+        _popularity_index_by_URM[URM_key] = PopularityIndex(URM)
+        weakref.finalize(URM, _popularity_index_by_URM.pop, URM_key, None)
 
-    return ten_perc_pop
+    return _popularity_index_by_URM[URM_key]
 
 
 def item_feature_ratios(ICM):
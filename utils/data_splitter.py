@@ -16,111 +16,210 @@ from utils.data_manager import csr_sparse_matrix
 
 # Leave One Out split: leave out one interaction/user ==> suggested for local split
 
-def split_train_leave_k_out_user_wise(URM, k_out = 1, use_validation_set = True, leave_random_out = True):
+def split_train_leave_k_out_user_wise(URM, k_out = 1, use_validation_set = True, leave_random_out = True, random_seed = None):
     """
-    The function splits an URM in two matrices selecting the k_out interactions one user at a time
+    The function splits an URM in two matrices selecting the k_out interactions one user at a time.
+    All users are processed at once: every interaction gets a sorting key (random, or its value when leave_random_out is False),
+    sorting by (user, key) ranks the interactions of each user and the splits are cut with one mask each.
+    The first k_out interactions of each user go in test, the following k_out in validation and the rest in train
     :param URM:
     :param k_out:
     :param use_validation_set:
     :param leave_random_out:
+    :param random_seed:         if None the global numpy random state is used
     :return:
     """
 
     assert k_out > 0, "k_out must be a value greater than 0, provided was '{}'".format(k_out)
 
-    URM = sps.csr_matrix(URM)
+    URM = _get_canonical_csr(URM)
     n_users, n_items = URM.shape
 
+    interaction_rank = _rank_interactions_user_wise(URM, leave_random_out = leave_random_out, random_seed = random_seed)
+
+    # Test interactions
+    URM_test = _csr_from_mask(URM, interaction_rank < k_out)
+
+    # Validation interactions
+    if use_validation_set:
+        URM_validation = _csr_from_mask(URM, (interaction_rank >= k_out) & (interaction_rank < 2*k_out))
+        first_train_rank = 2*k_out
+    else:
+        first_train_rank = k_out
+
+    # Train interactions
+    URM_train = _csr_from_mask(URM, interaction_rank >= first_train_rank)
+
+    user_no_item_train = np.sum(np.ediff1d(URM_train.indptr) == 0)
 
-    URM_train_builder = IncrementalSparseMatrix(auto_create_row_mapper=False, n_rows = n_users,
-                                        auto_create_col_mapper=False, n_cols = n_items)
+    if user_no_item_train != 0:
+        print("Warning: {} ({:.2f} %) of {} users have no Train items".format(user_no_item_train, user_no_item_train/n_users*100, n_users))
 
-    URM_test_builder = IncrementalSparseMatrix(auto_create_row_mapper=False, n_rows = n_users,
-                                        auto_create_col_mapper=False, n_cols = n_items)
 
     if use_validation_set:
-         URM_validation_builder = IncrementalSparseMatrix(auto_create_row_mapper=False, n_rows = n_users,
-                                                          auto_create_col_mapper=False, n_cols = n_items)
+        user_no_item_validation = np.sum(np.ediff1d(URM_validation.indptr) == 0)
 
+        if user_no_item_validation != 0:
+            print("Warning: {} ({:.2f} %) of {} users have no Validation items".format(user_no_item_validation, user_no_item_validation/n_users*100, n_users))
 
 
-    for user_id in range(n_users):
+        return URM_train, URM_validation, URM_test
 
-        start_user_position = URM.indptr[user_id]
-        end_user_position = URM.indptr[user_id+1]
 
-        user_profile = URM.indices[start_user_position:end_user_position]
+    return URM_train, URM_test
 
 
-        if leave_random_out:
-            indices_to_suffle = np.arange(len(user_profile), dtype=np.int)
+def _get_canonical_csr(URM):
 
-            np.random.shuffle(indices_to_suffle)
+    URM = sps.csr_matrix(URM)
 
-            user_interaction_items = user_profile[indices_to_suffle]
-            user_interaction_data = URM.data[start_user_position:end_user_position][indices_to_suffle]
+    if not URM.has_canonical_format:
+        URM = URM.copy()
+        URM.sum_duplicates()
 
-        else:
+    return URM
 
-            # The first will be sampled so the last interaction must be the first one
-            interaction_position = URM.data[start_user_position:end_user_position]
 
-            sort_interaction_index = np.argsort(-interaction_position)
+def _rank_interactions_user_wise(URM, leave_random_out = True, random_seed = None, random_state = None):
+    """
+    Ranks the interactions of each user, in random order or by decreasing value
+    :param URM:                 CSR matrix
+    :param leave_random_out:
+    :param random_seed:         if None the global numpy random state is used
+    :param random_state:        takes precedence over random_seed, to draw several rankings from the same sequence
+    :return:                    rank of each interaction within its row, aligned to URM.data
+    """
 
-            user_interaction_items = user_profile[sort_interaction_index]
-            user_interaction_data = URM.data[start_user_position:end_user_position][sort_interaction_index]
+    user_profile_length = np.ediff1d(URM.indptr)
+    interaction_user = np.repeat(np.arange(URM.shape[0], dtype=np.int32), user_profile_length)
 
+    # Sorting by (user, key) keeps the users in order, so the i-th sorted interaction belongs to the same user as the i-th one in the URM
+    if leave_random_out:
+        if random_state is None:
+            random_state = np.random.RandomState(random_seed) if random_seed is not None else np.random
 
-        #Test interactions
-        user_interaction_items_test = user_interaction_items[0:k_out]
-        user_interaction_data_test = user_interaction_data[0:k_out]
+        # A random key in [0, 1) added to the user index sorts as the pair (user, key),
+        # a single argsort of the almost sorted array is several times faster than lexsort
+        interaction_key = interaction_user + random_state.random_sample(URM.nnz)
+        sorted_interaction_position = np.argsort(interaction_key)
 
-        URM_test_builder.add_data_lists([user_id]*len(user_interaction_items_test), user_interaction_items_test, user_interaction_data_test)
+    else:
+        # The first will be sampled so the last interaction must be the first one
+        sorted_interaction_position = np.lexsort((-URM.data, interaction_user))
 
+    interaction_rank = np.empty(URM.nnz, dtype=np.int64)
+    interaction_rank[sorted_interaction_position] = np.arange(URM.nnz) - np.repeat(URM.indptr[:-1], user_profile_length)
 
-        #validation interactions
-        if use_validation_set:
-            user_interaction_items_validation = user_interaction_items[k_out:k_out*2]
-            user_interaction_data_validation = user_interaction_data[k_out:k_out*2]
+    return interaction_rank
 
-            URM_validation_builder.add_data_lists([user_id]*k_out, user_interaction_items_validation, user_interaction_data_validation)
 
+def _csr_from_mask(URM, interaction_mask):
+    """
+    Selects the interactions of a CSR matrix with a boolean mask, keeping its shape and the order of the columns in each row
+    :param URM:
+    :param interaction_mask:    aligned to URM.data
+    :return:
+    """
 
+    # The number of selected interactions before each row start is the new indptr
+    selected_before = np.zeros(URM.nnz + 1, dtype=URM.indptr.dtype)
+    np.cumsum(interaction_mask, out=selected_before[1:])
 
-        #Train interactions
-        user_interaction_items_train = user_interaction_items[k_out*2:]
-        user_interaction_data_train = user_interaction_data[k_out*2:]
+    sparseMatrix = sps.csr_matrix((URM.data[interaction_mask], URM.indices[interaction_mask], selected_before[URM.indptr]),
+                                  shape=URM.shape)
+    sparseMatrix.eliminate_zeros()
 
-        URM_train_builder.add_data_lists([user_id]*len(user_interaction_items_train), user_interaction_items_train, user_interaction_data_train)
+    return sparseMatrix
 
 
+class SplitFold(object):
+    """
+    One fold of a split generator. It only references the original URM and the shared fold assignment array,
+    the train and test matrices are built when requested and are not kept by the fold
+    """
 
-    URM_train = URM_train_builder.get_SparseMatrix()
-    URM_test = URM_test_builder.get_SparseMatrix()
+    def __init__(self, URM, interaction_fold, fold_index):
+        super(SplitFold, self).__init__()
 
+        self.URM = URM
+        self.fold_index = fold_index
+        self._interaction_fold = interaction_fold
 
-    URM_train = sps.csr_matrix(URM_train)
-    user_no_item_train = np.sum(np.ediff1d(URM_train.indptr) == 0)
+    def get_test_mask(self):
+        """
+        :return:    boolean mask over URM.data, True for the test interactions of this fold
+        """
+        return self._interaction_fold == self.fold_index
 
-    if user_no_item_train != 0:
-        print("Warning: {} ({:.2f} %) of {} users have no Train items".format(user_no_item_train, user_no_item_train/n_users*100, n_users))
+    def get_URM_train(self):
+        return _csr_from_mask(self.URM, ~self.get_test_mask())
 
+    def get_URM_test(self):
+        return _csr_from_mask(self.URM, self.get_test_mask())
 
+    def get_URM_train_test(self):
 
-    if use_validation_set:
-        URM_validation = URM_validation_builder.get_SparseMatrix()
+        test_mask = self.get_test_mask()
 
-        URM_validation = sps.csr_matrix(URM_validation)
-        user_no_item_validation = np.sum(np.ediff1d(URM_validation.indptr) == 0)
+        URM_test = _csr_from_mask(self.URM, test_mask)
+        np.logical_not(test_mask, out=test_mask)
+        URM_train = _csr_from_mask(self.URM, test_mask)
 
-        if user_no_item_validation != 0:
-            print("Warning: {} ({:.2f} %) of {} users have no Validation items".format(user_no_item_validation, user_no_item_validation/n_users*100, n_users))
+        return URM_train, URM_test
 
 
-        return URM_train, URM_validation, URM_test
+def split_k_fold_user_wise(URM, n_folds = 5, random_seed = None):
+    """
+    Generator of the folds of a user-wise k-fold split. The interactions of each user are shuffled and dealt to the folds
+    in turn, so every user has about 1/n_folds of its interactions in the test set of each fold.
+    The fold of each interaction is stored in a single int8 array shared by all the folds, one byte per nonzero
+    :param URM:
+    :param n_folds:
+    :param random_seed:     if None the global numpy random state is used
+    :return:                generator of SplitFold
+    """
 
+    assert 1 < n_folds <= np.iinfo(np.int8).max, \
+        "n_folds must be a value between 2 and {}, provided was '{}'".format(np.iinfo(np.int8).max, n_folds)
 
-    return URM_train, URM_test
+    URM = _get_canonical_csr(URM)
+    random_state = np.random.RandomState(random_seed) if random_seed is not None else np.random
+
+    interaction_rank = _rank_interactions_user_wise(URM, leave_random_out = True, random_state = random_state)
+
+    # Each user starts dealing from a random fold, otherwise the first folds would get the extra interactions of every user
+    user_first_fold = random_state.randint(0, n_folds, size=URM.shape[0])
+    interaction_rank += np.repeat(user_first_fold, np.ediff1d(URM.indptr))
+
+    interaction_fold = (interaction_rank % n_folds).astype(np.int8)
+
+    for fold_index in range(n_folds):
+        yield SplitFold(URM, interaction_fold, fold_index)
+
+
+def split_repeated_holdout_user_wise(URM, n_repetitions = 5, k_out = 1, random_seed = None):
+    """
+    Generator of n_repetitions independent leave-k-out splits, each drawn only when the generator reaches it
+    :param URM:
+    :param n_repetitions:
+    :param k_out:
+    :param random_seed:     if None the global numpy random state is used
+    :return:                generator of SplitFold
+    """
+
+    assert k_out > 0, "k_out must be a value greater than 0, provided was '{}'".format(k_out)
+
+    URM = _get_canonical_csr(URM)
+    random_state = np.random.RandomState(random_seed) if random_seed is not None else np.random
+
+    for _ in range(n_repetitions):
+
+        interaction_rank = _rank_interactions_user_wise(URM, leave_random_out = True, random_state = random_state)
+
+        # Fold 0 holds the test interactions
+        interaction_fold = (interaction_rank >= k_out).astype(np.int8)
+
+        yield SplitFold(URM, interaction_fold, 0)
 
 
 # Random holdout split: take interactions randomly
@@ -272,107 +371,450 @@ class IncrementalSparseMatrix_ListBased(object):
         return sparseMatrix
 
 
+class IncrementalIDMapper(object):
+    """
+    Maps original IDs to consecutive indices in order of first appearance.
+    Large arrays of IDs are mapped at once with a binary search over a sorted array of the known IDs, instead of one
+    dictionary access per element. Small batches, where the NumPy call overhead dominates, use a dictionary
+    and their new IDs are merged into the sorted array only when the next large batch arrives
+    """
+
+    _MAX_SMALL_BATCH_SIZE = 64
+
+    def __init__(self):
+        super(IncrementalIDMapper, self).__init__()
+
+        self._original_ID_to_index = {}
+
+        self._sorted_original_ID = None
+        self._sorted_index = np.zeros(0, dtype=np.int64)
+
+        # IDs added by small batches and not yet in the sorted array
+        self._pending_original_ID = []
+
+    def __len__(self):
+        return len(self._original_ID_to_index)
+
+    def _merge_into_sorted(self, new_ID, new_ID_index):
+
+        if self._sorted_original_ID is None:
+            merged_original_ID = new_ID
+            merged_index = new_ID_index
+        else:
+            merged_original_ID = np.concatenate((self._sorted_original_ID, new_ID))
+            merged_index = np.concatenate((self._sorted_index, new_ID_index))
+
+        merged_sorting = np.argsort(merged_original_ID, kind="stable")
+
+        self._sorted_original_ID = merged_original_ID[merged_sorting]
+        self._sorted_index = merged_index[merged_sorting]
+
+    def _get_index_small_batch(self, original_ID_list):
+
+        index_list = []
+
+        for original_ID in original_ID_list:
+
+            index = self._original_ID_to_index.get(original_ID)
+
+            if index is None:
+                index = len(self._original_ID_to_index)
+                self._original_ID_to_index[original_ID] = index
+                self._pending_original_ID.append(original_ID)
+
+            index_list.append(index)
+
+        return np.array(index_list, dtype=np.int64)
+
+    def get_index(self, original_ID_array):
+        """
+        Returns the index of each ID, the new IDs get the next free indices in the order they appear
+        :param original_ID_array:
+        :return:
+        """
+
+        if len(original_ID_array) <= self._MAX_SMALL_BATCH_SIZE:
+            original_ID_list = original_ID_array.tolist() if isinstance(original_ID_array, np.ndarray) else original_ID_array
+            return self._get_index_small_batch(original_ID_list)
+
+        original_ID_array = np.asarray(original_ID_array)
+
+        if len(self._pending_original_ID) > 0:
+            pending_original_ID = np.array(self._pending_original_ID, dtype=original_ID_array.dtype)
+            pending_index = np.array([self._original_ID_to_index[original_ID] for original_ID in self._pending_original_ID], dtype=np.int64)
+
+            self._merge_into_sorted(pending_original_ID, pending_index)
+            self._pending_original_ID = []
+
+        index = np.full(len(original_ID_array), -1, dtype=np.int64)
+
+        if self._sorted_original_ID is not None:
+            position = np.minimum(np.searchsorted(self._sorted_original_ID, original_ID_array), len(self._sorted_original_ID) - 1)
+            is_known = self._sorted_original_ID[position] == original_ID_array
+            index[is_known] = self._sorted_index[position[is_known]]
+
+        is_new = index == -1
+
+        if np.any(is_new):
+            new_ID, first_position = np.unique(original_ID_array[is_new], return_index=True)
+
+            new_ID_index = np.empty(len(new_ID), dtype=np.int64)
+            new_ID_index[np.argsort(first_position, kind="stable")] = len(self) + np.arange(len(new_ID))
+
+            self._original_ID_to_index.update(zip(new_ID.tolist(), new_ID_index.tolist()))
+            self._merge_into_sorted(new_ID, new_ID_index)
+
+            index[is_new] = new_ID_index[np.searchsorted(new_ID, original_ID_array[is_new])]
+
+        return index
+
+    def get_dictionary(self):
+        return self._original_ID_to_index.copy()
+
+
 class IncrementalSparseMatrix(IncrementalSparseMatrix_ListBased):
+    """
+    Accumulates the data points in preallocated arrays, whole NumPy arrays are copied at once and the capacity doubles
+    when it runs out. If the rows are appended in non decreasing order the CSR matrix is built directly, without going through COO
+    """
 
     def __init__(self, auto_create_col_mapper=False, auto_create_row_mapper=False, n_rows=None, n_cols=None,
-                 dtype=np.float64):
+                 dtype=np.float64, initial_capacity=100000):
 
-        super(IncrementalSparseMatrix, self).__init__(auto_create_col_mapper=auto_create_col_mapper,
-                                                      auto_create_row_mapper=auto_create_row_mapper,
+        super(IncrementalSparseMatrix, self).__init__(auto_create_col_mapper=False,
+                                                      auto_create_row_mapper=False,
                                                       n_rows=n_rows,
                                                       n_cols=n_cols)
 
-        self._dataBlock = 10000000
+        self._auto_create_column_mapper = auto_create_col_mapper
+        self._auto_create_row_mapper = auto_create_row_mapper
+
+        if self._auto_create_column_mapper:
+            self._column_mapper = IncrementalIDMapper()
+
+        if self._auto_create_row_mapper:
+            self._row_mapper = IncrementalIDMapper()
+
         self._next_cell_pointer = 0
 
         self._dtype_data = dtype
         self._dtype_coordinates = np.uint32
         self._max_value_of_coordinate_dtype = np.iinfo(self._dtype_coordinates).max
 
-        self._row_array = np.zeros(self._dataBlock, dtype=self._dtype_coordinates)
-        self._col_array = np.zeros(self._dataBlock, dtype=self._dtype_coordinates)
-        self._data_array = np.zeros(self._dataBlock, dtype=self._dtype_data)
+        self._row_array = np.zeros(initial_capacity, dtype=self._dtype_coordinates)
+        self._col_array = np.zeros(initial_capacity, dtype=self._dtype_coordinates)
+        self._data_array = np.zeros(initial_capacity, dtype=self._dtype_data)
+
+        # Whether the rows have been appended in non decreasing order
+        self._rows_sorted = True
+        self._last_row_index = 0
 
     def get_nnz(self):
         return self._next_cell_pointer
 
+    def _ensure_capacity(self, n_elements_to_add):
+
+        required_capacity = self._next_cell_pointer + n_elements_to_add
+
+        if required_capacity <= len(self._row_array):
+            return
+
+        # Geometric growth, so the total cost of the copies is linear in the number of elements
+        new_capacity = max(2 * len(self._row_array), required_capacity)
+
+        for array_name in ["_row_array", "_col_array", "_data_array"]:
+            old_array = getattr(self, array_name)
+            new_array = np.zeros(new_capacity, dtype=old_array.dtype)
+            new_array[:self._next_cell_pointer] = old_array[:self._next_cell_pointer]
+            setattr(self, array_name, new_array)
+
+    def _get_column_index(self, column_id):
+        return self._get_column_index_array([column_id])[0]
+
+    def _get_row_index(self, row_id):
+        return self._get_row_index_array([row_id])[0]
+
+    def _get_column_index_array(self, column_id_array):
+
+        if self._auto_create_column_mapper:
+            return self._column_mapper.get_index(column_id_array)
+
+        return np.asarray(column_id_array)
+
+    def _get_row_index_array(self, row_id_array):
+
+        if self._auto_create_row_mapper:
+            return self._row_mapper.get_index(row_id_array)
+
+        return np.asarray(row_id_array)
+
+    def get_column_token_to_id_mapper(self):
+
+        if self._auto_create_column_mapper:
+            return self._column_mapper.get_dictionary()
+
+        return super(IncrementalSparseMatrix, self).get_column_token_to_id_mapper()
+
+    def get_row_token_to_id_mapper(self):
+
+        if self._auto_create_row_mapper:
+            return self._row_mapper.get_dictionary()
+
+        return super(IncrementalSparseMatrix, self).get_row_token_to_id_mapper()
+
+    def _append_indices(self, row_index, col_index_array, data_to_add):
+        """
+        :param row_index:       a single row index for all the data points or one per data point
+        :param col_index_array:
+        :param data_to_add:     a single value for all the data points or one per data point
+        :return:
+        """
+
+        n_elements = len(col_index_array)
+
+        if n_elements == 0:
+            return
+
+        if np.ndim(row_index) == 0:
+            first_row_index = last_row_index = max_row_index = row_index
+            rows_non_decreasing = True
+        else:
+            first_row_index, last_row_index, max_row_index = row_index[0], row_index[-1], row_index.max()
+            rows_non_decreasing = n_elements == 1 or bool((row_index[1:] >= row_index[:-1]).all())
+
+        assert col_index_array.max() <= self._max_value_of_coordinate_dtype and \
+               max_row_index <= self._max_value_of_coordinate_dtype, \
+            "IncrementalSparseMatrix: coordinates exceed the maximum value of {}".format(self._dtype_coordinates)
+
+        if self._rows_sorted:
+            self._rows_sorted = rows_non_decreasing and (self._next_cell_pointer == 0 or first_row_index >= self._last_row_index)
+
+        self._last_row_index = last_row_index
+
+        self._ensure_capacity(n_elements)
+
+        end_cell_pointer = self._next_cell_pointer + n_elements
+
+        self._row_array[self._next_cell_pointer:end_cell_pointer] = row_index
+        self._col_array[self._next_cell_pointer:end_cell_pointer] = col_index_array
+        self._data_array[self._next_cell_pointer:end_cell_pointer] = data_to_add
+
+        self._next_cell_pointer = end_cell_pointer
+
     def add_data_lists(self, row_list_to_add, col_list_to_add, data_list_to_add):
 
         assert len(row_list_to_add) == len(col_list_to_add) and len(row_list_to_add) == len(data_list_to_add), \
             "IncrementalSparseMatrix: element lists must have the same length"
 
-        for data_point_index in range(len(row_list_to_add)):
+        self._append_indices(np.atleast_1d(self._get_row_index_array(row_list_to_add)),
+                             np.atleast_1d(self._get_column_index_array(col_list_to_add)),
+                             np.asarray(data_list_to_add))
 
-            if self._next_cell_pointer == len(self._row_array):
-                self._row_array = np.concatenate(
-                    (self._row_array, np.zeros(self._dataBlock, dtype=self._dtype_coordinates)))
-                self._col_array = np.concatenate(
-                    (self._col_array, np.zeros(self._dataBlock, dtype=self._dtype_coordinates)))
-                self._data_array = np.concatenate((self._data_array, np.zeros(self._dataBlock, dtype=self._dtype_data)))
+    def add_single_row(self, row_index, col_list, data=1.0):
+        """
+        :param row_index:
+        :param col_list:
+        :param data:        a single value for all the columns or one value per column
+        :return:
+        """
 
-            row_index = self._get_row_index(row_list_to_add[data_point_index])
-            col_index = self._get_column_index(col_list_to_add[data_point_index])
+        if self._auto_create_row_mapper:
+            row_index = self._get_row_index(row_index)
 
-            self._row_array[self._next_cell_pointer] = row_index
-            self._col_array[self._next_cell_pointer] = col_index
-            self._data_array[self._next_cell_pointer] = data_list_to_add[data_point_index]
+        self._append_indices(row_index, np.atleast_1d(self._get_column_index_array(col_list)), data)
 
-            self._next_cell_pointer += 1
+    def get_data_arrays(self):
+        """
+        Returns the data points in the order they were added, explicit zeros and duplicates included
+        :return:    row_array, col_array, data_array
+        """
 
-    def add_single_row(self, row_index, col_list, data=1.0):
+        return self._row_array[:self._next_cell_pointer].copy(), \
+               self._col_array[:self._next_cell_pointer].copy(), \
+               self._data_array[:self._next_cell_pointer].copy()
 
-        n_elements = len(col_list)
+    def get_SparseMatrix(self):
 
-        self.add_data_lists([row_index] * n_elements,
-                            col_list,
-                            [data] * n_elements)
+        row_array = self._row_array[:self._next_cell_pointer]
+        col_array = self._col_array[:self._next_cell_pointer]
+        data_array = self._data_array[:self._next_cell_pointer]
 
-    def get_SparseMatrix(self):
         if self._n_rows is None:
-            self._n_rows = self._row_array.max() + 1
+            self._n_rows = row_array.max() + 1 if self._next_cell_pointer > 0 else 0
 
         if self._n_cols is None:
-            self._n_cols = self._col_array.max() + 1
+            self._n_cols = col_array.max() + 1 if self._next_cell_pointer > 0 else 0
 
         shape = (self._n_rows, self._n_cols)
 
-        sparseMatrix = sps.csr_matrix((self._data_array[:self._next_cell_pointer],
-                                       (self._row_array[:self._next_cell_pointer],
-                                        self._col_array[:self._next_cell_pointer])),
-                                      shape=shape,
-                                      dtype=self._dtype_data)
+        if self._rows_sorted:
+            index_dtype = np.int32 if max(self._n_rows, self._n_cols, self._next_cell_pointer) < 2 ** 31 else np.int64
+
+            indptr = np.zeros(self._n_rows + 1, dtype=index_dtype)
+            np.cumsum(np.bincount(row_array, minlength=self._n_rows), out=indptr[1:])
+
+            sparseMatrix = sps.csr_matrix((data_array.copy(), col_array.astype(index_dtype), indptr), shape=shape)
+
+            # Same result of the COO constructor: columns sorted and duplicates summed within each row
+            sparseMatrix.sum_duplicates()
+
+        else:
+            sparseMatrix = sps.csr_matrix((data_array, (row_array, col_array)), shape=shape, dtype=self._dtype_data)
 
         sparseMatrix.eliminate_zeros()
 
         return sparseMatrix
 
 
-def assert_disjoint_matrices(URM_list):
+def _iterate_user_blocks(URM_list, max_block_nnz):
     """
-    Checks whether the URM in the list have an empty intersection, therefore there is no data point contained in more than one
-    URM at a time
-    :param URM_list:
-    :return:
+    Splits the users in contiguous blocks, each holding about max_block_nnz data points summed over all the URM
     """
 
-    URM_implicit_global = None
-
-    cumulative_nnz = 0
+    cumulative_nnz = np.zeros(URM_list[0].shape[0] + 1, dtype=np.int64)
 
     for URM in URM_list:
+        cumulative_nnz += URM.indptr
+
+    start_user = 0
+    n_users = URM_list[0].shape[0]
+
+    while start_user < n_users:
+        end_user = np.searchsorted(cumulative_nnz, cumulative_nnz[start_user] + max_block_nnz, side="right") - 1
+        end_user = min(max(end_user, start_user + 1), n_users)
 
-        cumulative_nnz += URM.nnz
-        URM_implicit = URM.copy()
-        URM_implicit.data = np.ones_like(URM_implicit.data)
+        yield start_user, end_user
 
-        if URM_implicit_global is None:
-            URM_implicit_global = URM_implicit
+        start_user = end_user
 
+
+def _get_block_coordinates(URM, start_user, end_user):
+    """
+    :return:    (user, item) of each data point of the block encoded as a single int64 key, and its value
+    """
+
+    start_position, end_position = URM.indptr[start_user], URM.indptr[end_user]
+
+    block_user = np.repeat(np.arange(end_user - start_user, dtype=np.int64), np.ediff1d(URM.indptr[start_user:end_user + 1]))
+    block_key = block_user * URM.shape[1] + URM.indices[start_position:end_position]
+
+    return block_key, URM.data[start_position:end_position]
+
+
+def _is_in_sorted(key_array, sorted_key_array):
+
+    if len(sorted_key_array) == 0:
+        return np.zeros(len(key_array), dtype=np.bool_)
+
+    position = np.minimum(np.searchsorted(sorted_key_array, key_array), len(sorted_key_array) - 1)
+
+    return sorted_key_array[position] == key_array
+
+
+def check_split_integrity(URM_list, URM_all = None, k_out = None, test_URM_index = -1, max_block_nnz = 2 ** 18):
+    """
+    Checks a split one block of users at a time, so the extra memory is O(n_users) plus one block, instead of full copies of the URM.
+    In each block the coordinates of all the URM are sorted together:
+    - a coordinate appearing twice belongs to more than one URM
+    - if URM_all is given, the coordinates and values must be exactly those of URM_all (train U test = all)
+    - if k_out is given, the test URM must have min(k_out, profile length) interactions for each user
+    :param URM_list:        URM of the split, e.g. [URM_train, URM_validation, URM_test]
+    :param URM_all:
+    :param k_out:
+    :param test_URM_index:  position of the test URM in the list
+    :param max_block_nnz:
+    :return:                dictionary with the number of problems found of each kind, all zero for a valid split
+    """
+
+    URM_list = [sps.csr_matrix(URM) for URM in URM_list]
+
+    assert all(URM.shape == URM_list[0].shape for URM in URM_list), \
+        "check_split_integrity: URM in list have different shapes {}".format([URM.shape for URM in URM_list])
+
+    if URM_all is not None:
+        URM_all = sps.csr_matrix(URM_all)
+
+        assert URM_all.shape == URM_list[0].shape, \
+            "check_split_integrity: URM_all has shape {}, split has shape {}".format(URM_all.shape, URM_list[0].shape)
+
+    integrity_dict = {"overlapping_data_points": 0}
+
+    if URM_all is not None:
+        integrity_dict["missing_data_points"] = 0
+        integrity_dict["extra_data_points"] = 0
+        integrity_dict["different_values"] = 0
+
+    for start_user, end_user in _iterate_user_blocks(URM_list + ([URM_all] if URM_all is not None else []), max_block_nnz):
+
+        block_coordinates = [_get_block_coordinates(URM, start_user, end_user) for URM in URM_list]
+
+        split_key = np.concatenate([block_key for block_key, _ in block_coordinates])
+
+        if URM_all is None:
+            # Only the coordinates are needed, sort them in place
+            split_key.sort()
         else:
-            URM_implicit_global += URM_implicit
+            split_sorting = np.argsort(split_key, kind="stable")
+            split_key = split_key[split_sorting]
+            split_data = np.concatenate([block_data for _, block_data in block_coordinates])[split_sorting]
+
+        integrity_dict["overlapping_data_points"] += int(np.count_nonzero(split_key[1:] == split_key[:-1]))
+
+        if URM_all is None:
+            continue
+
+        all_key, all_data = _get_block_coordinates(URM_all, start_user, end_user)
+
+        all_sorting = np.argsort(all_key, kind="stable")
+        all_key = all_key[all_sorting]
+        all_data = all_data[all_sorting]
+
+        integrity_dict["missing_data_points"] += int(np.count_nonzero(~_is_in_sorted(all_key, split_key)))
+        integrity_dict["extra_data_points"] += int(np.count_nonzero(~_is_in_sorted(split_key, all_key)))
+
+        if np.array_equal(split_key, all_key):
+            integrity_dict["different_values"] += int(np.count_nonzero(split_data != all_data))
+
+    if k_out is not None:
+        URM_test = URM_list[test_URM_index]
+
+        if URM_all is not None:
+            profile_length = np.ediff1d(URM_all.indptr)
+        else:
+            profile_length = sum(np.ediff1d(URM.indptr) for URM in URM_list)
+
+        expected_test_length = np.minimum(k_out, profile_length)
+        integrity_dict["users_with_wrong_k_out"] = int(np.count_nonzero(np.ediff1d(URM_test.indptr) != expected_test_length))
+
+    return integrity_dict
+
+
+def assert_split_integrity(URM_list, URM_all = None, k_out = None, test_URM_index = -1):
+    """
+    Same checks of check_split_integrity, raises an AssertionError describing the problems found
+    """
+
+    integrity_dict = check_split_integrity(URM_list, URM_all = URM_all, k_out = k_out, test_URM_index = test_URM_index)
+
+    problem_list = ["{} {}".format(n_problems, problem_name.replace("_", " "))
+                    for problem_name, n_problems in integrity_dict.items() if n_problems != 0]
+
+    assert len(problem_list) == 0, "assert_split_integrity: split is not valid, {}".format(", ".join(problem_list))
+
+    return True
+
+
+def assert_disjoint_matrices(URM_list):
+    """
+    Checks whether the URM in the list have an empty intersection, therefore there is no data point contained in more than one
+    URM at a time
+    :param URM_list:
+    :return:
+    """
+
+    n_overlapping = check_split_integrity(URM_list)["overlapping_data_points"]
 
-    assert cumulative_nnz == URM_implicit_global.nnz, \
-        "assert_disjoint_matrices: URM in list are not disjoint, {} data points are in more than one URM".format(
-            cumulative_nnz - URM_implicit_global.nnz)
+    assert n_overlapping == 0, \
+        "assert_disjoint_matrices: URM in list are not disjoint, {} data points are in more than one URM".format(n_overlapping)
 
     return True
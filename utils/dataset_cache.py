@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+#  -*- coding: utf-8 -*-
+
+"""
+	dataset_cache.py: binary cache for the sparse matrices built from the dataset csv files.
+	Each CSR matrix is stored as aligned .npy files (indptr, indices, data) that are reopened memory-mapped,
+	so a warm start does not parse the csv files and parallel processes share the same mapped pages.
+"""
+
+import os
+import json
+import hashlib
+import shutil
+import contextlib
+
+import numpy as np
+import scipy.sparse as sps
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+def compute_file_hash(file_path, chunk_size=2 ** 20):
+    """
+    Content hash of a file, read in chunks to keep the memory constant
+    :param file_path:
+    :param chunk_size:
+    :return:            hex digest
+    """
+
+    content_hash = hashlib.sha1()
+
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            content_hash.update(chunk)
+
+    return content_hash.hexdigest()
+
+
+@contextlib.contextmanager
+def file_lock(lock_path, shared=False):
+    """
+    Holds an advisory lock on lock_path, shared by the processes reading an entry or exclusive for the one replacing it.
+    Without fcntl (e.g. on Windows) the processes are not synchronized
+    :param lock_path:
+    :param shared:
+    :return:
+    """
+
+    if fcntl is None:
+        yield
+        return
+
+    with open(lock_path, 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def get_file_signature(file_path):
+    """
+    Size, mtime and content hash of a source file, used to detect when the cache must be rebuilt
+    :param file_path:
+    :return:
+    """
+
+    file_stat = os.stat(file_path)
+
+    return {"size": file_stat.st_size,
+            "mtime": file_stat.st_mtime,
+            "hash": compute_file_hash(file_path)}
+
+
+def save_sparse_npy(folder_path, matrix_name, sparse_matrix):
+    """
+    Saves the CSR components of the matrix as three .npy files, which can be opened memory-mapped
+    :param folder_path:
+    :param matrix_name:
+    :param sparse_matrix:
+    :return:
+    """
+
+    sparse_matrix = sps.csr_matrix(sparse_matrix)
+
+    if not os.path.exists(folder_path):
+        os.makedirs(folder_path)
+
+    for attribute_name in ["indptr", "indices", "data"]:
+        # np.save pads the header so that the array data starts on an aligned offset
+        # allow_pickle is FALSE to prevent using pickle and ensure portability
+        np.save(os.path.join(folder_path, "{}_{}.npy".format(matrix_name, attribute_name)),
+                getattr(sparse_matrix, attribute_name), allow_pickle=False)
+
+    with open(os.path.join(folder_path, "{}_shape.json".format(matrix_name)), 'w') as json_file:
+        json.dump([int(dimension) for dimension in sparse_matrix.shape], json_file)
+
+
+def load_sparse_shape(folder_path, matrix_name):
+    """
+    Shape of a matrix saved with save_sparse_npy, without opening its arrays
+    """
+
+    with open(os.path.join(folder_path, "{}_shape.json".format(matrix_name)), 'r') as json_file:
+        return tuple(json.load(json_file))
+
+
+def load_sparse_npy(folder_path, matrix_name, mmap_mode="c"):
+    """
+    Reopens a matrix saved with save_sparse_npy without copying its arrays
+    :param folder_path:
+    :param matrix_name:
+    :param mmap_mode:   "c" (copy-on-write) shares the pages among processes and keeps any in-place change private,
+                        "r" is read-only, None loads the arrays in memory
+    :return:            CSR matrix backed by the .npy files
+    """
+
+    shape = load_sparse_shape(folder_path, matrix_name)
+
+    indptr, indices, data = [np.load(os.path.join(folder_path, "{}_{}.npy".format(matrix_name, attribute_name)),
+                                     mmap_mode=mmap_mode, allow_pickle=False)
+                             for attribute_name in ["indptr", "indices", "data"]]
+
+    return sps.csr_matrix((data, indices, indptr), shape=shape, copy=False)
+
+
+class DatasetCache(object):
+    """
+    Caches the matrices built from the csv files. Each entry is keyed by the size, mtime and content hash
+    of its source files, plus an optional build key, and is rebuilt automatically when any of them changes.
+    """
+
+    _MANIFEST_FILE_NAME = "manifest.json"
+
+    def __init__(self, folder_path, mmap_mode="c", verbose=True):
+        super(DatasetCache, self).__init__()
+
+        self.folder_path = folder_path
+        self.mmap_mode = mmap_mode
+        self.verbose = verbose
+
+    def _print(self, message):
+        if self.verbose:
+            print("{}: {}".format("DatasetCache", message))
+
+    def _get_entry_folder(self, matrix_name):
+        return os.path.join(self.folder_path, matrix_name)
+
+    def _lock(self, matrix_name, shared=False):
+
+        if not os.path.exists(self.folder_path):
+            os.makedirs(self.folder_path, exist_ok=True)
+
+        return file_lock(os.path.join(self.folder_path, "{}.lock".format(matrix_name)), shared=shared)
+
+    def _load_manifest(self, matrix_name):
+
+        manifest_path = os.path.join(self._get_entry_folder(matrix_name), self._MANIFEST_FILE_NAME)
+
+        if not os.path.exists(manifest_path):
+            return None
+
+        with open(manifest_path, 'r') as json_file:
+            return json.load(json_file)
+
+    def _save_manifest(self, folder_path, manifest):
+
+        # Replaced atomically, the readers holding a shared lock may update the mtime of the sources at the same time
+        manifest_path = os.path.join(folder_path, self._MANIFEST_FILE_NAME)
+        temp_manifest_path = "{}.temp_{}".format(manifest_path, os.getpid())
+
+        with open(temp_manifest_path, 'w') as json_file:
+            json.dump(manifest, json_file)
+
+        os.replace(temp_manifest_path, manifest_path)
+
+    def _sources_unchanged(self, manifest, source_file_list):
+        """
+        Size and mtime are checked first, the content hash is computed only when the mtime differs,
+        so touching a file without changing it does not invalidate the cache
+        """
+
+        if sorted(manifest["sources"].keys()) != sorted(source_file_list):
+            return False
+
+        manifest_changed = False
+
+        for file_path in source_file_list:
+
+            if not os.path.exists(file_path):
+                return False
+
+            cached_signature = manifest["sources"][file_path]
+            file_stat = os.stat(file_path)
+
+            if file_stat.st_size != cached_signature["size"]:
+                return False
+
+            if file_stat.st_mtime != cached_signature["mtime"]:
+
+                if compute_file_hash(file_path) != cached_signature["hash"]:
+                    return False
+
+                cached_signature["mtime"] = file_stat.st_mtime
+                manifest_changed = True
+
+        if manifest_changed:
+            self._save_manifest(self._get_entry_folder(manifest["matrix_name"]), manifest)
+
+        return True
+
+    def is_valid(self, matrix_name, source_file_list, build_key=None):
+        """
+        Whether the cached entry exists and is up to date with its source files and build key
+        """
+
+        manifest = self._load_manifest(matrix_name)
+
+        return manifest is not None and manifest["build_key"] == build_key and \
+               self._sources_unchanged(manifest, source_file_list)
+
+    def get_shape(self, matrix_name):
+        """
+        Shape of the cached matrix, read from its entry without loading it. Check is_valid first
+        """
+
+        with self._lock(matrix_name, shared=True):
+            return load_sparse_shape(self._get_entry_folder(matrix_name), matrix_name)
+
+    def load_or_build(self, matrix_name, source_file_list, build_function, build_key=None):
+        """
+        Returns the cached matrix memory-mapped if it is still valid, otherwise calls build_function and caches its result
+        :param matrix_name:
+        :param source_file_list:    csv files the matrix is built from
+        :param build_function:      function without arguments returning the sparse matrix
+        :param build_key:           json serializable value with any other input the matrix depends on
+        :return:
+        """
+
+        entry_folder = self._get_entry_folder(matrix_name)
+
+        # The entry is checked and opened under a shared lock, it is replaced under an exclusive one, so no process
+        # removes a folder another one is opening. Once open, the memory-mapped arrays outlive the folder
+        with self._lock(matrix_name, shared=True):
+            if self.is_valid(matrix_name, source_file_list, build_key=build_key):
+                self._print("Loading '{}' from cache".format(matrix_name))
+                return load_sparse_npy(entry_folder, matrix_name, mmap_mode=self.mmap_mode)
+
+        with self._lock(matrix_name):
+
+            # Another process may have built it while this one waited for the lock
+            if self.is_valid(matrix_name, source_file_list, build_key=build_key):
+                self._print("Loading '{}' from cache".format(matrix_name))
+                return load_sparse_npy(entry_folder, matrix_name, mmap_mode=self.mmap_mode)
+
+            self._print("Cache for '{}' missing or outdated, building it".format(matrix_name))
+
+            sparse_matrix = build_function()
+
+            manifest = {"matrix_name": matrix_name,
+                        "build_key": build_key,
+                        "sources": {file_path: get_file_signature(file_path) for file_path in source_file_list}}
+
+            # Write in a temporary folder and move it in place, so that a failed build never leaves
+            # a partially written entry behind
+            temp_folder = "{}.temp_{}".format(entry_folder, os.getpid())
+
+            shutil.rmtree(temp_folder, ignore_errors=True)
+            save_sparse_npy(temp_folder, matrix_name, sparse_matrix)
+            self._save_manifest(temp_folder, manifest)
+
+            shutil.rmtree(entry_folder, ignore_errors=True)
+            os.replace(temp_folder, entry_folder)
+
+            return load_sparse_npy(entry_folder, matrix_name, mmap_mode=self.mmap_mode)
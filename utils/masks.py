@@ -90,4 +90,112 @@ def refactor_URM_ICM(URM, ICM):
     URM = URM[warm_users_2, :]
     URM = URM.tocsr()
 
-    return URM, ICM
\ No newline at end of file
+    return URM, ICM
+
+# Dense ID compaction
+# -------------------
+
+class IDMapper(object):
+    """
+    Reversible mapping between the original IDs and the dense indices left after removing the cold ones.
+    Both directions are int32 arrays, original IDs that were removed (or never existed) map to -1
+    """
+
+    def __init__(self, kept_ID_mask):
+        super(IDMapper, self).__init__()
+
+        kept_ID_mask = np.asarray(kept_ID_mask, dtype=bool)
+
+        self.n_original_IDs = len(kept_ID_mask)
+
+        self.dense_to_original = np.flatnonzero(kept_ID_mask).astype(np.int32)
+        self.original_to_dense = np.full(self.n_original_IDs, -1, dtype=np.int32)
+        self.original_to_dense[self.dense_to_original] = np.arange(len(self.dense_to_original), dtype=np.int32)
+
+    def __len__(self):
+        return len(self.dense_to_original)
+
+    def to_dense(self, original_ID_array):
+        """
+        :param original_ID_array:
+        :return:    dense indices, -1 for the IDs that have been removed
+        """
+
+        original_ID_array = np.asarray(original_ID_array)
+        dense_ID_array = np.full(original_ID_array.shape, -1, dtype=np.int32)
+
+        in_range_mask = np.logical_and(original_ID_array >= 0, original_ID_array < self.n_original_IDs)
+        dense_ID_array[in_range_mask] = self.original_to_dense[original_ID_array[in_range_mask]]
+
+        return dense_ID_array
+
+    def to_original(self, dense_ID_array):
+        """
+        :param dense_ID_array:
+        :return:    original IDs, -1 for the indices that are not dense IDs, e.g. the -1 of a removed or padding ID
+        """
+
+        dense_ID_array = np.asarray(dense_ID_array, dtype=np.int64)
+        original_ID_array = np.full(dense_ID_array.shape, -1, dtype=np.int32)
+
+        in_range_mask = np.logical_and(dense_ID_array >= 0, dense_ID_array < len(self.dense_to_original))
+        original_ID_array[in_range_mask] = self.dense_to_original[dense_ID_array[in_range_mask]]
+
+        return original_ID_array
+
+
+class DatasetCompaction(object):
+    """
+    Removes cold users (no interactions), cold items (no interactions) and cold features (no warm item or user
+    with that feature), renumbering the remaining ones densely. All n_items x n_items similarities and score
+    batches computed on the compacted matrices only span the warm items.
+    Any other matrix with the original shape (e.g. a split of the same URM) is compacted with the same mappers.
+    """
+
+    def __init__(self, URM, ICM=None, UCM=None):
+        super(DatasetCompaction, self).__init__()
+
+        URM = sps.csr_matrix(URM)
+
+        self.user_mapper = IDMapper(np.ediff1d(URM.indptr) > 0)
+        self.item_mapper = IDMapper(np.bincount(URM.indices, minlength=URM.shape[1]) > 0)
+
+        self.ICM_feature_mapper = None
+        self.UCM_feature_mapper = None
+
+        if ICM is not None:
+            ICM_warm_items = sps.csr_matrix(ICM)[self.item_mapper.dense_to_original, :]
+            self.ICM_feature_mapper = IDMapper(np.bincount(ICM_warm_items.indices, minlength=ICM.shape[1]) > 0)
+
+        if UCM is not None:
+            UCM_warm_users = sps.csr_matrix(UCM)[self.user_mapper.dense_to_original, :]
+            self.UCM_feature_mapper = IDMapper(np.bincount(UCM_warm_users.indices, minlength=UCM.shape[1]) > 0)
+
+        print("DatasetCompaction: kept {} of {} users, {} of {} items".format(
+            len(self.user_mapper), self.user_mapper.n_original_IDs,
+            len(self.item_mapper), self.item_mapper.n_original_IDs))
+
+    def compact_URM(self, URM):
+
+        assert URM.shape == (self.user_mapper.n_original_IDs, self.item_mapper.n_original_IDs), \
+            "DatasetCompaction: URM shape {} is not the original one".format(URM.shape)
+
+        URM = sps.csr_matrix(URM)[self.user_mapper.dense_to_original, :]
+
+        return URM[:, self.item_mapper.dense_to_original].tocsr()
+
+    def compact_ICM(self, ICM):
+
+        assert self.ICM_feature_mapper is not None, "DatasetCompaction: no ICM was provided when building the mappers"
+
+        ICM = sps.csr_matrix(ICM)[self.item_mapper.dense_to_original, :]
+
+        return ICM[:, self.ICM_feature_mapper.dense_to_original].tocsr()
+
+    def compact_UCM(self, UCM):
+
+        assert self.UCM_feature_mapper is not None, "DatasetCompaction: no UCM was provided when building the mappers"
+
+        UCM = sps.csr_matrix(UCM)[self.user_mapper.dense_to_original, :]
+
+        return UCM[:, self.UCM_feature_mapper.dense_to_original].tocsr()
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+#  -*- coding: utf-8 -*-
+
+"""
+	similarity_cache.py: cache of the raw dot products and column norms of the KNN similarities. They depend only on
+	the data, the similarity type and the row weights, so the variants with any topK, shrink and normalize
+	are derived from them by renormalizing and pruning, without computing the products again.
+"""
+
+import functools
+
+import numpy as np
+import scipy.sparse as sps
+
+from utils.artifact_cache import ArtifactCache
+from utils.compute_similarity import Compute_Similarity, Compute_Similarity_Python
+
+
+class SimilarityCache(object):
+    """
+    Computes the similarities of a hyperparameter search from a cached base, one for each data matrix,
+    similarity type and row weights.
+
+        similarity_cache = SimilarityCache("result_experiments/similarity_cache/", K_max=1000)
+        recommender.fit(topK=100, shrink=50, similarity="cosine", similarity_cache=similarity_cache)
+
+    The base keeps the K_max largest dot products of each column: the derived similarity is the same as the one
+    computed from scratch for the columns with at most K_max nonzero products, whose base holds all of them whatever
+    the shrink and the asymmetric alpha. The other columns are computed again from scratch and replace the derived ones,
+    the whole similarity when they are more than max_recomputed_fraction of the columns, e.g. most users of UserKNNCF.
+    Euclidean similarity and topK above K_max are computed from scratch.
+
+    Jaccard, Tanimoto, Dice and Tversky share the same base of co-occurrence counts and degrees.
+    """
+
+    # Parameters that change the normalization only, the base does not depend on them
+    _NORMALIZATION_ARGS = ["asymmetric_alpha", "tversky_alpha", "tversky_beta"]
+
+    # The set similarities are computed from the same co-occurrence counts. Their base is ranked on Dice, without shrink
+    # it orders the columns as Jaccard and as Tversky with equal alpha and beta
+    _SET_SIMILARITIES = ["jaccard", "tanimoto", "dice", "tversky"]
+
+    # Parameters that change how the base is computed but not its values, they are not part of its key
+    _EXECUTION_ARGS = ["n_workers", "memory_budget_bytes", "sparse_density_threshold", "use_symmetry"]
+
+    def __init__(self, folder_path, K_max=1000, max_recomputed_fraction=0.2, max_memory_bytes=2 ** 30, verbose=True):
+        super(SimilarityCache, self).__init__()
+
+        self.K_max = K_max
+        self.max_recomputed_fraction = max_recomputed_fraction
+        self.verbose = verbose
+
+        self._artifact_cache = ArtifactCache(folder_path, max_memory_bytes=max_memory_bytes, verbose=verbose)
+
+    def _print(self, message):
+        if self.verbose:
+            print("{}: {}".format("SimilarityCache", message))
+
+    def _compute_base(self, dataMatrix, similarity, row_weights, K_max, **execution_args):
+
+        similarity_object = Compute_Similarity_Python(dataMatrix, topK=K_max, similarity=similarity,
+                                                      row_weights=row_weights, **execution_args)
+
+        return similarity_object.compute_raw_similarity()
+
+    @staticmethod
+    def _compute_column_product_count(dataMatrix, max_product_nnz=10 ** 7):
+
+        # Number of other columns sharing a row with each column, an upper bound of its nonzero products after
+        # any transformation of the nonzero values. Computed on blocks of columns of at most max_product_nnz values
+        data_pattern = sps.csc_matrix(dataMatrix, dtype=np.float32, copy=True)
+        data_pattern.data[:] = 1.0
+
+        data_pattern_T = data_pattern.T.tocsr()
+        n_columns = data_pattern.shape[1]
+
+        block_size = max(1, max_product_nnz // max(1, n_columns))
+        column_product_count = np.zeros(n_columns, dtype=np.int64)
+
+        for start_col in range(0, n_columns, block_size):
+            end_col = min(start_col + block_size, n_columns)
+
+            block_product = data_pattern_T.dot(data_pattern[:, start_col:end_col]).tocsc()
+            has_self_product = np.diff(data_pattern.indptr[start_col:end_col + 1]) > 0
+
+            column_product_count[start_col:end_col] = np.diff(block_product.indptr) - has_self_product
+
+        return column_product_count
+
+    def get_column_product_count(self, dataMatrix):
+        """
+        Returns the number of nonzero products of each column with the others, from the cache or computing it
+        :param dataMatrix:
+        :return:
+        """
+
+        return self._artifact_cache.get_or_compute("similarity_column_product_count", self._compute_column_product_count,
+                                                   dataMatrix)
+
+    def _compute_similarity_columns(self, dataMatrix, column_id_array, **similarity_args):
+        """
+        Computes the similarity of the given columns from scratch, moving them to the first columns of dataMatrix
+        :param column_id_array:   sorted columns
+        :return:                  COO matrix whose nonzero columns are the TopK of the given columns
+        """
+
+        dataMatrix = sps.csc_matrix(dataMatrix)
+        n_columns = dataMatrix.shape[1]
+
+        is_selected = np.zeros(n_columns, dtype=np.bool_)
+        is_selected[column_id_array] = True
+
+        column_order = np.concatenate((column_id_array, np.flatnonzero(~is_selected)))
+
+        similarity_object = Compute_Similarity(dataMatrix[:, column_order], **similarity_args)
+        W_columns = similarity_object.compute_similarity(end_col=len(column_id_array)).tocoo()
+
+        return sps.coo_matrix((W_columns.data, (column_order[W_columns.row], column_id_array[W_columns.col])),
+                              shape=(n_columns, n_columns))
+
+    def get_base(self, dataMatrix, similarity="cosine", row_weights=None, **execution_args):
+        """
+        Returns the raw dot products pruned to K_max and the column norms, from the cache or computing them
+        :param dataMatrix:      matrix whose columns are compared, as passed to Compute_Similarity
+        :param similarity:
+        :param row_weights:
+        :param execution_args:  arguments of Compute_Similarity_Python that do not change the result, e.g. n_workers
+        :return:                W_base, sumOfSquared
+        """
+
+        if similarity in self._SET_SIMILARITIES:
+            similarity = "dice"
+
+        compute_base = functools.partial(self._compute_base, **execution_args)
+
+        return self._artifact_cache.get_or_compute("similarity_base_{}".format(similarity), compute_base,
+                                                   dataMatrix, similarity, row_weights, self.K_max)
+
+    def compute_similarity(self, dataMatrix, topK=100, shrink=0, normalize=True, similarity="cosine",
+                           row_weights=None, **similarity_args):
+        """
+        Same as Compute_Similarity(dataMatrix, ...).compute_similarity(), derived from the cached base when possible
+        :return:    W_sparse
+        """
+
+        similarity_args_all = dict(similarity_args, topK=topK, shrink=shrink, normalize=normalize,
+                                   similarity=similarity, row_weights=row_weights)
+
+        if similarity == "euclidean" or topK > self.K_max:
+            self._print("Similarity '{}' with topK {} is not derived from the base, computing it".format(similarity, topK))
+
+            return Compute_Similarity(dataMatrix, **similarity_args_all).compute_similarity()
+
+        # The columns with more than K_max nonzero products may have lost some of their TopK in the base
+        is_recomputed = self.get_column_product_count(dataMatrix) > self.K_max
+        n_recomputed = int(is_recomputed.sum())
+
+        if n_recomputed > self.max_recomputed_fraction * len(is_recomputed):
+            self._print("{} of {} columns have more than K_max {} nonzero products, computing the similarity".format(
+                n_recomputed, len(is_recomputed), self.K_max))
+
+            return Compute_Similarity(dataMatrix, **similarity_args_all).compute_similarity()
+
+        normalization_args = {key: value for key, value in similarity_args.items() if key in self._NORMALIZATION_ARGS}
+        execution_args = {key: value for key, value in similarity_args.items() if key in self._EXECUTION_ARGS}
+
+        W_base, sumOfSquared = self.get_base(dataMatrix, similarity=similarity, row_weights=row_weights,
+                                             **execution_args)
+
+        similarity_object = Compute_Similarity_Python(dataMatrix, topK=topK, shrink=shrink, normalize=normalize,
+                                                      similarity=similarity, **normalization_args)
+
+        W_sparse = similarity_object.compute_similarity_from_base(W_base, sumOfSquared)
+
+        if n_recomputed == 0:
+            return W_sparse
+
+        self._print("Computing {} columns with more than K_max {} nonzero products".format(n_recomputed, self.K_max))
+
+        W_derived = W_sparse.tocoo()
+        is_kept = ~is_recomputed[W_derived.col]
+
+        W_recomputed = self._compute_similarity_columns(dataMatrix, np.flatnonzero(is_recomputed), **similarity_args_all)
+
+        W_sparse = sps.csr_matrix((np.concatenate((W_derived.data[is_kept], W_recomputed.data)),
+                                   (np.concatenate((W_derived.row[is_kept], W_recomputed.row)),
+                                    np.concatenate((W_derived.col[is_kept], W_recomputed.col)))),
+                                  shape=W_derived.shape, dtype=np.float32)
+
+        return W_sparse
+
+    def print_statistics(self):
+        self._artifact_cache.print_statistics()
+
+    def clear_memory(self):
+        self._artifact_cache.clear_memory()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+#  -*- coding: utf-8 -*-
+
+"""
+	split_store.py: persisted train/validation/test splits. Each split is saved with its random seed, its parameters
+	and the fingerprint of the URM it was drawn from, and reopened memory-mapped while they all match,
+	so every process and every run evaluates on the same data without splitting it again.
+"""
+
+import os
+import json
+import shutil
+
+from utils.dataset_cache import save_sparse_npy, load_sparse_npy, file_lock
+from utils.artifact_cache import compute_fingerprint
+
+
+class SplitStore(object):
+    """
+    Stores the matrices returned by a split function in a folder per split name, as .npy files that
+    parallel workers open memory-mapped and share instead of recomputing or pickling them.
+
+        split_store = SplitStore("result_experiments/splits/")
+        URM_train, URM_validation, URM_test = split_store.get_split("leave_4_out", URM_all, split_train_leave_k_out_user_wise,
+                                                                    random_seed=42, k_out=4, use_validation_set=True)
+    """
+
+    _MANIFEST_FILE_NAME = "manifest.json"
+
+    def __init__(self, folder_path, mmap_mode="c", verbose=True):
+        super(SplitStore, self).__init__()
+
+        self.folder_path = folder_path
+        self.mmap_mode = mmap_mode
+        self.verbose = verbose
+
+    def _print(self, message):
+        if self.verbose:
+            print("{}: {}".format("SplitStore", message))
+
+    def _get_split_folder(self, split_name):
+        return os.path.join(self.folder_path, split_name)
+
+    def _lock(self, split_name, shared=False):
+
+        if not os.path.exists(self.folder_path):
+            os.makedirs(self.folder_path, exist_ok=True)
+
+        return file_lock(os.path.join(self.folder_path, "{}.lock".format(split_name)), shared=shared)
+
+    def _load_manifest(self, split_name):
+
+        manifest_path = os.path.join(self._get_split_folder(split_name), self._MANIFEST_FILE_NAME)
+
+        if not os.path.exists(manifest_path):
+            return None
+
+        with open(manifest_path, 'r') as json_file:
+            return json.load(json_file)
+
+    def _build_manifest(self, URM_fingerprint, split_function, random_seed, split_args):
+
+        # The json round trip makes the arguments comparable with the ones in the saved manifest
+        return {"URM_fingerprint": URM_fingerprint,
+                "split_function": "{}.{}".format(split_function.__module__, split_function.__qualname__),
+                "random_seed": random_seed,
+                "split_args": json.loads(json.dumps(split_args, sort_keys=True))}
+
+    def _is_manifest_valid(self, saved_manifest, manifest):
+        return saved_manifest is not None and all(saved_manifest.get(key) == manifest[key] for key in manifest.keys())
+
+    def _load_split(self, split_name, manifest):
+
+        split_folder = self._get_split_folder(split_name)
+
+        return tuple(load_sparse_npy(split_folder, matrix_name, mmap_mode=self.mmap_mode)
+                     for matrix_name in manifest["matrix_names"])
+
+    def _save_split(self, split_name, manifest, URM_list):
+
+        split_folder = self._get_split_folder(split_name)
+
+        # Write in a temporary folder and move it in place, so that a failed save never leaves a partially written split.
+        # The caller holds the exclusive lock, no other worker is opening the split folder
+        temp_folder = "{}.temp_{}".format(split_folder, os.getpid())
+        shutil.rmtree(temp_folder, ignore_errors=True)
+
+        for matrix_name, URM in zip(manifest["matrix_names"], URM_list):
+            save_sparse_npy(temp_folder, matrix_name, URM)
+
+        with open(os.path.join(temp_folder, self._MANIFEST_FILE_NAME), 'w') as json_file:
+            json.dump(manifest, json_file)
+
+        shutil.rmtree(split_folder, ignore_errors=True)
+        os.replace(temp_folder, split_folder)
+
+    def get_split(self, split_name, URM_all, split_function, random_seed, **split_args):
+        """
+        Returns the saved split if it was drawn from the same URM by the same split function with the same seed and parameters,
+        otherwise calls split_function(URM_all, random_seed=random_seed, **split_args) and saves its result
+        :param split_name:
+        :param URM_all:
+        :param split_function:  function returning a tuple of sparse matrices, e.g. split_train_leave_k_out_user_wise
+        :param random_seed:
+        :param split_args:      json serializable arguments of split_function
+        :return:                tuple of CSR matrices, memory-mapped
+        """
+
+        assert random_seed is not None, "SplitStore: a random_seed is required for the split to be reproducible"
+
+        manifest = self._build_manifest(compute_fingerprint(URM_all), split_function, random_seed, split_args)
+
+        # The split is checked and opened under a shared lock and saved under an exclusive one, so no worker removes
+        # a folder another one is opening. Once open, the memory-mapped matrices outlive the folder
+        with self._lock(split_name, shared=True):
+            saved_manifest = self._load_manifest(split_name)
+
+            if self._is_manifest_valid(saved_manifest, manifest):
+                self._print("Loading split '{}'".format(split_name))
+                return self._load_split(split_name, saved_manifest)
+
+        with self._lock(split_name):
+
+            # Another worker may have saved it while this one waited for the lock
+            saved_manifest = self._load_manifest(split_name)
+
+            if self._is_manifest_valid(saved_manifest, manifest):
+                self._print("Loading split '{}'".format(split_name))
+                return self._load_split(split_name, saved_manifest)
+
+            self._print("Split '{}' missing or outdated, computing it".format(split_name))
+
+            URM_list = split_function(URM_all, random_seed=random_seed, **split_args)
+            manifest["matrix_names"] = ["URM_{}".format(index) for index in range(len(URM_list))]
+
+            self._save_split(split_name, manifest, URM_list)
+
+            return self._load_split(split_name, manifest)